@@ -1,14 +1,20 @@
 # app.py (patched)
 import os
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from google_auth_oauthlib.flow import Flow
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, jsonify
 from auth_utils import load_credentials, save_credentials, revoke_credentials
-from config import CLIENT_SECRETS_FILE, SCOPES
-from drive_utils import build_drive_service, download_drive_file_to_spooled, pick_random_video_from_folder
-from youtube_utils import build_youtube_service, upload_video_from_fileobj, set_thumbnail
+from config import CLIENT_SECRETS_FILE, SCOPES, SCHED_HOURS, SCHED_TARGET_CONCURRENCY
+from drive_utils import pick_random_video_from_folder, return_pick
+from client_utils import client_pool
+from jobs_utils import job_manager
+from ledger_utils import get_ledger
+from quota_utils import quota_ledger, UPLOAD_COST, API_COSTS
+from metrics_utils import render_metrics
+from buffer_utils import buffer_manager
 from tags_utils import fetch_trending_hashtags
+from stream_utils import transfer_drive_to_youtube
 from scheduler_utils import AutoUploader
+from thumbnail_utils import thumbnail_pipeline, upload_thumbnail
 
 # For local development only — allow http redirect (keep this off in production)
 os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
@@ -17,6 +23,59 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name
 logger = logging.getLogger('app')
 
 
+def manual_upload_job(job, creds, drive_file_id, title, description, tags, thumb_drive_id):
+    """Body of a /manual submission, run on the job pool. Returns the YouTube video id."""
+    # reserve quota first so an exhausted budget fails before any Drive bytes move
+    with quota_ledger.reserve(UPLOAD_COST + (API_COSTS['thumbnails.set'] if thumb_drive_id else 0)), \
+            client_pool.lease(creds) as (drive_service, youtube_service):
+        # an unusable thumbnail fails the job before the video is uploaded; rendering overlaps the transfer
+        thumb = thumbnail_pipeline.submit_drive(drive_service, thumb_drive_id) if thumb_drive_id else None
+        if not tags:
+            job.set_stage('tags')
+            try:
+                tags = fetch_trending_hashtags(youtube_service) or []
+            except Exception:
+                logger.exception("Failed to fetch trending tags for manual upload")
+                tags = []
+        job.set_stage('transferring')
+        video_id = transfer_drive_to_youtube(drive_service, youtube_service, drive_file_id, title, description, tags=tags, creds=creds,
+                                             progress=job)
+        get_ledger().record_upload(drive_file_id, video_id=video_id)
+        # thumbnail
+        if thumb is not None:
+            job.set_stage('thumbnail')
+            upload_thumbnail(youtube_service, video_id, thumb)
+        return video_id
+
+
+def folder_upload_job(job, creds, folder_id, region):
+    """Body of a /folder submission, run on the job pool. Returns the YouTube video id."""
+    with quota_ledger.reserve(UPLOAD_COST), client_pool.lease(creds) as (drive_service, youtube_service):
+        job.set_stage('picking')
+        video_meta = pick_random_video_from_folder(drive_service, folder_id)
+        if not video_meta:
+            raise ValueError('No video found in folder')
+        job.picked = video_meta.get('name')
+        try:
+            job.set_stage('tags')
+            tags = fetch_trending_hashtags(youtube_service, regionCode=region) if region else fetch_trending_hashtags(youtube_service)
+            title = video_meta.get('name') or 'Short'
+            job.set_stage('transferring')
+            video_id = transfer_drive_to_youtube(drive_service, youtube_service, video_meta['id'], title, f'Auto-pick from folder {folder_id}',
+                                                 tags=tags, creds=creds, progress=job)
+        except Exception:
+            return_pick(folder_id, video_meta)
+            raise
+        get_ledger().record_upload(video_meta['id'], video_meta.get('md5Checksum'), folder_id, video_id)
+        return video_id
+
+
+def _job_accepted(job):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+    return render_template('result.html', message=f'Job queued: {job.id}', job_id=job.id), 202
+
+
 def create_app():
     app = Flask(__name__)
     app.secret_key = os.environ.get('FLASK_SECRET', 'change-me')
@@ -28,12 +87,14 @@ def create_app():
     @app.route('/')
     def index():
         creds = load_credentials()
-        return render_template('index.html', authorized=bool(creds))
+        return render_template('index.html', authorized=bool(creds), targets=app.auto_uploader.list_targets())
 
     @app.route('/authorize')
     def authorize():
         if not os.path.exists(CLIENT_SECRETS_FILE):
             return 'Place credentials.json in the application folder.'
+        # the OAuth flow stack (oauthlib, requests-oauthlib) is only loaded when someone authorizes
+        from google_auth_oauthlib.flow import Flow
         flow = Flow.from_client_secrets_file(
             CLIENT_SECRETS_FILE,
             scopes=SCOPES,
@@ -50,6 +111,7 @@ def create_app():
     @app.route('/oauth2callback')
     def oauth2callback():
         state = session.get('state')
+        from google_auth_oauthlib.flow import Flow
         flow = Flow.from_client_secrets_file(
             CLIENT_SECRETS_FILE,
             scopes=SCOPES,
@@ -94,25 +156,9 @@ def create_app():
         tags = [t.strip() for t in tags_raw.split(',') if t.strip()]
         thumb_drive_id = request.form.get('thumb_drive_id')
 
-        try:
-            drive_service = build_drive_service(creds)
-            youtube_service = build_youtube_service(creds)
-            sp = download_drive_file_to_spooled(drive_service, drive_file_id)
-            if not tags:
-                try:
-                    tags = fetch_trending_hashtags(youtube_service) or []
-                except Exception:
-                    logger.exception("Failed to fetch trending tags for manual upload")
-                    tags = []
-            video_id = upload_video_from_fileobj(youtube_service, sp, title, description, tags=tags)
-            # thumbnail
-            if thumb_drive_id:
-                thumb_sp = download_drive_file_to_spooled(drive_service, thumb_drive_id, max_mem=1 * 1024 * 1024)
-                set_thumbnail(youtube_service, video_id, thumb_fileobj=thumb_sp)
-            return render_template('result.html', message=f'Uploaded video id: {video_id}')
-        except Exception as e:
-            logger.exception('Manual upload failed')
-            return render_template('result.html', message=f'Error: {e}')
+        job = job_manager.submit('manual', lambda job: manual_upload_job(job, creds, drive_file_id, title, description, tags, thumb_drive_id),
+                                 params={'drive_file_id': drive_file_id, 'title': title})
+        return _job_accepted(job)
 
     # Folder single-upload (manual trigger)
     @app.route('/folder', methods=['GET', 'POST'])
@@ -129,20 +175,9 @@ def create_app():
             flash('Provide folder id')
             return redirect(url_for('folder'))
 
-        try:
-            drive_service = build_drive_service(creds)
-            youtube_service = build_youtube_service(creds)
-            video_meta = pick_random_video_from_folder(drive_service, folder_id)
-            if not video_meta:
-                return render_template('result.html', message='No video found in folder')
-            sp = download_drive_file_to_spooled(drive_service, video_meta['id'])
-            tags = fetch_trending_hashtags(youtube_service, regionCode=region) if region else fetch_trending_hashtags(youtube_service)
-            title = video_meta.get('name') or 'Short'
-            video_id = upload_video_from_fileobj(youtube_service, sp, title, f'Auto-pick from folder {folder_id}', tags=tags)
-            return render_template('result.html', message=f'Uploaded video id: {video_id} (picked: {video_meta.get("name")})')
-        except Exception as e:
-            logger.exception('Folder manual upload failed')
-            return render_template('result.html', message=f'Error: {e}')
+        job = job_manager.submit('folder', lambda job: folder_upload_job(job, creds, folder_id, region),
+                                 params={'folder_id': folder_id, 'region': region})
+        return _job_accepted(job)
 
     # Scheduler control - start (runs immediately on start for convenience)
     @app.route('/scheduler/start', methods=['POST'])
@@ -167,7 +202,7 @@ def create_app():
         flash('Scheduler stopped')
         return redirect(url_for('index'))
 
-    # Run now synchronous endpoint for debugging (runs job inside current request)
+    # Run now endpoint for debugging (queues one run of the scheduled job body)
     @app.route('/scheduler/run_now', methods=['POST'])
     def sched_run_now():
         creds = load_credentials()
@@ -180,18 +215,84 @@ def create_app():
             flash('Provide folder id')
             return redirect(url_for('index'))
 
-        # set properties and call the job wrapper synchronously (it will use app.app_context())
-        try:
-            app.auto_uploader.folder_id = folder_id
-            app.auto_uploader.region = region
-            # run job synchronously (useful to see exceptions in logs immediately)
-            app.auto_uploader._job_wrapper()
-            flash('Run executed (check server logs for details)')
-        except Exception as e:
-            logger.exception("Run now failed")
-            flash(f'Run failed: {e}')
+        # run job in the background job pool (it will use app.app_context()); poll /jobs/<id> for status
+        job = job_manager.submit('run_now', lambda job: app.auto_uploader.run_once(folder_id, region, job=job),
+                                 params={'folder_id': folder_id, 'region': region})
+        flash(f'Run queued as job {job.id} (see {url_for("job_status", job_id=job.id)})')
         return redirect(url_for('index'))
 
+    # YouTube quota usage for the current Pacific day
+    @app.route('/quota')
+    def quota_status():
+        return jsonify(quota_ledger.snapshot())
+
+    # Transfer buffer memory: budget, bytes leased and pooled, spills to the scratch directory
+    @app.route('/buffers')
+    def buffer_status():
+        return jsonify(buffer_manager.stats())
+
+    # Upload history with the YouTube processing state recorded by the status poller
+    @app.route('/uploads')
+    def uploads():
+        return jsonify(get_ledger().history(limit=request.args.get('limit', 50, type=int)))
+
+    # Prometheus scrape endpoint: stage timings, bytes, API calls/latency, retries, scheduler lag
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    # Background job status
+    @app.route('/jobs')
+    def jobs_list():
+        return jsonify(job_manager.list())
+
+    @app.route('/jobs/<job_id>')
+    def job_status(job_id):
+        job = job_manager.get(job_id)
+        if job is None:
+            return jsonify({'error': 'unknown job'}), 404
+        return jsonify(job.to_dict())
+
+    # Multi-target scheduler: list / add / remove (folder, region, interval) targets
+    @app.route('/scheduler/targets', methods=['GET'])
+    def sched_targets():
+        return jsonify(app.auto_uploader.list_targets())
+
+    @app.route('/scheduler/targets', methods=['POST'])
+    def sched_add_target():
+        data = request.get_json(silent=True) or request.form
+        folder_id = (data.get('folder_id') or '').strip()
+        if not folder_id:
+            return jsonify({'error': 'folder_id is required'}), 400
+        try:
+            interval = float(data.get('interval') or SCHED_HOURS)
+            concurrency = int(data.get('concurrency') or SCHED_TARGET_CONCURRENCY)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'interval and concurrency must be numbers'}), 400
+        if not 0 < interval < float('inf') or concurrency <= 0:
+            return jsonify({'error': 'interval and concurrency must be positive'}), 400
+        target_id = app.auto_uploader.add_target(
+            folder_id,
+            region=(data.get('region') or 'US').strip(),
+            interval=interval,
+            concurrency=concurrency,
+            target_id=(data.get('id') or '').strip() or None,
+            run_immediately=str(data.get('run_immediately', '')).lower() in ('1', 'true', 'on', 'yes'),
+        )
+        return jsonify({'id': target_id}), 201
+
+    @app.route('/scheduler/targets/<target_id>', methods=['DELETE'])
+    @app.route('/scheduler/targets/<target_id>/delete', methods=['POST'])
+    def sched_remove_target(target_id):
+        removed = app.auto_uploader.remove_target(target_id)
+        if request.method == 'POST' and request.accept_mimetypes.best != 'application/json':
+            # the Remove button on the index page
+            flash(f'Removed target {target_id}' if removed else f'Unknown target {target_id}')
+            return redirect(url_for('index'))
+        if not removed:
+            return jsonify({'error': 'unknown target'}), 404
+        return jsonify({'removed': target_id})
+
     return app
 
 
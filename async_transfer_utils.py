@@ -0,0 +1,367 @@
+import json
+import time
+import types
+import socket
+import asyncio
+import logging
+import functools
+from config import (ASYNC_CONNECTION_LIMIT, ASYNC_CONNECTIONS_PER_HOST, ASYNC_CHUNK_SIZE, DRIVE_API_URL, YOUTUBE_UPLOAD_URL,
+                    TRANSFER_STALL_GRACE, UPLOAD_CHUNK_MODE)
+from buffer_utils import buffer_manager
+from quota_utils import quota_ledger, is_quota_error
+from transfer_utils import RetryPolicy, RETRYABLE_STATUS, RATE_LIMIT_REASONS
+from youtube_utils import AdaptiveChunker, build_video_body, CHUNK_GRANULARITY
+from metrics_utils import (span, api_call, record_transfer, TRANSFER_BYTES, RETRIES, RETRY_REASONS, RETRY_BACKOFF,
+                           TRANSFER_GIVEUPS)
+
+try:
+    import aiohttp
+except ImportError:   # optional: only this engine needs it
+    aiohttp = None
+
+logger = logging.getLogger('async_transfer_utils')
+
+
+class AsyncHttpError(Exception):
+    """Unexpected HTTP status; resp.status and content mirror googleapiclient's HttpError (api_call, is_quota_error)."""
+
+    def __init__(self, status, content, url):
+        super().__init__('HTTP %d from %s: %s' % (status, url.split('?')[0], content[:200]))
+        self.resp = types.SimpleNamespace(status=status)
+        self.content = content
+
+
+def retry_reason(exc):
+    """transfer_utils.retry_reason for aiohttp failures."""
+    if isinstance(exc, AsyncHttpError):
+        status = exc.resp.status
+        if status in RETRYABLE_STATUS:
+            return 'http_%d' % status
+        if status == 429:
+            return 'rate_limit'
+        if status == 403 and any(r in str(exc.content) for r in RATE_LIMIT_REASONS):
+            return 'rate_limit'
+        return None
+    if isinstance(exc, asyncio.TimeoutError):
+        # sock_read timeout: no bytes for TRANSFER_STALL_GRACE seconds
+        return 'stall'
+    if isinstance(exc, socket.timeout):
+        return 'timeout'
+    if isinstance(exc, (aiohttp.ClientError, OSError)):
+        return 'network'
+    return None
+
+
+def _refresh_credentials(creds):
+    """Blocking: valid credentials, refreshed through auth_utils so token.json stays shared with the threaded path."""
+    from google.auth.transport.requests import Request
+    from auth_utils import load_credentials, save_credentials
+    fresh = load_credentials()
+    if fresh is not None and fresh.valid and fresh.token != creds.token:
+        return fresh
+    creds.refresh(Request())
+    save_credentials(creds)
+    return creds
+
+
+class AsyncTransferEngine:
+    """Drive media downloads and YouTube resumable uploads over one pooled aiohttp session.
+
+    The wire protocols are spoken directly (ranged Drive GETs, resumable session POST and
+    Content-Range PUTs) so a transfer in flight costs a coroutine, not an OS thread; the
+    connector caps connections in total and per host. The coroutines mirror the threaded
+    functions of drive_utils/youtube_utils/stream_utils and take the same auth_utils credentials:
+
+        async with AsyncTransferEngine(load_credentials()) as engine:
+            video_ids = await asyncio.gather(*(engine.transfer_drive_to_youtube(f, title, desc) for f in file_ids))
+    """
+
+    def __init__(self, creds=None, limit=ASYNC_CONNECTION_LIMIT, limit_per_host=ASYNC_CONNECTIONS_PER_HOST,
+                 chunk_size=ASYNC_CHUNK_SIZE, drive_endpoint=DRIVE_API_URL, upload_endpoint=YOUTUBE_UPLOAD_URL, policy=None):
+        if aiohttp is None:
+            raise RuntimeError('the async transfer engine needs aiohttp (pip install aiohttp)')
+        if chunk_size % CHUNK_GRANULARITY:
+            raise ValueError('chunk_size must be a multiple of %d' % CHUNK_GRANULARITY)
+        self.creds = creds
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.chunk_size = chunk_size
+        self.drive_endpoint = drive_endpoint
+        self.upload_endpoint = upload_endpoint
+        self.policy = policy or RetryPolicy()
+        self.session = None
+        self._refresh_lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=TRANSFER_STALL_GRACE)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+            self._refresh_lock = asyncio.Lock()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # -- plumbing -------------------------------------------------------------
+
+    async def _headers(self, refresh=False):
+        creds = self.creds
+        if creds is None:
+            return {}
+        if refresh or not creds.valid:
+            async with self._refresh_lock:
+                if self.creds is creds and (refresh or not creds.valid):
+                    # token refresh is blocking I/O: keep it off the event loop
+                    self.creds = await asyncio.get_running_loop().run_in_executor(None, _refresh_credentials, creds)
+                creds = self.creds
+        return {'Authorization': 'Bearer %s' % creds.token}
+
+    async def _retry(self, operation, call):
+        """call(headers) with transient failures retried like transfer_utils.run_chunk; one 401 refreshes the token."""
+        attempt = 0
+        refresh = refreshed = False
+        while True:
+            try:
+                return await call(await self._headers(refresh=refresh))
+            except Exception as e:
+                refresh = False
+                if isinstance(e, AsyncHttpError) and e.resp.status == 401 and not refreshed and self.creds is not None:
+                    refresh = refreshed = True
+                    continue
+                reason = retry_reason(e)
+                if reason is None or attempt >= self.policy.retries:
+                    if reason is not None:
+                        TRANSFER_GIVEUPS.inc(operation=operation)
+                    raise
+                attempt += 1
+                delay = self.policy.delay(attempt)
+                RETRIES.inc(operation=operation)
+                RETRY_REASONS.inc(operation=operation, reason=reason)
+                RETRY_BACKOFF.observe(delay, operation=operation)
+                logger.warning('%s failed (%s: %s); retry %d/%d in %.1fs', operation, reason, e, attempt, self.policy.retries, delay)
+                await asyncio.sleep(delay)
+
+    # -- Drive ----------------------------------------------------------------
+
+    async def get_file_metadata(self, file_id, fields='id, name, mimeType, size'):
+        url = f'{self.drive_endpoint}files/{file_id}'
+
+        async def call(headers):
+            with api_call('drive.files.get'):
+                async with self.session.get(url, params={'fields': fields}, headers=headers) as resp:
+                    body = await resp.read()
+                    if resp.status != 200:
+                        raise AsyncHttpError(resp.status, body, url)
+                    return json.loads(body)
+        return await self._retry('drive.files.get', call)
+
+    async def _download_range(self, file_id, start, end):
+        """Bytes start..end (inclusive) of a Drive file and the file's total size."""
+        url = f'{self.drive_endpoint}files/{file_id}'
+
+        async def call(headers):
+            headers['Range'] = f'bytes={start}-{end}'
+            with api_call('drive.files.get_media'):
+                async with self.session.get(url, params={'alt': 'media'}, headers=headers) as resp:
+                    data = await resp.read()
+                    if resp.status == 206:
+                        total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+                        return data, int(total) if total.isdigit() else None
+                    if resp.status == 200:
+                        # whole file despite the Range header
+                        return data[start:end + 1], len(data)
+                    raise AsyncHttpError(resp.status, data, url)
+        data, total = await self._retry('drive.download', call)
+        TRANSFER_BYTES.inc(len(data), direction='download')
+        return data, total
+
+    async def _ranges(self, file_id):
+        """Yield (chunk, file size) in order, downloading the next chunk while the caller handles the current one."""
+        start = 0
+        task = asyncio.ensure_future(self._download_range(file_id, 0, self.chunk_size - 1))
+        try:
+            while task is not None:
+                data, size = await task
+                start += len(data)
+                task = None
+                if data and (size is None or start < size):
+                    task = asyncio.ensure_future(self._download_range(file_id, start, start + self.chunk_size - 1))
+                yield data, size if size is not None else start
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def download_drive_file_to_spooled(self, file_id, max_mem=None, progress_callback=None):
+        """drive_utils.download_drive_file_to_spooled: the file in a budgeted spool, seeked to the start."""
+        # the spool takes budget locks and may spill to a scratch file: keep it off the event loop
+        loop = asyncio.get_running_loop()
+        sp = await loop.run_in_executor(None, buffer_manager.spool, max_mem)
+        received = 0
+        started = time.monotonic()
+        try:
+            with span('download', file_id=file_id, mode='async'):
+                chunks = self._ranges(file_id)
+                try:
+                    async for data, size in chunks:
+                        await loop.run_in_executor(None, sp.write, data)
+                        received += len(data)
+                        if progress_callback is not None:
+                            progress_callback(received, size)
+                finally:
+                    await chunks.aclose()
+        except BaseException:
+            sp.close()
+            raise
+        record_transfer('download', received, time.monotonic() - started)
+        sp.seek(0)
+        return sp
+
+    # -- YouTube resumable upload ---------------------------------------------
+
+    async def _create_session(self, body, size):
+        async def call(headers):
+            headers.update({'Content-Type': 'application/json; charset=UTF-8', 'X-Upload-Content-Type': 'video/*'})
+            if size is not None:
+                headers['X-Upload-Content-Length'] = str(size)
+            with api_call('youtube.videos.insert'):
+                async with self.session.post(self.upload_endpoint, params={'uploadType': 'resumable', 'part': 'snippet,status'},
+                                             data=json.dumps(body), headers=headers) as resp:
+                    content = await resp.read()
+                    if resp.status != 200 or 'Location' not in resp.headers:
+                        raise AsyncHttpError(resp.status, content, self.upload_endpoint)
+                    return resp.headers['Location']
+        # the session-creating call is the one that spends the videos.insert quota. The ledger takes a
+        # file lock and rewrites its state file, so it runs off the event loop, drawing on the
+        # reservation held by the loop's thread
+        loop = asyncio.get_running_loop()
+        charge = functools.partial(quota_ledger.charge, 'videos.insert', reservation=quota_ledger.current_reservation())
+        await loop.run_in_executor(None, charge)
+        try:
+            return await self._retry('youtube.upload', call)
+        except AsyncHttpError as e:
+            if is_quota_error(e):
+                await loop.run_in_executor(None, quota_ledger.mark_exhausted)
+            raise
+
+    async def _put(self, uri, data, offset, total, headers):
+        """One PUT to the session; returns (committed bytes, video resource or None). Empty data queries the offset."""
+        size = str(total) if total is not None else '*'
+        headers['Content-Range'] = f'bytes {offset}-{offset + len(data) - 1}/{size}' if data else f'bytes */{size}'
+        with api_call('youtube.videos.insert'):
+            async with self.session.put(uri, data=data, headers=headers) as resp:
+                content = await resp.read()
+                if resp.status in (200, 201):
+                    return total if total is not None else offset + len(data), json.loads(content)
+                if resp.status == 308:
+                    rng = resp.headers.get('Range')
+                    return (int(rng.rsplit('-', 1)[1]) + 1 if rng else 0), None
+                raise AsyncHttpError(resp.status, content, uri)
+
+    async def _send_chunk(self, uri, data, offset, total):
+        """Send data at offset until the session has committed all of it (or returned the video resource).
+
+        A 308 may commit less than was sent; the uncommitted tail is sent again. A retry first asks
+        the session what it committed and resends only the rest.
+        """
+        end = offset + len(data)
+        state = {'committed': offset, 'query': False}
+
+        async def call(headers):
+            if state['query']:
+                committed, response = await self._put(uri, b'', None, total, dict(headers))
+                if response is not None or committed >= end:
+                    return committed, response
+                if committed < offset:
+                    raise IOError('upload session committed %d bytes, but this chunk starts at %d' % (committed, offset))
+                state['committed'] = committed
+            state['query'] = True
+            while True:
+                start = state['committed']
+                committed, response = await self._put(uri, memoryview(data)[start - offset:], start, total, dict(headers))
+                if response is not None or committed >= end:
+                    return committed, response
+                if committed <= start:
+                    raise IOError('upload session committed nothing of bytes %d-%d' % (start, end - 1))
+                state['committed'] = committed
+        return await self._retry('youtube.upload', call)
+
+    async def _upload(self, chunks, title, description, tags, privacy, stats=None, chunker=None, progress_callback=None,
+                      resume_uri=None, resume_offset=0, size=None):
+        """Resumable videos.insert fed by an async iterator of (chunk, total size). Returns the video id."""
+        uri = resume_uri or await self._create_session(build_video_body(title, description, tags=tags, privacy=privacy), size)
+        if stats is not None:
+            stats.mode = 'async-adaptive' if chunker else 'async'
+        offset = resume_offset
+        response = None
+        upload_started = time.monotonic()
+        with span('upload', title=title, resumed=bool(resume_uri)):
+            try:
+                async for data, total in chunks:
+                    started = time.monotonic()
+                    committed, response = await self._send_chunk(uri, data, offset, total)
+                    elapsed = time.monotonic() - started
+                    sent = committed - offset
+                    offset = committed
+                    TRANSFER_BYTES.inc(sent, direction='upload')
+                    if stats is not None:
+                        stats.record(sent, elapsed, len(data))
+                    if chunker is not None:
+                        chunker.observe(sent, elapsed)
+                    if progress_callback is not None:
+                        progress_callback(uri, offset, total)
+                    if response is not None:
+                        break
+            finally:
+                await chunks.aclose()
+        if response is None:
+            raise IOError('upload source ended at byte %d without a video resource' % offset)
+        record_transfer('upload', offset - resume_offset, time.monotonic() - upload_started)
+        logger.info('Upload finished: video id=%s', response.get('id'))
+        return response.get('id')
+
+    async def upload_video_from_fileobj(self, fileobj, title, description, tags=None, privacy='public', chunk_size=None,
+                                        adaptive=None, stats=None, progress_callback=None, resume_uri=None, resume_offset=0):
+        """youtube_utils.upload_video_from_fileobj for a seekable file object. Returns the video id."""
+        size = fileobj.seek(0, 2)
+        fileobj.seek(resume_offset)
+        if adaptive is None:
+            adaptive = UPLOAD_CHUNK_MODE == 'adaptive'
+        chunker = AdaptiveChunker(initial=chunk_size or self.chunk_size) if adaptive else None
+
+        async def chunks():
+            while True:
+                data = fileobj.read(chunker.current if chunker else chunk_size or self.chunk_size)
+                if not data:
+                    return
+                yield data, size
+        return await self._upload(chunks(), title, description, tags, privacy, stats=stats, chunker=chunker,
+                                  progress_callback=progress_callback, resume_uri=resume_uri, resume_offset=resume_offset, size=size)
+
+    async def transfer_drive_to_youtube(self, file_id, title, description, tags=None, privacy='public', progress=None, stats=None):
+        """stream_utils.transfer_drive_to_youtube: Drive ranges go straight into upload chunks (no spool).
+
+        progress (a jobs_utils.Job or anything with on_download/on_upload) receives byte counts.
+        """
+        async def chunks():
+            done = 0
+            ranges = self._ranges(file_id)
+            try:
+                async for data, size in ranges:
+                    done += len(data)
+                    if progress is not None:
+                        progress.on_download(done, size)
+                    yield data, size
+            finally:
+                await ranges.aclose()
+        on_upload = (lambda uri, offset, total: progress.on_upload(offset, total)) if progress is not None else None
+        with span('transfer', file_id=file_id, mode='async'):
+            return await self._upload(chunks(), title, description, tags, privacy, stats=stats, progress_callback=on_upload)
@@ -1,39 +1,73 @@
 import os
 import logging
+import threading
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from config import TOKEN_FILE, SCOPES
 
 logger = logging.getLogger('auth_utils')
 
+# In-memory copy of TOKEN_FILE, shared by every request and job in the process.
+# _refresh_lock makes reload/refresh single-flight: concurrent callers wait for one refresh
+# instead of each refreshing and rewriting token.json.
+_cached = {'creds': None, 'stamp': None}
+_refresh_lock = threading.Lock()
 
-def load_credentials():
-    """Load saved credentials from TOKEN_FILE. Refresh if expired."""
+
+def _token_stamp():
+    try:
+        st = os.stat(TOKEN_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def read_credentials():
+    """Parse TOKEN_FILE without refreshing. Returns None if missing or unreadable."""
     if not os.path.exists(TOKEN_FILE):
         return None
     try:
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+        return Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
     except Exception as e:
         logger.exception("Failed to read credentials file: %s", e)
         return None
 
-    if creds and creds.expired and creds.refresh_token:
-        try:
-            creds.refresh(Request())
-            save_credentials(creds)
-        except Exception as e:
-            logger.exception('Failed to refresh credentials: %s', e)
+
+def load_credentials():
+    """Return process-wide cached credentials, reloading TOKEN_FILE only when it changes. Refresh if expired."""
+    creds = _cached['creds']
+    if creds is not None and creds.valid and _cached['stamp'] == _token_stamp():
+        return creds
+
+    with _refresh_lock:
+        # another thread may have reloaded/refreshed while we waited
+        stamp = _token_stamp()
+        if stamp is None:
+            _cached['creds'], _cached['stamp'] = None, None
             return None
-    return creds
+        if _cached['creds'] is None or _cached['stamp'] != stamp:
+            _cached['creds'], _cached['stamp'] = read_credentials(), stamp
+        creds = _cached['creds']
+
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                save_credentials(creds)
+            except Exception as e:
+                logger.exception('Failed to refresh credentials: %s', e)
+                return None
+        return creds
 
 
 def save_credentials(creds):
     """Save credentials to TOKEN_FILE."""
     with open(TOKEN_FILE, 'w') as f:
         f.write(creds.to_json())
+    _cached['creds'], _cached['stamp'] = creds, _token_stamp()
     logger.info('Saved credentials to %s', TOKEN_FILE)
 
 
 def revoke_credentials():
     if os.path.exists(TOKEN_FILE):
         os.remove(TOKEN_FILE)
+    _cached['creds'], _cached['stamp'] = None, None
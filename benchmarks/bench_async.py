@@ -0,0 +1,160 @@
+"""Threaded vs asyncio transfer engine: many concurrent Drive -> YouTube transfers against the local fake server.
+
+- threaded: stream_utils.transfer_drive_to_youtube on one thread per transfer, each with its own
+  googleapiclient services (httplib2 connections are not thread-safe), as the job pool runs them
+- async:    async_transfer_utils.AsyncTransferEngine.transfer_drive_to_youtube, all transfers gathered
+  on one event loop over one pooled connector
+
+Each (engine, concurrency) case runs in a fresh subprocess; one JSON object per case reports wall
+time, aggregate MB/s, peak threads, peak RSS and how many uploads arrived intact (md5 matched):
+
+    python benchmarks/bench_async.py --concurrency 10,100,300 --size-mb 4 --latency-ms 20 --bandwidth-mbps 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from bench_transfer import MB, _peak_rss_mb  # noqa: E402
+from conftest import isolate_state, fake_services  # noqa: E402
+
+ENGINES = ('threaded', 'async')
+
+
+class _ThreadSampler:
+    """Highest threading.active_count() seen while running."""
+
+    def __init__(self, interval=0.05):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# -- child: runs one case -----------------------------------------------------
+
+def _run_threaded(args, file_ids):
+    from concurrent.futures import ThreadPoolExecutor
+    from stream_utils import transfer_drive_to_youtube
+
+    def one(file_id):
+        drive, youtube = fake_services(args.endpoint)
+        return transfer_drive_to_youtube(drive, youtube, file_id, file_id, 'bench upload')
+
+    with ThreadPoolExecutor(max_workers=len(file_ids)) as pool:
+        return list(pool.map(one, file_ids))
+
+
+def _run_async(args, file_ids):
+    import asyncio
+    from async_transfer_utils import AsyncTransferEngine
+
+    async def main():
+        async with AsyncTransferEngine(drive_endpoint=args.endpoint + '/drive/v3/',
+                                       upload_endpoint=args.endpoint + '/upload/youtube/v3/videos') as engine:
+            return await asyncio.gather(*(engine.transfer_drive_to_youtube(f, f, 'bench upload') for f in file_ids))
+    return asyncio.run(main())
+
+
+def run_child(args):
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix='bench-')
+    isolate_state(tmp)
+    file_ids = [f'file{i}' for i in range(args.concurrency)]
+    result = {'engine': args.engine, 'concurrency': args.concurrency, 'size_mb': args.size_mb}
+    error = None
+    video_ids = []
+    started = time.perf_counter()
+    with _ThreadSampler() as threads:
+        try:
+            video_ids = (_run_threaded if args.engine == 'threaded' else _run_async)(args, file_ids)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+    elapsed = time.perf_counter() - started
+    total = args.size_mb * len(video_ids)
+    result.update(seconds=round(elapsed, 3), mb_per_s=round(total / elapsed, 2) if elapsed else None, peak_threads=threads.peak,
+                  peak_rss_mb=_peak_rss_mb(), video_ids=video_ids, error=error)
+    shutil.rmtree(tmp, ignore_errors=True)
+    print(json.dumps(result))
+
+
+# -- parent: fake server + one subprocess per case ------------------------------
+
+def run_parent(args):
+    from fake_google import FakeGoogle
+    server = FakeGoogle(latency=args.latency_ms / 1000.0, bandwidth=int(args.bandwidth_mbps * MB), error_rate=args.error_rate,
+                        partial_rate=args.partial_rate)
+    levels = [int(c) for c in args.concurrency.split(',')]
+    for i in range(max(levels)):
+        server.add_file(f'file{i}', int(args.size_mb * MB))
+    server.start()
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for concurrency in levels:
+            for engine in args.engines.split(','):
+                server.reset_counters()
+                server.completed.clear()
+                cmd = [sys.executable, os.path.abspath(__file__), '--child', '--engine', engine, '--endpoint', server.url,
+                       '--concurrency', str(concurrency), '--size-mb', str(args.size_mb)]
+                proc = subprocess.run(cmd, capture_output=True, text=True, cwd=ROOT)
+                lines = [ln for ln in proc.stdout.splitlines() if ln.startswith('{')]
+                result = json.loads(lines[-1]) if lines else {'engine': engine, 'concurrency': concurrency,
+                                                               'error': proc.stderr.strip()[-500:]}
+                # intact: the fake server saw the same bytes the source file holds
+                expected = {f.md5 for f in server.files.values()}
+                video_ids = result.pop('video_ids', None) or []
+                result['intact'] = sum(1 for v in video_ids if server.completed.get(v) in expected)
+                result.update(api=server.stats(), latency_ms=args.latency_ms, bandwidth_mbps=args.bandwidth_mbps,
+                              error_rate=args.error_rate, partial_rate=args.partial_rate)
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+    finally:
+        server.stop()
+        if out is not sys.stdout:
+            out.close()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--concurrency', default='10,100', help='comma separated numbers of simultaneous transfers')
+    p.add_argument('--size-mb', type=float, default=4)
+    p.add_argument('--engines', default=','.join(ENGINES))
+    p.add_argument('--latency-ms', type=float, default=20.0)
+    p.add_argument('--bandwidth-mbps', type=float, default=0.0, help='MB/s per connection, 0 = unlimited')
+    p.add_argument('--error-rate', type=float, default=0.0, help='fraction of media requests answered with 503')
+    p.add_argument('--partial-rate', type=float, default=0.0, help='fraction of upload chunks the server commits only half of')
+    p.add_argument('--output', help='write JSON lines here instead of stdout')
+    # child-only
+    p.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    p.add_argument('--engine', help=argparse.SUPPRESS)
+    p.add_argument('--endpoint', help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        args.concurrency = int(args.concurrency)
+        run_child(args)
+    else:
+        run_parent(args)
+
+
+if __name__ == '__main__':
+    main()
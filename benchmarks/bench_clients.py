@@ -0,0 +1,73 @@
+"""Micro-benchmark: per-request cost of getting credentials + API clients.
+
+before: re-read token.json and build both services from the discovery document on every request
+        (old behaviour: googleapiclient.discovery.build, no discovery cache, no pool)
+after:  cached credentials (auth_utils.load_credentials) + leased clients (client_utils.client_pool)
+
+Runs offline against a throwaway token.json; prints one JSON object.
+
+    python benchmarks/bench_clients.py [iterations]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from googleapiclient.discovery import build  # noqa: E402
+
+import auth_utils  # noqa: E402
+from client_utils import client_pool  # noqa: E402
+
+
+def _write_fake_token(path):
+    expiry = (datetime.utcnow() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    with open(path, 'w') as f:
+        json.dump({'token': 'bench-token', 'refresh_token': 'bench-refresh', 'client_id': 'bench',
+                   'client_secret': 'bench', 'token_uri': 'https://oauth2.googleapis.com/token',
+                   'scopes': auth_utils.SCOPES, 'expiry': expiry}, f)
+
+
+def _time_per_call(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations
+
+
+def before():
+    creds = auth_utils.read_credentials()
+    # called directly: build_drive_service/build_youtube_service now go through discovery_utils
+    build('drive', 'v3', credentials=creds, cache_discovery=False)
+    build('youtube', 'v3', credentials=creds, cache_discovery=False)
+
+
+def after():
+    creds = auth_utils.load_credentials()
+    with client_pool.lease(creds) as (drive_service, youtube_service):
+        pass
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as tmp:
+        auth_utils.TOKEN_FILE = os.path.join(tmp, 'token.json')
+        _write_fake_token(auth_utils.TOKEN_FILE)
+        after()  # warm the cache/pool once, as a long-running process would be
+        t_before = _time_per_call(before, iterations)
+        t_after = _time_per_call(after, iterations)
+    print(json.dumps({
+        'benchmark': 'client_overhead',
+        'iterations': iterations,
+        'before_ms_per_request': round(t_before * 1000, 3),
+        'after_ms_per_request': round(t_after * 1000, 3),
+        'speedup': round(t_before / t_after, 1) if t_after else None,
+        'pool': client_pool.stats(),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Startup benchmark: cold import time of the app and time to the first `/` response.
+
+Every run is a fresh interpreter, as in a new container or a Werkzeug reload. The child
+measures from its first line: importing `app`, create_app(), then one GET / through the
+Flask test client. It runs with FLASK_DEBUG=1 outside the reloader, so the scheduler is not
+started and no uploads can run. The slowest top-level imports come from `python -X importtime`.
+
+Prints one JSON object with median timings over the runs:
+
+    python benchmarks/bench_startup.py [--runs 5] [--top 10]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import time
+started = time.perf_counter()
+import sys, json
+sys.path.insert(0, %(root)r)
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+status = flask_app.test_client().get('/').status_code
+answered = time.perf_counter()
+print(json.dumps({'import_s': imported - started, 'create_app_s': created - imported,
+                  'first_response_s': answered - started, 'status': status,
+                  'loaded': sorted(m for m in ('pytrends', 'pandas', 'apscheduler', 'googleapiclient.discovery',
+                                               'google_auth_oauthlib') if m in sys.modules)}))
+'''
+
+
+def _child_env():
+    env = dict(os.environ, FLASK_DEBUG='1')
+    env.pop('WERKZEUG_RUN_MAIN', None)
+    return env
+
+
+def run_once():
+    proc = subprocess.run([sys.executable, '-c', CHILD % {'root': ROOT}], capture_output=True, text=True, cwd=ROOT, env=_child_env())
+    lines = [ln for ln in proc.stdout.splitlines() if ln.startswith('{')]
+    if not lines:
+        raise RuntimeError('startup child failed: %s' % proc.stderr.strip()[-500:])
+    return json.loads(lines[-1])
+
+
+def slowest_imports(top):
+    """Top-level modules by cumulative import time (microseconds) while importing app."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], capture_output=True, text=True, cwd=ROOT,
+                          env=_child_env())
+    totals = []
+    for line in proc.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package"
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[0].startswith('import time:') or not parts[1].strip().isdigit():
+            continue
+        # nested imports are indented by two more spaces per level
+        if not parts[2].startswith('  '):
+            totals.append((int(parts[1]), parts[2].strip()))
+    totals.sort(reverse=True)
+    return [{'module': name, 'cumulative_ms': round(us / 1000.0, 1)} for us, name in totals[:top]]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--runs', type=int, default=5)
+    p.add_argument('--top', type=int, default=10, help='slowest top-level imports to list')
+    args = p.parse_args()
+    runs = [run_once() for _ in range(args.runs)]
+    print(json.dumps({
+        'runs': args.runs,
+        'import_ms': round(statistics.median(r['import_s'] for r in runs) * 1000, 1),
+        'create_app_ms': round(statistics.median(r['create_app_s'] for r in runs) * 1000, 1),
+        'first_response_ms': round(statistics.median(r['first_response_s'] for r in runs) * 1000, 1),
+        'status': runs[-1]['status'],
+        'heavy_modules_loaded': runs[-1]['loaded'],
+        'slowest_imports': slowest_imports(args.top),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Transfer benchmarks against the local fake Drive/YouTube server (no Google APIs involved).
+
+For every file size x SPOOLED_MAX_MEM (per-spool memory cap) setting this measures:
+- download: drive_utils.download_drive_file_to_spooled
+- upload:   youtube_utils.upload_video_from_fileobj (from an already downloaded spool)
+- job:      the scheduler's full pick -> tags -> transfer path (AutoUploader body)
+
+Each case runs in a fresh subprocess so peak RSS is per case. One JSON object per case is
+written to stdout (or --output), with MB/s, peak RSS and API call counts:
+
+    python benchmarks/bench_transfer.py --sizes 8,64,256 --spool 1,20 --latency-ms 20 --bandwidth-mbps 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from conftest import isolate_state, fake_services, FixedPool  # noqa: E402
+
+MB = 1024 * 1024
+CASES = ('download', 'upload', 'job')
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# -- child: runs one case -----------------------------------------------------
+
+def run_child(args):
+    import shutil
+    import tempfile
+    import drive_utils
+    import buffer_utils
+    import stream_utils
+    from youtube_utils import upload_video_from_fileobj, UploadStats
+
+    tmp = tempfile.mkdtemp(prefix='bench-')
+    isolate_state(tmp)
+    buffer_utils.SPOOLED_MAX_MEM = args.spool * MB
+    stream_utils.TRANSFER_MODE = args.mode
+    drive, youtube = fake_services(args.endpoint)
+    size = args.size * MB
+    result = {'case': args.case, 'size_mb': args.size, 'spool_mb': args.spool, 'mode': args.mode}
+    stats = UploadStats()
+    error = None
+    started = time.perf_counter()
+    try:
+        if args.case == 'download':
+            sp = drive_utils.download_drive_file_to_spooled(drive, args.file_id)
+            sp.close()
+        elif args.case == 'upload':
+            sp = drive_utils.download_drive_file_to_spooled(drive, args.file_id)
+            started = time.perf_counter()
+            upload_video_from_fileobj(youtube, sp, 'bench', 'bench upload', stats=stats)
+        else:
+            import scheduler_utils
+            scheduler_utils.client_pool = FixedPool(drive, youtube)
+            uploader = scheduler_utils.AutoUploader(workers=1)
+            video_id = uploader._upload_random_with_quota(args.folder_id, 'US', None, None)
+            if video_id is None:
+                error = 'job returned no video id'
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    elapsed = time.perf_counter() - started
+    result.update(seconds=round(elapsed, 3), mb_per_s=round(size / MB / elapsed, 2) if elapsed else None,
+                  peak_rss_mb=_peak_rss_mb(), error=error)
+    if stats.chunk_sizes:
+        result['upload_chunks'] = len(stats.chunk_sizes)
+    shutil.rmtree(tmp, ignore_errors=True)
+    print(json.dumps(result))
+
+
+# -- parent: fake server + one subprocess per case ------------------------------
+
+def run_parent(args):
+    from fake_google import FakeGoogle
+    server = FakeGoogle(latency=args.latency_ms / 1000.0, bandwidth=int(args.bandwidth_mbps * MB), error_rate=args.error_rate)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    spools = [int(s) for s in args.spool.split(',')]
+    for size in sizes:
+        server.add_file(f'bench{size}', size * MB, parents=['bench-folder'])
+    server.start()
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for size in sizes:
+            for spool in spools:
+                for case in args.cases.split(','):
+                    if case == 'job':
+                        # the job picks from the folder; keep only the file of this size in it
+                        for f in server.files.values():
+                            f.parents = ['bench-folder'] if f.id == f'bench{size}' else ['elsewhere']
+                    server.reset_counters()
+                    cmd = [sys.executable, os.path.abspath(__file__), '--child', '--case', case, '--endpoint', server.url,
+                           '--file-id', f'bench{size}', '--folder-id', 'bench-folder',
+                           '--size', str(size), '--spool', str(spool), '--mode', args.mode]
+                    proc = subprocess.run(cmd, capture_output=True, text=True, cwd=ROOT)
+                    lines = [ln for ln in proc.stdout.splitlines() if ln.startswith('{')]
+                    result = json.loads(lines[-1]) if lines else {'case': case, 'size_mb': size, 'spool_mb': spool,
+                                                                   'error': proc.stderr.strip()[-500:]}
+                    result.update(api=server.stats(), latency_ms=args.latency_ms, bandwidth_mbps=args.bandwidth_mbps,
+                                  error_rate=args.error_rate)
+                    out.write(json.dumps(result) + '\n')
+                    out.flush()
+    finally:
+        server.stop()
+        if out is not sys.stdout:
+            out.close()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--sizes', default='8,64', help='comma separated file sizes in MB')
+    p.add_argument('--spool', default='1,20', help='comma separated SPOOLED_MAX_MEM settings in MB')
+    p.add_argument('--cases', default=','.join(CASES))
+    p.add_argument('--mode', default='spooled', help='TRANSFER_MODE for the job case')
+    p.add_argument('--latency-ms', type=float, default=0.0)
+    p.add_argument('--bandwidth-mbps', type=float, default=0.0, help='MB/s per connection, 0 = unlimited')
+    p.add_argument('--error-rate', type=float, default=0.0, help='fraction of media requests answered with 503')
+    p.add_argument('--output', help='write JSON lines here instead of stdout')
+    # child-only
+    p.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    p.add_argument('--case', help=argparse.SUPPRESS)
+    p.add_argument('--endpoint', help=argparse.SUPPRESS)
+    p.add_argument('--file-id', help=argparse.SUPPRESS)
+    p.add_argument('--folder-id', help=argparse.SUPPRESS)
+    p.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        args.spool = int(args.spool)
+        run_child(args)
+    else:
+        run_parent(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Local stand-in for the Drive and YouTube endpoints the app uses, for benchmarks.
+
+Implements just enough of the wire protocol for googleapiclient:
+- Drive v3: files.get (metadata and alt=media with Range), files.list, changes.getStartPageToken, changes.list
+- YouTube v3: videos.list (mostPopular) and the resumable videos.insert upload protocol
+
+Latency (per request), bandwidth (per connection, both directions), a 5xx error rate and
+a rate of upload chunks only half committed (308 with a short Range) can be injected. Request counts per API method are kept in `calls`.
+
+    server = FakeGoogle(latency=0.02, bandwidth=50 * 1024 * 1024)
+    server.add_file('vid1', 64 * 1024 * 1024, name='clip.mp4')
+    server.start()
+    drive, youtube = fake_services(server.url)      # tests/conftest.py: clients whose URLs all point here
+"""
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+BLOCK_SIZE = 1024 * 1024
+IO_SLICE = 64 * 1024
+
+
+class FakeFile:
+    """Deterministic content: one pseudo-random 1 MiB block repeated up to size."""
+
+    def __init__(self, file_id, size, name, mime_type='video/mp4', parents=None):
+        self.id = file_id
+        self.size = size
+        self.name = name
+        self.mime_type = mime_type
+        self.parents = parents or ['bench-folder']
+        self.block = random.Random(file_id).randbytes(BLOCK_SIZE)
+        digest = hashlib.md5()
+        for offset in range(0, size, BLOCK_SIZE):
+            digest.update(self.block[:min(BLOCK_SIZE, size - offset)])
+        self.md5 = digest.hexdigest()
+
+    def read(self, start, end):
+        """Bytes start..end inclusive, yielded in IO_SLICE pieces."""
+        pos = start
+        while pos <= end:
+            off = pos % BLOCK_SIZE
+            n = min(IO_SLICE, BLOCK_SIZE - off, end - pos + 1)
+            yield self.block[off:off + n]
+            pos += n
+
+    def meta(self):
+        return {'id': self.id, 'name': self.name, 'mimeType': self.mime_type, 'size': str(self.size),
+                'md5Checksum': self.md5, 'modifiedTime': '2024-01-01T00:00:00.000Z', 'parents': self.parents}
+
+
+class UploadSession:
+    def __init__(self, body):
+        self.body = body
+        self.received = 0
+        self.digest = hashlib.md5()
+        self.video_id = uuid.uuid4().hex[:11]
+
+
+class _Server(ThreadingHTTPServer):
+    # the default listen backlog (5) drops connects when hundreds of transfers start at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeGoogle:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=0, error_rate=0.0, partial_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes/s per connection, 0 = unlimited
+        self.error_rate = error_rate
+        self.partial_rate = partial_rate
+        self.files = {}
+        self.sessions = {}
+        self.completed = {}
+        self.calls = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = _Server((host, port), _make_handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def drive_endpoint(self):
+        return self.url + '/drive/v3/'
+
+    @property
+    def youtube_endpoint(self):
+        return self.url + '/youtube/v3/'
+
+    def add_file(self, file_id, size, name=None, **kwargs):
+        self.files[file_id] = FakeFile(file_id, size, name or f'{file_id}.mp4', **kwargs)
+        return self.files[file_id]
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_in = self.bytes_out = 0
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-google', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, method, nin=0, nout=0):
+        with self._lock:
+            self.calls[method] += 1
+            self.bytes_in += nin
+            self.bytes_out += nout
+
+    def _should_fail(self):
+        return self._roll(self.error_rate)
+
+    def _roll(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):
+            pass
+
+        # -- helpers ----------------------------------------------------------
+
+        def _throttle(self, nbytes, started):
+            if server.bandwidth:
+                wait = nbytes / server.bandwidth - (time.monotonic() - started)
+                if wait > 0:
+                    time.sleep(wait)
+
+        def _send(self, status, body=b'', headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode()
+                headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status=503):
+            self._send(status, {'error': {'code': status, 'message': 'injected error'}})
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            chunks = []
+            started = time.monotonic()
+            got = 0
+            while got < length:
+                piece = self.rfile.read(min(IO_SLICE, length - got))
+                if not piece:
+                    break
+                chunks.append(piece)
+                got += len(piece)
+                self._throttle(got, started)
+            return b''.join(chunks)
+
+        def _begin(self):
+            if server.latency:
+                time.sleep(server.latency)
+            parts = urlsplit(self.path)
+            return parts.path, {k: v[0] for k, v in parse_qs(parts.query).items()}
+
+        # -- Drive ------------------------------------------------------------
+
+        def _drive_media(self, f):
+            rng = self.headers.get('range') or self.headers.get('Range')
+            start, end = 0, f.size - 1
+            status = 200
+            headers = {'Content-Type': f.mime_type}
+            if rng:
+                m = re.match(r'bytes=(\d+)-(\d*)', rng)
+                start = int(m.group(1))
+                end = min(int(m.group(2)) if m.group(2) else f.size - 1, f.size - 1)
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end}/{f.size}'
+            length = end - start + 1
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            started = time.monotonic()
+            sent = 0
+            for piece in f.read(start, end):
+                self.wfile.write(piece)
+                sent += len(piece)
+                self._throttle(sent, started)
+            server._count('drive.files.get_media', nout=length)
+
+        # -- verbs ------------------------------------------------------------
+
+        def do_GET(self):
+            path, query = self._begin()
+            if path == '/drive/v3/files':
+                server._count('drive.files.list')
+                m = re.search(r"'([^']+)' in parents", query.get('q', ''))
+                files = [f for f in server.files.values() if m is None or m.group(1) in f.parents]
+                return self._send(200, {'files': [f.meta() for f in files]})
+            if path == '/drive/v3/changes/startPageToken':
+                server._count('drive.changes.getStartPageToken')
+                return self._send(200, {'startPageToken': '1'})
+            if path == '/drive/v3/changes':
+                server._count('drive.changes.list')
+                return self._send(200, {'changes': [], 'newStartPageToken': '1'})
+            m = re.match(r'^/drive/v3/files/([^/]+)$', path)
+            if m:
+                f = server.files.get(m.group(1))
+                if f is None:
+                    return self._send(404, {'error': {'code': 404, 'message': 'File not found'}})
+                if query.get('alt') == 'media':
+                    if server._should_fail():
+                        return self._error()
+                    return self._drive_media(f)
+                server._count('drive.files.get')
+                return self._send(200, f.meta())
+            if path == '/youtube/v3/videos':
+                server._count('youtube.videos.list')
+                items = [{'id': 'trend%d' % i, 'snippet': {'title': f'Trending {i} #bench #fake{i % 3}',
+                                                           'description': '', 'tags': ['shorts', 'benchmark']}}
+                         for i in range(int(query.get('maxResults', 5)))]
+                return self._send(200, {'items': items})
+            self._send(404, {'error': {'code': 404, 'message': f'no fake for GET {path}'}})
+
+        def do_POST(self):
+            path, query = self._begin()
+            body = self._read_body()
+            if path == '/upload/youtube/v3/videos' and query.get('uploadType') == 'resumable':
+                server._count('youtube.videos.insert')
+                upload_id = uuid.uuid4().hex
+                server.sessions[upload_id] = UploadSession(json.loads(body or b'{}'))
+                location = f'{server.url}/upload/youtube/v3/videos?uploadType=resumable&upload_id={upload_id}'
+                return self._send(200, b'', {'Location': location})
+            if path.startswith('/youtube/v3/thumbnails/set') or path.startswith('/upload/youtube/v3/thumbnails/set'):
+                server._count('youtube.thumbnails.set', nin=len(body))
+                return self._send(200, {'items': []})
+            self._send(404, {'error': {'code': 404, 'message': f'no fake for POST {path}'}})
+
+        def do_PUT(self):
+            path, query = self._begin()
+            session = server.sessions.get(query.get('upload_id', ''))
+            if path != '/upload/youtube/v3/videos' or session is None:
+                self._read_body()
+                return self._send(404, {'error': {'code': 404, 'message': 'upload session not found'}})
+            fail = server._should_fail()
+            body = self._read_body()
+            server._count('youtube.upload.chunk', nin=len(body))
+            if fail:
+                return self._error()
+            m = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', self.headers.get('Content-Range', ''))
+            total = None
+            if m:
+                start = int(m.group(1))
+                total = None if m.group(3) == '*' else int(m.group(3))
+                if start == session.received:
+                    if len(body) > 1 and server._roll(server.partial_rate):
+                        body = body[:len(body) // 2]
+                    session.digest.update(body)
+                    session.received += len(body)
+            else:
+                q = re.match(r'bytes \*/(\d+|\*)', self.headers.get('Content-Range', ''))
+                if q and q.group(1) != '*':
+                    total = int(q.group(1))
+            if total is not None and session.received >= total:
+                server.completed[session.video_id] = session.digest.hexdigest()
+                return self._send(200, {'id': session.video_id, 'kind': 'youtube#video', 'snippet': session.body.get('snippet', {})})
+            headers = {'Range': f'bytes=0-{session.received - 1}'} if session.received else {}
+            self._send(308, b'', headers)
+
+    return Handler
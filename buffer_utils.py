@@ -0,0 +1,202 @@
+import io
+import os
+import logging
+import tempfile
+import threading
+from config import MEMORY_BUDGET, SPOOL_BLOCK_SIZE, SPOOL_SCRATCH_DIR, SPOOLED_MAX_MEM
+from metrics_utils import BUFFER_BYTES, SPOOL_SPILLS
+
+logger = logging.getLogger('buffer_utils')
+
+
+class BufferManager:
+    """Process-wide budget for in-memory transfer buffers.
+
+    acquire() hands out bytearrays only while the bytes leased plus the bytes kept for reuse
+    stay within budget, so buffer memory is bounded however many jobs run. Released buffers
+    are pooled and handed out again to the next request of the same size.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET, scratch_dir=SPOOL_SCRATCH_DIR, block_size=SPOOL_BLOCK_SIZE):
+        self.budget = budget
+        self.scratch_dir = scratch_dir
+        self.block_size = block_size
+        self._free = {}      # size -> idle bytearrays
+        self._in_use = 0
+        self._pooled = 0
+        self._spills = 0
+        self._lock = threading.Lock()
+        if scratch_dir:
+            os.makedirs(scratch_dir, exist_ok=True)
+
+    def _update_gauges_locked(self):
+        BUFFER_BYTES.set(self._in_use, state='in_use')
+        BUFFER_BYTES.set(self._pooled, state='pooled')
+
+    def acquire(self, size):
+        """Lease a bytearray of size bytes, or None if the budget is used up."""
+        with self._lock:
+            if self._in_use + size > self.budget:
+                return None
+            free = self._free.get(size)
+            if free:
+                buf = free.pop()
+                self._pooled -= size
+            else:
+                # make room by dropping idle buffers of other sizes
+                for other in sorted(self._free, reverse=True):
+                    while self._free[other] and self._in_use + self._pooled + size > self.budget:
+                        self._free[other].pop()
+                        self._pooled -= other
+                buf = bytearray(size)
+            self._in_use += size
+            self._update_gauges_locked()
+            return buf
+
+    def release(self, buf):
+        with self._lock:
+            size = len(buf)
+            self._in_use -= size
+            if self._in_use + self._pooled + size <= self.budget:
+                self._free.setdefault(size, []).append(buf)
+                self._pooled += size
+            self._update_gauges_locked()
+
+    def scratch_file(self):
+        """Unnamed temporary file in the scratch directory (the system temp dir if unset)."""
+        return tempfile.TemporaryFile(dir=self.scratch_dir)
+
+    def spool(self, max_mem=None):
+        return BudgetedSpool(self, SPOOLED_MAX_MEM if max_mem is None else max_mem)
+
+    def _spilled(self):
+        with self._lock:
+            self._spills += 1
+        SPOOL_SPILLS.inc()
+
+    def stats(self):
+        with self._lock:
+            return {'budget': self.budget, 'in_use': self._in_use, 'pooled': self._pooled,
+                    'free': self.budget - self._in_use, 'spills': self._spills, 'scratch_dir': self.scratch_dir or tempfile.gettempdir()}
+
+
+class BudgetedSpool(io.RawIOBase):
+    """Seekable read/write temp file kept in budget blocks until it outgrows max_mem or the budget runs out.
+
+    Then its contents move to a scratch file and every later operation goes to disk, like
+    tempfile.SpooledTemporaryFile. Blocks go back to the manager on close().
+    """
+
+    def __init__(self, manager, max_mem):
+        super().__init__()
+        self._manager = manager
+        self._max_mem = max_mem
+        self._bs = manager.block_size
+        self._blocks = []
+        self._size = 0
+        self._pos = 0
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _spill(self, reason):
+        f = self._manager.scratch_file()
+        for i, block in enumerate(self._blocks):
+            f.write(memoryview(block)[:min(self._bs, self._size - i * self._bs)])
+        f.seek(self._pos)
+        self._release_blocks()
+        self._file = f
+        self._manager._spilled()
+        logger.info('Spool spilled to disk after %d bytes (%s)', self._size, reason)
+
+    def _release_blocks(self):
+        for block in self._blocks:
+            self._manager.release(block)
+        self._blocks = []
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed spool')
+        if self._file is not None:
+            return self._file.write(data)
+        mv = memoryview(data).cast('B')
+        n = len(mv)
+        if self._pos > self._size:
+            # pooled blocks hold stale bytes: zero the gap left by a seek past the end
+            gap_end, self._pos = self._pos, self._size
+            self.write(bytes(gap_end - self._size))
+            if self._file is not None:
+                return self._file.write(mv)
+        end = self._pos + n
+        if end > self._max_mem:
+            self._spill('over max_mem')
+            return self._file.write(mv)
+        while len(self._blocks) * self._bs < end:
+            block = self._manager.acquire(self._bs)
+            if block is None:
+                self._spill('memory budget exhausted')
+                return self._file.write(mv)
+            self._blocks.append(block)
+        while mv:
+            i, off = divmod(self._pos, self._bs)
+            k = min(len(mv), self._bs - off)
+            self._blocks[i][off:off + k] = mv[:k]
+            self._pos += k
+            mv = mv[k:]
+        self._size = max(self._size, self._pos)
+        return n
+
+    def read(self, size=-1):
+        if self._file is not None:
+            return self._file.read(size)
+        stop = self._size if size is None or size < 0 else min(self._size, self._pos + size)
+        out = bytearray()
+        while self._pos < stop:
+            i, off = divmod(self._pos, self._bs)
+            k = min(stop - self._pos, self._bs - off)
+            out += self._blocks[i][off:off + k]
+            self._pos += k
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self._file is not None:
+            return self._file.seek(offset, whence)
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        if base + offset < 0:
+            raise ValueError('negative seek position')
+        self._pos = base + offset
+        return self._pos
+
+    def tell(self):
+        return self._file.tell() if self._file is not None else self._pos
+
+    def close(self):
+        if self.closed:
+            return
+        if self._file is not None:
+            self._file.close()
+        self._release_blocks()
+        super().close()
+
+    def __del__(self):
+        # unclosed spools dropped by their owner still hand their blocks back
+        self.close()
+
+
+buffer_manager = BufferManager()
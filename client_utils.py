@@ -0,0 +1,65 @@
+import logging
+import threading
+import contextlib
+from collections import deque
+from auth_utils import load_credentials
+from config import CLIENT_POOL_SIZE
+from drive_utils import build_drive_service
+from youtube_utils import build_youtube_service
+
+logger = logging.getLogger('client_utils')
+
+
+class ClientPool:
+    """Pool of authorized (drive, youtube) service pairs.
+
+    googleapiclient services wrap a non thread-safe httplib2 transport, so each pair is
+    leased to one thread at a time and returned afterwards instead of being rebuilt
+    (discovery parse + new transport) for every request or job. Pairs are bound to the
+    credentials object they were built with and dropped when credentials change.
+    """
+
+    def __init__(self, max_idle=CLIENT_POOL_SIZE):
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._built = 0
+
+    @contextlib.contextmanager
+    def lease(self, creds=None):
+        """Yield (drive_service, youtube_service), or (None, None) without credentials."""
+        creds = creds or load_credentials()
+        if creds is None:
+            yield None, None
+            return
+        pair = None
+        with self._lock:
+            while self._idle:
+                cand = self._idle.pop()
+                if cand[0] is creds:
+                    pair = cand
+                    break
+        if pair is None:
+            pair = (creds, build_drive_service(creds), build_youtube_service(creds))
+            with self._lock:
+                self._built += 1
+        healthy = False
+        try:
+            yield pair[1], pair[2]
+            healthy = True
+        finally:
+            # a pair whose transfer blew up may hold a half-used connection; let it go
+            with self._lock:
+                if healthy and len(self._idle) < self.max_idle:
+                    self._idle.append(pair)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'idle': len(self._idle), 'built': self._built}
+
+
+client_pool = ClientPool()
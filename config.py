@@ -23,3 +23,151 @@ MAX_HASHTAGS = 10
 
 # Spooled temp max in-memory size (bytes) before spilling to disk
 SPOOLED_MAX_MEM = 20 * 1024 * 1024  # 20 MB (adjust for larger files)
+
+# Transfer mode for Drive -> YouTube jobs:
+#   'stream'  - pipe Drive download chunks straight into the resumable upload
+#   'spooled' - download the whole file first, then upload
+#   'parallel' - download with concurrent ranged requests into a temp file, then upload
+TRANSFER_MODE = 'stream'
+
+# Streaming transfer: fixed in-memory ring buffer shared by download and upload
+STREAM_BUFFER_SIZE = 32 * 1024 * 1024   # 32 MB memory ceiling per streamed transfer
+STREAM_DOWNLOAD_CHUNK = 4 * 1024 * 1024  # Drive MediaIoBaseDownload chunk size
+STREAM_UPLOAD_CHUNK = 8 * 1024 * 1024    # must be a multiple of 256 KiB and <= STREAM_BUFFER_SIZE
+
+# Parallel ranged Drive downloads (TRANSFER_MODE = 'parallel')
+DOWNLOAD_CONCURRENCY = 4                 # concurrent range requests per file
+DOWNLOAD_RANGE_SIZE = 16 * 1024 * 1024   # bytes per range request
+DOWNLOAD_RANGE_RETRIES = 3               # retries per range before the download fails
+
+# Resumable YouTube upload chunking: 'adaptive' tunes chunk size from measured throughput, 'fixed' keeps it constant
+UPLOAD_CHUNK_MODE = 'adaptive'
+UPLOAD_CHUNK_MIN = 256 * 1024            # starting / smallest chunk (API requires multiples of 256 KiB)
+UPLOAD_CHUNK_MAX = 64 * 1024 * 1024      # largest chunk the adaptive mode will use
+UPLOAD_CHUNK_TARGET_SECONDS = 4          # aim for chunks that take about this long to send
+
+# Persisted resumable upload sessions, resumed on startup after a crash
+UPLOAD_STATE_FILE = os.path.join(BASE_DIR, 'upload_state.json')
+
+# Local SQLite index of Drive folder contents, kept current through the Drive Changes feed
+DRIVE_INDEX_ENABLED = True
+DRIVE_INDEX_DB = os.path.join(BASE_DIR, 'drive_index.sqlite3')
+
+# Trending hashtag cache (per region)
+TREND_CACHE_TTL = 60 * 60                 # seconds an entry is considered fresh
+TREND_CACHE_REFRESH_AHEAD = 5 * 60        # start a background refresh this long before expiry
+TREND_CACHE_MAX_STALE = 24 * 60 * 60      # serve expired tags (while refreshing) up to this age
+TREND_CACHE_MAX_REGIONS = 32              # LRU bound on cached regions
+TREND_CACHE_SNAPSHOT = os.path.join(BASE_DIR, 'trending_cache.json')  # None disables the on-disk snapshot
+
+# Trending tag scores: mostPopular charts (TREND_VIDEO_LIMIT videos per region x category, 50 per page,
+# 1 quota unit each) are fetched concurrently and folded into a per-region score table that decays
+# with TREND_HALF_LIFE, so tags keep weight across refreshes. None means the overall chart.
+TREND_CATEGORIES = (None,)                # e.g. (None, '10', '24') adds Music and Entertainment
+TREND_FETCH_CONCURRENCY = 4
+TREND_HALF_LIFE = 6 * 60 * 60
+TREND_MAX_TAGS = 5000                     # per region; the lowest scores are pruned beyond this
+TREND_SCORES_SNAPSHOT = os.path.join(BASE_DIR, 'trend_scores.json')  # None disables persistence
+
+# Parsed Google API discovery documents, cached between runs (None keeps them in memory only)
+DISCOVERY_CACHE_DIR = os.path.join(BASE_DIR, 'discovery_cache')
+
+# Idle authorized (drive, youtube) client pairs kept for reuse across requests and jobs
+CLIENT_POOL_SIZE = 8
+
+# Multi-target scheduler
+SCHED_WORKERS = 4               # upload worker threads shared by all targets
+SCHED_TARGET_CONCURRENCY = 1    # default max concurrent runs of a single target
+SCHED_MAX_PENDING = 2           # runs allowed to wait for a worker per target; further ticks are skipped
+
+# Multi-process deployments (e.g. gunicorn -w N): targets and job status live in SCHED_DB so any worker can
+# change and read them, and only the worker holding the scheduler lease runs scheduled uploads.
+SCHED_COORDINATION = True
+SCHED_DB = os.path.join(BASE_DIR, 'scheduler.sqlite3')
+SCHED_LEASE_TTL = 30            # seconds without renewal before another process takes over
+SCHED_SYNC_INTERVAL = 5         # lease renewal / target sync period; keep well below SCHED_LEASE_TTL
+JOB_PUBLISH_INTERVAL = 1.0      # min seconds between shared snapshots of a running job's progress
+
+# Background jobs for /manual, /folder and /scheduler/run_now
+JOB_WORKERS = 4        # concurrent transfers; further submissions queue
+JOB_HISTORY = 200      # finished jobs kept for /jobs/<id> status
+
+# No-repeat picking: shuffle-bag draws per folder plus a persistent ledger of uploaded files
+PICK_NO_REPEAT = True
+UPLOAD_LEDGER_DB = os.path.join(BASE_DIR, 'upload_ledger.sqlite3')
+
+# YouTube Data API quota budget (units per Pacific day) and where today's usage is persisted
+QUOTA_DAILY_LIMIT = 10000
+QUOTA_STATE_FILE = os.path.join(BASE_DIR, 'quota_state.json')
+
+# Metrics (/metrics, Prometheus text format) and per-job trace spans (shown in /jobs/<id>)
+METRICS_TRACE = True
+METRICS_TRACE_MAX_SPANS = 200            # spans kept per job trace
+
+# Shorts eligibility probe: read the container header (MP4 moov / WebM-MKV EBML) with ranged Drive reads
+PROBE_ENABLED = True
+PROBE_READ_SIZE = 64 * 1024              # first read; holds the whole header of faststart MP4s and most WebMs
+PROBE_MAX_HEADER = 4 * 1024 * 1024       # cap on moov / EBML header bytes read for one probe
+SHORTS_MAX_DURATION = 180                # seconds; longer videos are not treated as Shorts
+SHORTS_REQUIRE_VERTICAL = True           # skip landscape videos (square and portrait pass)
+SHORTS_ALLOW_UNPROBED = True             # pick files whose header could not be parsed (e.g. AVI/FLV)
+PICK_MAX_CANDIDATES = 25                 # files tried per pick before giving up when filtering (random pick mode)
+
+# Prefetch staging cache: scheduled targets download their next pick ahead of the trigger, while no upload runs
+PREFETCH_ENABLED = True
+PREFETCH_DEPTH = 1                       # staged videos kept ready per scheduled folder
+PREFETCH_IDLE_WAIT = 600                 # seconds a prefetch waits for the upload workers to go idle before giving up
+STAGING_DIR = os.path.join(BASE_DIR, 'staging')
+STAGING_MAX_BYTES = 2 * 1024 * 1024 * 1024  # LRU-evicted above this many bytes on disk
+STAGING_DOWNLOAD_CHUNK = 16 * 1024 * 1024
+
+# Shared transfer layer: per-chunk retries with exponential backoff + full jitter, and a stall watchdog
+TRANSFER_RETRIES = 5                     # retries per chunk before the transfer fails
+TRANSFER_BACKOFF_BASE = 1                # seconds; attempt n waits up to base * 2**n
+TRANSFER_BACKOFF_MAX = 60                # cap on a single backoff wait
+TRANSFER_MIN_THROUGHPUT = 64 * 1024      # bytes/s; a chunk slower than this (after the grace period) counts as stalled
+TRANSFER_STALL_GRACE = 30                # seconds every chunk gets on top of its size-based deadline
+
+# Drive folder traversal: include videos in nested subfolders, listing up to this many folders at once
+DRIVE_RECURSIVE = True
+DRIVE_LIST_CONCURRENCY = 4
+
+# Process-wide memory budget for transfer buffers (spooled downloads, thumbnails, stream ring buffers).
+# Spools that cannot get memory spill to SPOOL_SCRATCH_DIR (None = system temp dir; a tmpfs such as
+# /dev/shm is faster but its spills still live in RAM), and a stream that cannot get its ring runs spooled.
+MEMORY_BUDGET = 96 * 1024 * 1024
+SPOOL_BLOCK_SIZE = 1024 * 1024
+SPOOL_SCRATCH_DIR = None
+SPOOL_DOWNLOAD_CHUNK = 8 * 1024 * 1024   # bytes per Drive request when spooling; each response is held in memory whole
+
+# Post-upload processing status: pending video ids are checked in batches of up to 50 per videos.list call.
+# Each video's next check backs off from STATUS_POLL_INITIAL, doubling up to STATUS_POLL_MAX_DELAY (or sooner if
+# YouTube reports less processing time left); videos still unsettled after STATUS_POLL_MAX_AGE are marked 'timeout'.
+STATUS_POLL_ENABLED = True
+STATUS_POLL_INTERVAL = 60          # seconds between poller runs
+STATUS_POLL_INITIAL = 60
+STATUS_POLL_MAX_DELAY = 3600
+STATUS_POLL_MAX_AGE = 48 * 3600
+STATUS_POLL_MAX_CALLS = 10         # videos.list calls per run (x 50 ids)
+
+# Thumbnails are decoded, fitted into THUMB_SIZE and re-encoded as JPEG under THUMB_MAX_BYTES (YouTube's 2 MB limit)
+# on a pool of THUMB_WORKERS processes. That needs Pillow; without it only JPEG/PNG files already under the limit pass.
+# Results are cached by source md5 in THUMB_CACHE_DIR. With THUMB_AUTO_PICK scheduled folder uploads use an image
+# named like the video from the same Drive folder (clip.mp4 -> clip.jpg / clip.png).
+THUMB_SIZE = (1280, 720)
+THUMB_MAX_BYTES = 2 * 1024 * 1024
+THUMB_MAX_SOURCE_BYTES = 50 * 1024 * 1024   # larger source images are rejected before download
+THUMB_WORKERS = 2
+THUMB_RENDER_TIMEOUT = 120                  # seconds an upload waits for its thumbnail render
+THUMB_CACHE_DIR = os.path.join(BASE_DIR, 'thumb_cache')
+THUMB_CACHE_MAX_FILES = 500
+THUMB_AUTO_PICK = True
+
+# asyncio transfer engine (async_transfer_utils, needs aiohttp): hundreds of Drive -> YouTube transfers on one event
+# loop over pooled connections instead of one OS thread each. Each transfer holds at most two chunks in memory
+# (one uploading, the next downloading); a connection with no bytes for TRANSFER_STALL_GRACE seconds is retried.
+ASYNC_CONNECTION_LIMIT = 512         # pooled connections in total
+ASYNC_CONNECTIONS_PER_HOST = 64      # pooled connections per host
+ASYNC_CHUNK_SIZE = 8 * 1024 * 1024   # Drive range / upload chunk; a multiple of 256 KiB
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3/'
+YOUTUBE_UPLOAD_URL = 'https://www.googleapis.com/upload/youtube/v3/videos'
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import socket
+import sqlite3
+import logging
+import threading
+import contextlib
+from config import SCHED_DB, SCHED_LEASE_TTL, SCHED_SYNC_INTERVAL
+
+logger = logging.getLogger('coordination_utils')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS targets (
+    id TEXT PRIMARY KEY,
+    folder_id TEXT NOT NULL,
+    region TEXT,
+    interval REAL NOT NULL,
+    concurrency INTEGER NOT NULL,
+    next_run REAL,
+    runs INTEGER NOT NULL DEFAULT 0,
+    last_result TEXT,
+    last_finished TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_updated ON jobs (updated);
+'''
+
+TARGET_COLUMNS = ('id', 'folder_id', 'region', 'interval', 'concurrency', 'next_run', 'runs', 'last_result', 'last_finished')
+
+_process_id = None
+
+
+def process_id():
+    """host:pid:nonce naming this process in state files shared with other workers (a pid alone is reused after a restart)."""
+    global _process_id
+    # regenerated after a fork, so preloaded worker processes do not share the parent's id
+    if _process_id is None or _process_id.split(':')[-2] != str(os.getpid()):
+        _process_id = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+    return _process_id
+
+
+def process_alive(owner):
+    """Whether the process that wrote owner (a process_id()) may still be running; owners on other hosts count as alive."""
+    if not owner:
+        return False
+    host, pid, _ = owner.rsplit(':', 2)
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return owner == process_id()
+    return pid_alive(int(pid))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass    # exists, owned by another user
+    return True
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock on path + '.lock' between processes (and between threads, as each call opens its own handle)."""
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_json(path, data, fsync=False):
+    """Replace path with data atomically; the temp name is per process so concurrent writers do not collide."""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class SharedStore:
+    """SQLite state shared by every worker process of one deployment.
+
+    Holds the scheduler leader lease, the upload targets (with their next tick, so a new
+    leader continues the schedule) and snapshots of background jobs for status polling.
+    A version counter in meta changes with every target change so the leader can sync cheaply.
+    """
+
+    def __init__(self, path=SCHED_DB):
+        self.path = path
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # -- leader lease ---------------------------------------------------------
+
+    def try_lease(self, name, holder, ttl):
+        """Take or renew lease name for holder; returns the expiry time, or None if another holder has it."""
+        now = time.time()
+        with self._connect() as db:
+            # take the write lock before reading so two processes cannot both see the lease as free
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT holder, expires FROM leases WHERE name=?', (name,)).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                return None
+            db.execute('INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)', (name, holder, now + ttl))
+            return now + ttl
+
+    def release_lease(self, name, holder):
+        with self._connect() as db:
+            db.execute('DELETE FROM leases WHERE name=? AND holder=?', (name, holder))
+
+    def lease_holder(self, name):
+        with self._connect() as db:
+            row = db.execute('SELECT holder, expires FROM leases WHERE name=?', (name,)).fetchone()
+        return row[0] if row and row[1] > time.time() else None
+
+    # -- targets --------------------------------------------------------------
+
+    def _bump_locked(self, db):
+        db.execute("INSERT INTO meta (key, value) VALUES ('targets_version', '1') "
+                   "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER) + 1")
+
+    def targets_version(self):
+        with self._connect() as db:
+            row = db.execute("SELECT value FROM meta WHERE key='targets_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def save_target(self, target_id, folder_id, region, interval, concurrency, next_run):
+        with self._connect() as db:
+            db.execute('INSERT INTO targets (id, folder_id, region, interval, concurrency, next_run, created) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT(id) DO UPDATE SET folder_id=excluded.folder_id, region=excluded.region, '
+                       'interval=excluded.interval, concurrency=excluded.concurrency, next_run=excluded.next_run',
+                       (target_id, folder_id, region, interval, concurrency, next_run, time.time()))
+            self._bump_locked(db)
+
+    def delete_target(self, target_id=None):
+        """Delete one target (every target if target_id is None); returns whether anything was deleted."""
+        with self._connect() as db:
+            if target_id is None:
+                cur = db.execute('DELETE FROM targets')
+            else:
+                cur = db.execute('DELETE FROM targets WHERE id=?', (target_id,))
+            if cur.rowcount:
+                self._bump_locked(db)
+            return bool(cur.rowcount)
+
+    def load_targets(self):
+        with self._connect() as db:
+            rows = db.execute('SELECT %s FROM targets ORDER BY created' % ', '.join(TARGET_COLUMNS)).fetchall()
+        return [dict(zip(TARGET_COLUMNS, r)) for r in rows]
+
+    def record_tick(self, target_id, next_run):
+        with self._connect() as db:
+            db.execute('UPDATE targets SET next_run=? WHERE id=?', (next_run, target_id))
+
+    def record_run(self, target_id, result, finished):
+        with self._connect() as db:
+            db.execute('UPDATE targets SET runs=runs+1, last_result=?, last_finished=? WHERE id=?', (result, finished, target_id))
+
+    # -- job snapshots --------------------------------------------------------
+
+    def save_job(self, data):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO jobs (id, data, updated) VALUES (?, ?, ?)', (data['id'], json.dumps(data), time.time()))
+
+    def get_job(self, job_id):
+        with self._connect() as db:
+            row = db.execute('SELECT data FROM jobs WHERE id=?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_jobs(self, limit):
+        with self._connect() as db:
+            rows = db.execute('SELECT data FROM jobs ORDER BY updated DESC LIMIT ?', (limit,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def trim_jobs(self, keep):
+        with self._connect() as db:
+            db.execute('DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY updated DESC LIMIT ?)', (keep,))
+
+
+class LeaderElector:
+    """Keeps trying to hold a lease in the shared store and reports leadership changes.
+
+    Every interval the lease is taken or renewed. on_elected() runs when this process
+    becomes leader, on_demoted() when it loses the lease (e.g. it stalled past the ttl and
+    another process took over) and on_tick() on every interval while leading.
+    """
+
+    def __init__(self, store, name, on_elected, on_demoted, on_tick=None, ttl=SCHED_LEASE_TTL, interval=SCHED_SYNC_INTERVAL):
+        self.store = store
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_tick = on_tick
+        self.ttl = ttl
+        self.interval = interval
+        self.holder = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.is_leader = False
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def holds(self):
+        """True while this process leads and its lease has not run out (safe to start work)."""
+        return self.is_leader and time.time() < self._valid_until
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='leader-elector', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.is_leader:
+            self.is_leader = False
+            self.on_demoted()
+            self.store.release_lease(self.name, self.holder)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.interval)
+
+    def tick(self):
+        try:
+            expires = self.store.try_lease(self.name, self.holder, self.ttl)
+        except sqlite3.Error:
+            logger.exception('Could not reach the shared store for lease %s', self.name)
+            expires = None
+        if expires is not None:
+            self._valid_until = expires
+        try:
+            if expires is not None and not self.is_leader:
+                logger.info('Process %s is now the %s leader', self.holder, self.name)
+                self.is_leader = True
+                self.on_elected()
+            elif expires is None and self.is_leader:
+                logger.warning('Process %s lost the %s lease; stepping down', self.holder, self.name)
+                self.is_leader = False
+                self.on_demoted()
+            elif self.is_leader and self.on_tick is not None:
+                self.on_tick()
+        except Exception:
+            logger.exception('Leadership callback for %s failed', self.name)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_shared_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SharedStore()
+        return _store
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import marshal
+import logging
+import threading
+from config import DISCOVERY_CACHE_DIR
+
+logger = logging.getLogger('discovery_utils')
+
+_documents = {}   # (api, version) -> marshalled discovery document, or None if not bundled
+_lock = threading.Lock()
+
+
+def _cache_path(api, version):
+    from googleapiclient.version import __version__
+    # marshal output is specific to the Python version; the document to the client library version
+    tag = '%s-py%d%d' % (__version__, sys.version_info[0], sys.version_info[1])
+    return os.path.join(DISCOVERY_CACHE_DIR, f'{api}.{version}.{tag}.marshal')
+
+
+def _load_document(api, version):
+    try:
+        path = _cache_path(api, version) if DISCOVERY_CACHE_DIR else None
+    except Exception:
+        logger.warning('Cannot name the discovery cache for %s %s; building from discovery instead', api, version, exc_info=True)
+        return None
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            marshal.loads(data)
+            return data
+        except Exception:
+            logger.warning('Ignoring unreadable discovery cache %s', path)
+    from googleapiclient.discovery_cache import get_static_doc
+    doc = get_static_doc(api, version)
+    if doc is None:
+        return None
+    data = marshal.dumps(json.loads(doc))
+    if path:
+        try:
+            os.makedirs(DISCOVERY_CACHE_DIR, exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning('Could not write discovery cache %s', path, exc_info=True)
+    return data
+
+
+def build_service(api, version, creds):
+    """Build a googleapiclient service from the bundled discovery document, parsed once per process.
+
+    The parsed document is kept marshalled in memory and in DISCOVERY_CACHE_DIR; every build
+    unmarshals a private copy (build_from_document fixes up the document in place).
+    """
+    with _lock:
+        if (api, version) not in _documents:
+            _documents[api, version] = _load_document(api, version)
+        data = _documents[api, version]
+    if data is None:
+        from googleapiclient.discovery import build
+        return build(api, version, credentials=creds, cache_discovery=False)
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(marshal.loads(data), credentials=creds)
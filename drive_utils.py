@@ -1,58 +1,378 @@
 import io
+import os
+import time
 import random
+import hashlib
 import logging
-import tempfile
-from googleapiclient.discovery import build
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httplib2
+import google_auth_httplib2
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
-from config import SPOOLED_MAX_MEM
+from metrics_utils import span, api_call, TRANSFER_BYTES, record_transfer
+from transfer_utils import RetryPolicy, run_chunk
+from buffer_utils import buffer_manager
+from discovery_utils import build_service
+from config import (DOWNLOAD_CONCURRENCY, DOWNLOAD_RANGE_SIZE, DOWNLOAD_RANGE_RETRIES, DRIVE_INDEX_ENABLED, PICK_NO_REPEAT,
+                    PROBE_ENABLED, PICK_MAX_CANDIDATES, STAGING_DOWNLOAD_CHUNK, DRIVE_LIST_CONCURRENCY, DRIVE_RECURSIVE, SPOOL_DOWNLOAD_CHUNK)
 
 logger = logging.getLogger('drive_utils')
 
 
 def build_drive_service(creds):
-    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+    return build_service('drive', 'v3', creds)
 
 
-def list_videos_in_folder(drive_service, folder_id, page_size=100):
-    """Return list of file dicts for files in folder_id (best-effort video filtering)."""
-    q = f"'{folder_id}' in parents and trashed=false"
-    fields = 'nextPageToken, files(id, name, mimeType)'
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.webm', '.mkv', '.avi', '.flv', '.mpeg')
+FILE_FIELDS = 'id, name, mimeType, md5Checksum, size, modifiedTime'
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+# pushed to files.list: videos, plus untyped uploads that may still be videos by extension (checked client-side)
+VIDEO_QUERY = "(mimeType contains 'video/' or mimeType = 'application/octet-stream')"
+IMAGE_QUERY = "mimeType contains 'image/'"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')   # preference order for a video's sibling image
+
+
+def is_video_file(f):
+    """Best-effort video check: mimeType startswith video OR filename extension."""
+    m = f.get('mimeType', '')
+    name = f.get('name', '').lower()
+    return m.startswith('video') or name.endswith(VIDEO_EXTENSIONS)
+
+
+def _list_page(drive_service, folder_id, page_token, page_size, folders=False):
+    """One files.list page of the videos (and, with folders=True, subfolders) directly in folder_id."""
+    kinds = f"({VIDEO_QUERY[1:-1]} or mimeType = '{FOLDER_MIME}')" if folders else VIDEO_QUERY
+    q = f"'{folder_id}' in parents and trashed=false and {kinds}"
+    with api_call('drive.files.list'):
+        res = drive_service.files().list(q=q, spaces='drive', fields=f'nextPageToken, files({FILE_FIELDS})',
+                                         pageToken=page_token, pageSize=page_size).execute()
+    return res.get('files', []), res.get('nextPageToken')
+
+
+def list_videos_in_folder(drive_service, folder_id, page_size=1000, recursive=False):
+    """Return list of file dicts for videos in folder_id (and its subfolders when recursive)."""
+    if recursive:
+        return [f for _, f in walk_folder_tree(drive_service, folder_id, page_size=page_size) if f.get('mimeType') != FOLDER_MIME]
     files = []
     page_token = None
     while True:
-        res = drive_service.files().list(q=q, spaces='drive', fields=fields, pageToken=page_token, pageSize=page_size).execute()
-        files.extend(res.get('files', []))
-        page_token = res.get('nextPageToken')
+        page, page_token = _list_page(drive_service, folder_id, page_token, page_size)
+        files.extend(page)
         if not page_token:
             break
-    # Filter likely videos (mimeType startswith video OR filename extension)
-    video_files = []
-    for f in files:
-        m = f.get('mimeType', '')
-        name = f.get('name', '').lower()
-        if m.startswith('video') or name.endswith(('.mp4', '.mov', '.webm', '.mkv', '.avi', '.flv', '.mpeg')):
-            video_files.append(f)
-    return video_files
+    return [f for f in files if is_video_file(f)]
 
 
-def pick_random_video_from_folder(drive_service, folder_id):
-    vids = list_videos_in_folder(drive_service, folder_id)
-    if not vids:
+def _service_credentials(service):
+    """Credentials a googleapiclient service was built with (None for an unauthorized transport)."""
+    http = getattr(service, '_http', None)
+    return http.credentials if isinstance(http, google_auth_httplib2.AuthorizedHttp) else None
+
+
+def walk_folder_tree(drive_service, root_id, concurrency=DRIVE_LIST_CONCURRENCY, page_size=1000, creds=None):
+    """Yield (parent_id, item) for every video and subfolder below root_id as listing pages arrive.
+
+    With concurrency > 1 up to that many files.list calls run at once, each on its own pooled
+    client for creds (default: the credentials drive_service was built with); without
+    credentials the walk is sequential on drive_service. Closing the generator early cancels
+    the listings not yet started. Folders reachable twice are walked once.
+    """
+    seen = {root_id}
+
+    def accept(parent_id, files):
+        for f in files:
+            if f.get('mimeType') == FOLDER_MIME:
+                if f['id'] not in seen:
+                    seen.add(f['id'])
+                    yield parent_id, f
+            elif is_video_file(f):
+                yield parent_id, f
+
+    if concurrency > 1 and creds is None:
+        creds = _service_credentials(drive_service)
+    if concurrency <= 1 or creds is None:
+        queue = deque([(root_id, None)])
+        while queue:
+            folder_id, token = queue.popleft()
+            files, token = _list_page(drive_service, folder_id, token, page_size, folders=True)
+            if token:
+                queue.append((folder_id, token))
+            for parent_id, f in accept(folder_id, files):
+                if f.get('mimeType') == FOLDER_MIME:
+                    queue.append((f['id'], None))
+                yield parent_id, f
+        return
+
+    # imported here: client_utils builds its services from this module
+    from client_utils import client_pool
+
+    def task(folder_id, token):
+        with client_pool.lease(creds) as (drive, _):
+            return _list_page(drive, folder_id, token, page_size, folders=True)
+
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='drive-walk')
+    pending = {pool.submit(task, root_id, None): root_id}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                folder_id = pending.pop(fut)
+                files, token = fut.result()
+                if token:
+                    pending[pool.submit(task, folder_id, token)] = folder_id
+                for parent_id, f in accept(folder_id, files):
+                    if f.get('mimeType') == FOLDER_MIME:
+                        pending[pool.submit(task, f['id'], None)] = f['id']
+                    yield parent_id, f
+    finally:
+        for fut in pending:
+            fut.cancel()
+        pool.shutdown(wait=False)
+
+
+def get_file_metadata(drive_service, file_id, fields='id, name, mimeType, size'):
+    """Return Drive metadata dict for a single file."""
+    with api_call('drive.files.get'):
+        return drive_service.files().get(fileId=file_id, fields=fields).execute()
+
+
+def find_sibling_image(drive_service, video_meta):
+    """Image next to a video with the same base name (clip.mp4 -> clip.jpg, then clip.png, ...), or None."""
+    stem = os.path.splitext(video_meta.get('name') or '')[0]
+    if not stem:
+        return None
+    parents = video_meta.get('parents')
+    if parents is None:
+        parents = get_file_metadata(drive_service, video_meta['id'], fields='parents').get('parents') or []
+    if not parents:
         return None
-    return random.choice(vids)
+    in_parents = ' or '.join(f"'{p}' in parents" for p in parents)
+    name = stem.replace('\\', '\\\\').replace("'", "\\'")
+    q = f"({in_parents}) and trashed=false and {IMAGE_QUERY} and name contains '{name}'"
+    with api_call('drive.files.list'):
+        res = drive_service.files().list(q=q, spaces='drive', fields=f'files({FILE_FIELDS})', pageSize=100).execute()
+    # name contains is a prefix/word match: keep exact base names, best extension first
+    matches = [f for f in res.get('files', []) if os.path.splitext(f.get('name', ''))[0] == stem]
+    rank = {ext: i for i, ext in enumerate(IMAGE_EXTENSIONS)}
+    matches.sort(key=lambda f: rank.get(os.path.splitext(f['name'])[1].lower(), len(rank)))
+    return matches[0] if matches else None
+
+
+def pick_random_video_from_folder(drive_service, folder_id):
+    with span('pick', folder_id=folder_id):
+        return _pick_random_video(drive_service, folder_id)
+
+
+def _pick_random_video(drive_service, folder_id):
+    accept = None
+    if PROBE_ENABLED:
+        # skip files whose container header shows they cannot be Shorts (too long, landscape)
+        from probe_utils import shorts_filter
+        accept = shorts_filter(drive_service)
+    if DRIVE_INDEX_ENABLED:
+        # imported here: index_utils/ledger_utils build on the listing helpers above
+        from index_utils import get_folder_index
+        try:
+            index = get_folder_index()
+            if PICK_NO_REPEAT:
+                from ledger_utils import get_ledger
+                index.refresh(drive_service, folder_id)
+                return get_ledger().pick(index, folder_id, accept=accept)
+            return index.pick_random(drive_service, folder_id, accept=accept)
+        except Exception:
+            logger.exception('Drive folder index unavailable; listing folder %s directly', folder_id)
+    vids = list_videos_in_folder(drive_service, folder_id, recursive=DRIVE_RECURSIVE)
+    random.shuffle(vids)
+    for f in vids[:PICK_MAX_CANDIDATES if accept else 1]:
+        if accept is None or accept(f):
+            return f
+    return None
+
+
+def return_pick(folder_id, video_meta):
+    """Put a picked video whose upload failed back into the folder's shuffle bag (no-op without one)."""
+    if DRIVE_INDEX_ENABLED and PICK_NO_REPEAT:
+        from ledger_utils import get_ledger
+        try:
+            get_ledger().return_to_bag(folder_id, video_meta['id'])
+        except Exception:
+            logger.exception('Could not return %s to the shuffle bag of folder %s', video_meta['id'], folder_id)
+
 
+def next_download_chunk(downloader, request, chunksize):
+    """downloader.next_chunk() with per-chunk retries and stall detection; a retry resumes at the last received byte."""
+    def call():
+        with api_call('drive.files.get_media'):
+            return downloader.next_chunk()
+    return run_chunk(call, request.http, 'drive.download', chunksize)
 
-def download_drive_file_to_spooled(drive_service, file_id, max_mem=SPOOLED_MAX_MEM):
-    """Download Drive file into a SpooledTemporaryFile and return it (seeked to start)."""
-    sp = tempfile.SpooledTemporaryFile(max_size=max_mem)
+
+def download_drive_file_to_spooled(drive_service, file_id, max_mem=None, progress_callback=None):
+    """Download Drive file into a budgeted spool (see buffer_utils) and return it (seeked to start).
+
+    max_mem (default SPOOLED_MAX_MEM) caps the spool's memory; it spills to the scratch directory beyond
+    that or when the process-wide budget is used up. progress_callback(bytes_done, total_bytes) is called after every chunk.
+    """
+    sp = buffer_manager.spool(max_mem)
     request = drive_service.files().get_media(fileId=file_id)
-    downloader = MediaIoBaseDownload(sp, request)
+    downloader = MediaIoBaseDownload(sp, request, chunksize=SPOOL_DOWNLOAD_CHUNK)
     done = False
+    received = 0
+    started = time.monotonic()
     logger.info('Starting download of Drive file %s to spooled file', file_id)
-    while not done:
-        status, done = downloader.next_chunk()
-        if status:
-            logger.info('Download progress: %d%%', int(status.progress() * 100))
+    with span('download', file_id=file_id, mode='spooled'):
+        while not done:
+            status, done = next_download_chunk(downloader, request, SPOOL_DOWNLOAD_CHUNK)
+            if status:
+                TRANSFER_BYTES.inc(status.resumable_progress - received, direction='download')
+                received = status.resumable_progress
+                logger.info('Download progress: %d%%', int(status.progress() * 100))
+                if progress_callback is not None:
+                    progress_callback(status.resumable_progress, status.total_size)
+    record_transfer('download', received, time.monotonic() - started)
     sp.seek(0)
     logger.info('Download complete')
     return sp
+
+
+def download_drive_tail_to_spooled(drive_service, file_id, start, size=None, max_mem=None, retries=DOWNLOAD_RANGE_RETRIES):
+    """Download bytes start..size-1 of a Drive file with ranged GETs into a budgeted spool (seeked to its start).
+
+    Lets an interrupted upload resume without fetching the bytes YouTube already has.
+    size defaults to the file's size in Drive.
+    """
+    if size is None:
+        size = int(get_file_metadata(drive_service, file_id, fields='id, size').get('size') or 0)
+    sp = buffer_manager.spool(max_mem)
+    request = drive_service.files().get_media(fileId=file_id)
+    received = 0
+    started = time.monotonic()
+    logger.info('Starting download of Drive file %s from byte %d to spooled file', file_id, start)
+    try:
+        with span('download', file_id=file_id, mode='tail'):
+            for begin in range(start, size, SPOOL_DOWNLOAD_CHUNK):
+                content = _fetch_range(request.http, request.uri, begin, min(begin + SPOOL_DOWNLOAD_CHUNK, size) - 1, retries)
+                sp.write(content)
+                received += len(content)
+                TRANSFER_BYTES.inc(len(content), direction='download')
+    except Exception:
+        sp.close()
+        raise
+    record_transfer('download', received, time.monotonic() - started)
+    sp.seek(0)
+    return sp
+
+
+class _HashingWriter:
+    """File wrapper that md5-hashes everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
+
+
+def download_drive_file_to_path(drive_service, file_id, path, progress_callback=None):
+    """Download a Drive file to path on disk and return the md5 hex digest of the bytes written."""
+    request = drive_service.files().get_media(fileId=file_id)
+    received = 0
+    started = time.monotonic()
+    with open(path, 'wb') as f, span('download', file_id=file_id, mode='staging'):
+        writer = _HashingWriter(f)
+        downloader = MediaIoBaseDownload(writer, request, chunksize=STAGING_DOWNLOAD_CHUNK)
+        done = False
+        while not done:
+            status, done = next_download_chunk(downloader, request, STAGING_DOWNLOAD_CHUNK)
+            if status:
+                TRANSFER_BYTES.inc(status.resumable_progress - received, direction='download')
+                received = status.resumable_progress
+                if progress_callback is not None:
+                    progress_callback(status.resumable_progress, status.total_size)
+    record_transfer('download', received, time.monotonic() - started)
+    return writer.md5.hexdigest()
+
+
+class DownloadChecksumError(Exception):
+    """Downloaded bytes do not match Drive's md5Checksum."""
+
+
+def _fetch_range(http, uri, start, end, retries):
+    """GET bytes start..end (inclusive) of a media uri, retrying transient failures."""
+    headers = {'range': 'bytes=%d-%d' % (start, end)}
+    expected = end - start + 1
+
+    def call():
+        with api_call('drive.files.get_media.range'):
+            resp, content = http.request(uri, 'GET', headers=headers)
+        if resp.status not in (200, 206):
+            raise HttpError(resp, content, uri=uri)
+        if len(content) != expected:
+            raise IOError('short range response: len=%d expected=%d' % (len(content), expected))
+        return content
+
+    return run_chunk(call, http, 'drive.range', expected, policy=RetryPolicy(retries=retries))
+
+
+def download_drive_file_parallel(drive_service, creds, file_id, concurrency=DOWNLOAD_CONCURRENCY,
+                                 range_size=DOWNLOAD_RANGE_SIZE, retries=DOWNLOAD_RANGE_RETRIES, meta=None, progress_callback=None):
+    """Download a Drive file with concurrent ranged GETs into a preallocated temp file.
+
+    Each worker thread uses its own authorized Http (httplib2 is not thread-safe).
+    The result is verified against md5Checksum when Drive provides one and returned seeked to start.
+    """
+    if meta is None:
+        meta = get_file_metadata(drive_service, file_id, fields='id, name, size, md5Checksum')
+    size = int(meta.get('size') or 0)
+    if not size:
+        # Drive gave no size (e.g. native Docs) -> nothing to split into ranges
+        return download_drive_file_to_spooled(drive_service, file_id, progress_callback=progress_callback)
+
+    uri = drive_service.files().get_media(fileId=file_id).uri
+    out = buffer_manager.scratch_file()
+    out.truncate(size)
+    fd = out.fileno()
+    local = threading.local()
+
+    def worker(start):
+        if not hasattr(local, 'http'):
+            local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        end = min(start + range_size, size) - 1
+        content = _fetch_range(local.http, uri, start, end, retries)
+        os.pwrite(fd, content, start)
+        TRANSFER_BYTES.inc(len(content), direction='download')
+        return len(content)
+
+    logger.info('Starting parallel download of Drive file %s (%d bytes, %d workers, %d byte ranges)',
+                file_id, size, concurrency, range_size)
+    done = 0
+    started = time.monotonic()
+    try:
+        with span('download', file_id=file_id, mode='parallel'), \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='drive-range') as pool:
+            for n in pool.map(worker, range(0, size, range_size)):
+                done += n
+                logger.debug('Download progress: %d%%', int(done * 100 / size))
+                if progress_callback is not None:
+                    progress_callback(done, size)
+    except Exception:
+        out.close()
+        raise
+    record_transfer('download', done, time.monotonic() - started)
+
+    expected_md5 = meta.get('md5Checksum')
+    if expected_md5:
+        out.seek(0)
+        digest = hashlib.md5()
+        for block in iter(lambda: out.read(1024 * 1024), b''):
+            digest.update(block)
+        if digest.hexdigest() != expected_md5:
+            out.close()
+            raise DownloadChecksumError('md5 mismatch for %s: got %s expected %s' % (file_id, digest.hexdigest(), expected_md5))
+    out.seek(0)
+    logger.info('Parallel download complete')
+    return out
@@ -0,0 +1,341 @@
+import time
+import random
+import sqlite3
+import contextlib
+import logging
+import threading
+from config import DRIVE_INDEX_DB, PICK_MAX_CANDIDATES, DRIVE_RECURSIVE
+from drive_utils import list_videos_in_folder, walk_folder_tree, is_video_file, FILE_FIELDS, FOLDER_MIME
+
+logger = logging.getLogger('index_utils')
+
+CHANGE_FIELDS = f'nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}, parents, trashed))'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS folders (
+    folder_id TEXT PRIMARY KEY,
+    seeded_at REAL NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    folder_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    name TEXT,
+    mime_type TEXT,
+    md5 TEXT,
+    size INTEGER,
+    modified TEXT,
+    seq INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (folder_id, file_id),
+    UNIQUE (folder_id, pos)
+);
+CREATE INDEX IF NOT EXISTS files_by_id ON files (file_id);
+CREATE TABLE IF NOT EXISTS subfolders (
+    folder_id TEXT NOT NULL,
+    subfolder_id TEXT NOT NULL,
+    PRIMARY KEY (folder_id, subfolder_id)
+);
+CREATE TABLE IF NOT EXISTS probes (
+    file_id TEXT PRIMARY KEY,
+    md5 TEXT,
+    modified TEXT,
+    container TEXT,
+    duration REAL,
+    width INTEGER,
+    height INTEGER,
+    codec TEXT,
+    error TEXT,
+    probed_at REAL NOT NULL
+);
+'''
+
+# created after the migration below so older databases gain the column first
+SEQ_INDEX = 'CREATE INDEX IF NOT EXISTS files_by_seq ON files (folder_id, seq)'
+
+# rows written per transaction while a folder tree is being walked
+SEED_BATCH = 500
+
+
+def _row_to_meta(row):
+    return {'id': row[0], 'name': row[1], 'mimeType': row[2], 'md5Checksum': row[3], 'size': row[4], 'modifiedTime': row[5]}
+
+
+class DriveFolderIndex:
+    """Persistent index of video files per Drive folder.
+
+    Each folder is listed once (seed); afterwards it is kept current from changes.list
+    using a stored start page token. Files of a folder occupy dense positions 0..count-1,
+    so a random pick is a single primary-key lookup; removals move the last file into the hole.
+    """
+
+    def __init__(self, path=DRIVE_INDEX_DB):
+        self.path = path
+        self._lock = threading.RLock()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = {r[1] for r in db.execute('PRAGMA table_info(files)')}
+            if 'seq' not in columns:
+                db.execute('ALTER TABLE files ADD COLUMN seq INTEGER NOT NULL DEFAULT 0')
+            # rows indexed before seq existed: number them so files_added_since(folder, 0) returns them
+            if db.execute('SELECT 1 FROM files WHERE seq=0 LIMIT 1').fetchone():
+                db.execute('UPDATE files SET seq=?+rowid WHERE seq=0', (int(self._get_meta(db, 'seq') or 0),))
+                self._set_meta(db, 'seq', str(db.execute('SELECT MAX(seq) FROM files').fetchone()[0]))
+            db.execute(SEQ_INDEX)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # -- meta -----------------------------------------------------------------
+
+    def _get_meta(self, db, key):
+        row = db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, db, key, value):
+        db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    # -- row maintenance ------------------------------------------------------
+
+    def _upsert(self, db, folder_id, f):
+        values = (f.get('name'), f.get('mimeType'), f.get('md5Checksum'),
+                  int(f['size']) if f.get('size') else None, f.get('modifiedTime'))
+        cur = db.execute('UPDATE files SET name=?, mime_type=?, md5=?, size=?, modified=? WHERE folder_id=? AND file_id=?',
+                         values + (folder_id, f['id']))
+        if cur.rowcount:
+            return
+        count = db.execute('SELECT count FROM folders WHERE folder_id=?', (folder_id,)).fetchone()[0]
+        # seq grows with every insert so consumers can fetch "files added since" cheaply
+        seq = int(self._get_meta(db, 'seq') or 0) + 1
+        self._set_meta(db, 'seq', str(seq))
+        db.execute('INSERT INTO files (folder_id, file_id, pos, name, mime_type, md5, size, modified, seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (folder_id, f['id'], count) + values + (seq,))
+        db.execute('UPDATE folders SET count=count+1 WHERE folder_id=?', (folder_id,))
+
+    def _remove(self, db, folder_id, file_id):
+        row = db.execute('SELECT pos FROM files WHERE folder_id=? AND file_id=?', (folder_id, file_id)).fetchone()
+        if row is None:
+            return
+        pos = row[0]
+        last = db.execute('SELECT count FROM folders WHERE folder_id=?', (folder_id,)).fetchone()[0] - 1
+        db.execute('DELETE FROM files WHERE folder_id=? AND file_id=?', (folder_id, file_id))
+        if pos != last:
+            db.execute('UPDATE files SET pos=? WHERE folder_id=? AND pos=?', (pos, folder_id, last))
+        db.execute('UPDATE folders SET count=count-1 WHERE folder_id=?', (folder_id,))
+
+    def _forget(self, db, folder_id):
+        """Drop everything indexed for folder_id so the next refresh seeds it again."""
+        db.execute('DELETE FROM files WHERE folder_id=?', (folder_id,))
+        db.execute('DELETE FROM subfolders WHERE folder_id=?', (folder_id,))
+        db.execute('DELETE FROM folders WHERE folder_id=?', (folder_id,))
+
+    def _add_tree(self, drive_service, folder_id, subfolder_id):
+        """Index the videos and subfolders below subfolder_id under folder_id, committing as pages arrive."""
+        added = 0
+        batch = []
+
+        def flush():
+            with self._connect() as db:
+                for f in batch:
+                    if f.get('mimeType') == FOLDER_MIME:
+                        db.execute('INSERT OR IGNORE INTO subfolders (folder_id, subfolder_id) VALUES (?, ?)', (folder_id, f['id']))
+                    else:
+                        self._upsert(db, folder_id, f)
+            batch.clear()
+
+        if DRIVE_RECURSIVE:
+            items = (f for _, f in walk_folder_tree(drive_service, subfolder_id))
+        else:
+            items = iter(list_videos_in_folder(drive_service, subfolder_id))
+        for f in items:
+            batch.append(f)
+            added += f.get('mimeType') != FOLDER_MIME
+            if len(batch) >= SEED_BATCH:
+                flush()
+        flush()
+        return added
+
+    # -- public API -----------------------------------------------------------
+
+    def is_seeded(self, folder_id):
+        with self._connect() as db:
+            # seeded_at stays 0 until the walk completes, so a seed killed midway is redone
+            return db.execute('SELECT 1 FROM folders WHERE folder_id=? AND seeded_at>0', (folder_id,)).fetchone() is not None
+
+    def seed(self, drive_service, folder_id):
+        """List folder_id (its whole subtree with DRIVE_RECURSIVE) once and (re)build its entries."""
+        with self._lock:
+            with self._connect() as db:
+                if self._get_meta(db, 'start_page_token') is None:
+                    # take the token before listing so changes made during the listing are replayed
+                    token = drive_service.changes().getStartPageToken().execute().get('startPageToken')
+                    self._set_meta(db, 'start_page_token', token)
+            with self._connect() as db:
+                self._forget(db, folder_id)
+                db.execute('INSERT INTO folders (folder_id, seeded_at, count) VALUES (?, 0, 0)', (folder_id,))
+            try:
+                added = self._add_tree(drive_service, folder_id, folder_id)
+            except Exception:
+                # a half-listed tree must not look seeded
+                with self._connect() as db:
+                    self._forget(db, folder_id)
+                raise
+            with self._connect() as db:
+                db.execute('UPDATE folders SET seeded_at=? WHERE folder_id=?', (time.time(), folder_id))
+            logger.info('Seeded Drive index for folder %s with %d videos', folder_id, added)
+            return added
+
+    def sync(self, drive_service):
+        """Apply pending changes.list entries to every seeded folder. Returns number of changes seen."""
+        with self._lock:
+            with self._connect() as db:
+                page_token = self._get_meta(db, 'start_page_token')
+                folders = {r[0]: {r[0]} for r in db.execute('SELECT folder_id FROM folders WHERE seeded_at>0')}
+                for folder_id, subfolder_id in db.execute('SELECT s.folder_id, s.subfolder_id FROM subfolders s '
+                                                          'JOIN folders f ON f.folder_id=s.folder_id WHERE f.seeded_at>0'):
+                    folders[folder_id].add(subfolder_id)
+            if page_token is None or not folders:
+                return 0
+            seen = 0
+            new_subfolders = []
+            while page_token:
+                res = drive_service.changes().list(pageToken=page_token, spaces='drive', pageSize=1000,
+                                                   fields=CHANGE_FIELDS).execute()
+                with self._connect() as db:
+                    for change in res.get('changes', []):
+                        self._apply_change(db, folders, change, new_subfolders)
+                        seen += 1
+                    if res.get('newStartPageToken'):
+                        self._set_meta(db, 'start_page_token', res['newStartPageToken'])
+                page_token = res.get('nextPageToken')
+            for folder_id, subfolder_id in new_subfolders:
+                # a folder created or moved into a tree: its contents never show up as changes of their own
+                if folder_id in folders:
+                    self._add_tree(drive_service, folder_id, subfolder_id)
+            if seen:
+                logger.info('Applied %d Drive changes to folder index', seen)
+            return seen
+
+    def _apply_change(self, db, folders, change, new_subfolders):
+        """Apply one change; folders maps each seeded folder to the ids of its tree and is updated in place."""
+        file_id = change.get('fileId')
+        f = change.get('file')
+        gone = change.get('removed') or not f or f.get('trashed')
+        parents = set() if gone else set(f.get('parents') or [])
+        if gone or f.get('mimeType') == FOLDER_MIME:
+            for folder_id, tree in list(folders.items()):
+                if file_id == folder_id or file_id not in tree or parents & tree:
+                    continue
+                # a subfolder left the tree: which indexed files were below it is unknown, so re-seed
+                logger.info('Subfolder %s left folder %s; re-seeding it', file_id, folder_id)
+                self._forget(db, folder_id)
+                del folders[folder_id]
+            if not gone and DRIVE_RECURSIVE:
+                for folder_id, tree in folders.items():
+                    if parents & tree and file_id not in tree:
+                        db.execute('INSERT OR IGNORE INTO subfolders (folder_id, subfolder_id) VALUES (?, ?)', (folder_id, file_id))
+                        tree.add(file_id)
+                        new_subfolders.append((folder_id, file_id))
+            if not gone:
+                return
+        if gone:
+            for (folder_id,) in db.execute('SELECT folder_id FROM files WHERE file_id=?', (file_id,)).fetchall():
+                self._remove(db, folder_id, file_id)
+            return
+        for folder_id, tree in folders.items():
+            if parents & tree and is_video_file(f):
+                self._upsert(db, folder_id, f)
+            else:
+                self._remove(db, folder_id, file_id)
+
+    def count(self, folder_id):
+        with self._connect() as db:
+            row = db.execute('SELECT count FROM folders WHERE folder_id=?', (folder_id,)).fetchone()
+            return row[0] if row else 0
+
+    def get(self, folder_id, file_id):
+        with self._connect() as db:
+            row = db.execute('SELECT file_id, name, mime_type, md5, size, modified FROM files WHERE folder_id=? AND file_id=?',
+                             (folder_id, file_id)).fetchone()
+            return _row_to_meta(row) if row else None
+
+    def files(self, folder_id):
+        with self._connect() as db:
+            rows = db.execute('SELECT file_id, name, mime_type, md5, size, modified FROM files WHERE folder_id=? ORDER BY pos',
+                              (folder_id,)).fetchall()
+            return [_row_to_meta(r) for r in rows]
+
+    def files_added_since(self, folder_id, seq):
+        """Return ([video dicts added after seq], latest seq) for folder_id."""
+        with self._connect() as db:
+            rows = db.execute('SELECT file_id, name, mime_type, md5, size, modified, seq FROM files WHERE folder_id=? AND seq>? ORDER BY seq',
+                              (folder_id, seq)).fetchall()
+            latest = int(self._get_meta(db, 'seq') or 0)
+            return [_row_to_meta(r) for r in rows], max([seq, latest] + [r[6] for r in rows])
+
+    # -- container probes (see probe_utils) -----------------------------------
+
+    def get_probe(self, file_id, md5=None, modified=None):
+        """Cached probe result for file_id, or None if missing or the file changed since it was probed."""
+        with self._connect() as db:
+            row = db.execute('SELECT md5, modified, container, duration, width, height, codec, error FROM probes WHERE file_id=?',
+                             (file_id,)).fetchone()
+        if row is None or (md5 and row[0] != md5) or (not md5 and modified and row[1] != modified):
+            return None
+        info = dict(zip(('container', 'duration', 'width', 'height', 'codec', 'error'), row[2:]))
+        return {k: v for k, v in info.items() if v is not None}
+
+    def save_probe(self, file_id, md5, modified, info):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO probes (file_id, md5, modified, container, duration, width, height, codec, error, probed_at) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (file_id, md5, modified, info.get('container'), info.get('duration'), info.get('width'), info.get('height'),
+                        info.get('codec'), info.get('error'), time.time()))
+
+    def refresh(self, drive_service, folder_id):
+        """Seed folder_id if it was never indexed, otherwise catch up from the Changes feed."""
+        if self.is_seeded(folder_id):
+            self.sync(drive_service)
+        # sync may have dropped the folder (a subfolder moved out of it)
+        if not self.is_seeded(folder_id):
+            self.seed(drive_service, folder_id)
+
+    def pick_random(self, drive_service, folder_id, accept=None, max_tries=PICK_MAX_CANDIDATES):
+        """Return a random video dict from folder_id without listing the folder.
+
+        With accept(meta), up to max_tries distinct random files are tried and the first accepted one returned.
+        """
+        self.refresh(drive_service, folder_id)
+        count = self.count(folder_id)
+        if not count:
+            return None
+        for pos in random.sample(range(count), min(count, max_tries if accept else 1)):
+            with self._connect() as db:
+                row = db.execute('SELECT file_id, name, mime_type, md5, size, modified FROM files WHERE folder_id=? AND pos=?',
+                                 (folder_id, pos)).fetchone()
+            if row and (accept is None or accept(_row_to_meta(row))):
+                return _row_to_meta(row)
+        return None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_folder_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = DriveFolderIndex()
+        return _index
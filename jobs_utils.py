@@ -0,0 +1,202 @@
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics_utils import Trace, bind_trace, JOBS
+from config import JOB_WORKERS, JOB_HISTORY, METRICS_TRACE, SCHED_COORDINATION, JOB_PUBLISH_INTERVAL
+
+logger = logging.getLogger('jobs_utils')
+
+
+class Job:
+    """Progress record for one background upload; also the progress sink passed to transfers."""
+
+    def __init__(self, kind, params=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.stage = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.bytes_total = None
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.transfer_started = None
+        self.video_id = None
+        self.picked = None
+        self.error = None
+        self.trace = Trace() if METRICS_TRACE else None
+        self._lock = threading.Lock()
+        self._publish = None     # set by JobManager to share snapshots with other worker processes
+        self._published = 0.0
+
+    def set_stage(self, stage):
+        with self._lock:
+            self.stage = stage
+        logger.debug('Job %s stage: %s', self.id, stage)
+        self._notify(force=True)
+
+    def _notify(self, force=False):
+        # progress callbacks arrive per chunk; share at most one snapshot per JOB_PUBLISH_INTERVAL
+        if self._publish is None:
+            return
+        now = time.time()
+        if force or now - self._published >= JOB_PUBLISH_INTERVAL:
+            self._published = now
+            self._publish(self)
+
+    def _mark_transfer(self, total):
+        if self.transfer_started is None:
+            self.transfer_started = time.time()
+        if total:
+            self.bytes_total = total
+
+    def on_download(self, done, total):
+        with self._lock:
+            self._mark_transfer(total)
+            self.bytes_downloaded = done
+        self._notify()
+
+    def on_upload(self, done, total):
+        with self._lock:
+            self._mark_transfer(total)
+            self.bytes_uploaded = done
+        self._notify()
+
+    def throughput(self):
+        """Upload bytes/s since the transfer started (download rate while nothing is uploaded yet)."""
+        if self.transfer_started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.transfer_started
+        moved = self.bytes_uploaded or self.bytes_downloaded
+        return moved / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'params': self.params,
+                'stage': self.stage,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'bytes_total': self.bytes_total,
+                'bytes_downloaded': self.bytes_downloaded,
+                'bytes_uploaded': self.bytes_uploaded,
+                'throughput_bytes_per_s': round(self.throughput(), 1),
+                'picked': self.picked,
+                'video_id': self.video_id,
+                'error': self.error,
+                'trace': self.trace.to_list() if self.trace is not None else None,
+            }
+
+
+class JobSnapshot:
+    """Status of a job running in another worker process, as last published to the shared store."""
+
+    def __init__(self, data):
+        self.data = data
+        self.id = data['id']
+
+    def to_dict(self):
+        return self.data
+
+
+class JobManager:
+    """Runs submitted upload jobs on a bounded thread pool and keeps their status for polling.
+
+    Submissions return immediately; only JOB_WORKERS jobs transfer at once and the rest queue.
+    At most JOB_HISTORY jobs are remembered (oldest finished ones are forgotten first).
+
+    With a shared store (SCHED_COORDINATION) every job's status is also published there, so
+    get() and list() answer for jobs of all worker processes, whichever one serves the request.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, history=JOB_HISTORY, store=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
+        self.history = history
+        self._store = store
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None and SCHED_COORDINATION:
+            from coordination_utils import get_shared_store
+            self._store = get_shared_store()
+        return self._store
+
+    def _publish(self, job):
+        try:
+            self.store.save_job(job.to_dict())
+        except sqlite3.Error:
+            logger.warning('Could not publish status of job %s', job.id, exc_info=True)
+
+    def submit(self, kind, fn, params=None):
+        """Queue fn(job) and return the Job; fn's return value becomes job.video_id."""
+        job = Job(kind, params)
+        if self.store is not None:
+            job._publish = self._publish
+            self._publish(job)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_locked()
+        self.executor.submit(self._run, job, fn)
+        logger.info('Queued %s job %s', kind, job.id)
+        return job
+
+    def _run(self, job, fn):
+        job.started = time.time()
+        job.set_stage('running')
+        try:
+            with bind_trace(job.trace):
+                job.video_id = fn(job)
+            job.set_stage('done')
+        except Exception as e:
+            logger.exception('Job %s (%s) failed', job.id, job.kind)
+            job.error = str(e)
+            job.set_stage('failed')
+        finally:
+            job.finished = time.time()
+            JOBS.inc(kind=job.kind, result=job.stage)
+            if job._publish is not None:
+                job._notify(force=True)
+                try:
+                    self.store.trim_jobs(self.history)
+                except sqlite3.Error:
+                    logger.warning('Could not trim shared job history', exc_info=True)
+
+    def _trim_locked(self):
+        if len(self._jobs) <= self.history:
+            return
+        for job_id in [j.id for j in self._jobs.values() if j.finished]:
+            if len(self._jobs) <= self.history:
+                break
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            data = self.store.get_job(job_id)
+            job = JobSnapshot(data) if data else None
+        return job
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        local = [j.to_dict() for j in reversed(jobs)]
+        if self.store is None:
+            return local
+        # local jobs are fresher than their last published snapshot
+        merged = {d['id']: d for d in self.store.list_jobs(self.history)}
+        merged.update((d['id'], d) for d in local)
+        return sorted(merged.values(), key=lambda d: d['created'], reverse=True)[:self.history]
+
+
+job_manager = JobManager()
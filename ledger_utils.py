@@ -0,0 +1,213 @@
+import time
+import random
+import sqlite3
+import logging
+import threading
+import contextlib
+from config import UPLOAD_LEDGER_DB, STATUS_POLL_INITIAL, PICK_MAX_CANDIDATES
+
+logger = logging.getLogger('ledger_utils')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_id TEXT NOT NULL,
+    md5 TEXT,
+    folder_id TEXT,
+    video_id TEXT,
+    uploaded_at REAL NOT NULL,
+    state TEXT,
+    state_detail TEXT,
+    checks INTEGER NOT NULL DEFAULT 0,
+    next_check REAL,
+    settled_at REAL
+);
+CREATE INDEX IF NOT EXISTS uploads_by_file ON uploads (file_id);
+CREATE INDEX IF NOT EXISTS uploads_by_md5 ON uploads (md5);
+CREATE TABLE IF NOT EXISTS bags (
+    folder_id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    last_seq INTEGER NOT NULL DEFAULT 0,
+    cycle INTEGER NOT NULL DEFAULT 0,
+    cycle_started REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS bag_items (
+    folder_id TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    PRIMARY KEY (folder_id, pos),
+    UNIQUE (folder_id, file_id)
+);
+'''
+
+# YouTube processing state columns added to uploads after the first release
+STATE_COLUMNS = (('state', 'TEXT'), ('state_detail', 'TEXT'), ('checks', 'INTEGER NOT NULL DEFAULT 0'),
+                 ('next_check', 'REAL'), ('settled_at', 'REAL'))
+# created after the migration so older databases gain the column first
+NEXT_CHECK_INDEX = 'CREATE INDEX IF NOT EXISTS uploads_by_next_check ON uploads (next_check)'
+
+
+class UploadLedger:
+    """Persistent record of uploaded Drive files plus a per-folder shuffle bag.
+
+    The bag holds the files of a folder not yet drawn in the current cycle at dense
+    positions, so a draw is a random position lookup plus moving the last item into the
+    hole (O(1)). It is refilled from the folder index only once the folder is exhausted;
+    files added to the folder mid-cycle join the bag via the index's insert sequence, and
+    files removed from Drive are discarded lazily when drawn.
+    """
+
+    def __init__(self, path=UPLOAD_LEDGER_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = {r[1] for r in db.execute('PRAGMA table_info(uploads)')}
+            for name, decl in STATE_COLUMNS:
+                if name not in columns:
+                    db.execute(f'ALTER TABLE uploads ADD COLUMN {name} {decl}')
+            db.execute(NEXT_CHECK_INDEX)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # -- ledger ---------------------------------------------------------------
+
+    def record_upload(self, file_id, md5=None, folder_id=None, video_id=None):
+        """Record an upload; one with a video_id is 'pending' until the processing-status poller settles it."""
+        now = time.time()
+        state, next_check = ('pending', now + STATUS_POLL_INITIAL) if video_id else (None, None)
+        with self._connect() as db:
+            db.execute('INSERT INTO uploads (file_id, md5, folder_id, video_id, uploaded_at, state, next_check) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (file_id, md5, folder_id, video_id, now, state, next_check))
+
+    def due_for_check(self, limit, now=None):
+        """Pending uploads whose next status check is due: list of (video_id, uploaded_at, checks), most overdue first."""
+        with self._connect() as db:
+            return db.execute("SELECT video_id, uploaded_at, checks FROM uploads WHERE state='pending' AND next_check<=? "
+                              'ORDER BY next_check LIMIT ?', (time.time() if now is None else now, limit)).fetchall()
+
+    def record_state(self, video_id, state, detail=None, next_check=None):
+        """Store a status check result: with next_check the upload stays pending, otherwise state is final."""
+        settled_at = None if next_check else time.time()
+        with self._connect() as db:
+            db.execute('UPDATE uploads SET state=?, state_detail=?, checks=checks+1, next_check=?, settled_at=? WHERE video_id=?',
+                       (state, detail, next_check, settled_at, video_id))
+
+    def was_uploaded(self, file_id=None, md5=None, since=0):
+        """True if file_id, or any file with the same md5Checksum, was uploaded at or after since."""
+        with self._connect() as db:
+            return self._was_uploaded(db, file_id, md5, since)
+
+    def _was_uploaded(self, db, file_id, md5, since):
+        if file_id and db.execute('SELECT 1 FROM uploads WHERE file_id=? AND uploaded_at>=? LIMIT 1', (file_id, since)).fetchone():
+            return True
+        if md5 and db.execute('SELECT 1 FROM uploads WHERE md5=? AND uploaded_at>=? LIMIT 1', (md5, since)).fetchone():
+            return True
+        return False
+
+    def history(self, limit=50):
+        with self._connect() as db:
+            rows = db.execute('SELECT file_id, md5, folder_id, video_id, uploaded_at, state, state_detail, settled_at '
+                              'FROM uploads ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [{'file_id': r[0], 'md5': r[1], 'folder_id': r[2], 'video_id': r[3], 'uploaded_at': r[4],
+                 'state': r[5], 'state_detail': r[6], 'settled_at': r[7]} for r in rows]
+
+    # -- shuffle bag ----------------------------------------------------------
+
+    def _bag(self, db, folder_id):
+        row = db.execute('SELECT size, last_seq, cycle, cycle_started FROM bags WHERE folder_id=?', (folder_id,)).fetchone()
+        if row is None:
+            db.execute('INSERT INTO bags (folder_id) VALUES (?)', (folder_id,))
+            row = (0, 0, 0, 0)
+        return {'size': row[0], 'last_seq': row[1], 'cycle': row[2], 'cycle_started': row[3]}
+
+    def _add_items(self, db, folder_id, bag, file_ids):
+        for file_id in file_ids:
+            cur = db.execute('INSERT OR IGNORE INTO bag_items (folder_id, pos, file_id) VALUES (?, ?, ?)',
+                             (folder_id, bag['size'], file_id))
+            if cur.rowcount:
+                bag['size'] += 1
+
+    def _refill(self, db, folder_id, bag, index):
+        files, latest = index.files_added_since(folder_id, 0)
+        db.execute('DELETE FROM bag_items WHERE folder_id=?', (folder_id,))
+        bag.update(size=0, last_seq=latest, cycle=bag['cycle'] + 1, cycle_started=time.time())
+        self._add_items(db, folder_id, bag, [f['id'] for f in files])
+        logger.info('Shuffle bag for folder %s refilled with %d files (cycle %d)', folder_id, bag['size'], bag['cycle'])
+
+    def _draw(self, db, folder_id, bag):
+        pos = random.randrange(bag['size'])
+        last = bag['size'] - 1
+        file_id = db.execute('SELECT file_id FROM bag_items WHERE folder_id=? AND pos=?', (folder_id, pos)).fetchone()[0]
+        db.execute('DELETE FROM bag_items WHERE folder_id=? AND pos=?', (folder_id, pos))
+        if pos != last:
+            db.execute('UPDATE bag_items SET pos=? WHERE folder_id=? AND pos=?', (pos, folder_id, last))
+        bag['size'] = last
+        return file_id
+
+    def _draw_candidate(self, index, folder_id):
+        """Draw the next bag entry still in the folder and not uploaded this cycle; None once the folder is exhausted."""
+        with self._lock, self._connect() as db:
+            bag = self._bag(db, folder_id)
+            added, bag['last_seq'] = index.files_added_since(folder_id, bag['last_seq'])
+            self._add_items(db, folder_id, bag, [f['id'] for f in added])
+            refilled = False
+            picked = None
+            while picked is None:
+                if bag['size'] == 0:
+                    if refilled:
+                        break
+                    self._refill(db, folder_id, bag, index)
+                    refilled = True
+                    if bag['size'] == 0:
+                        break
+                file_id = self._draw(db, folder_id, bag)
+                meta = index.get(folder_id, file_id)
+                if meta is None:
+                    continue  # removed from Drive since it was bagged
+                if self._was_uploaded(db, file_id, meta.get('md5Checksum'), bag['cycle_started']):
+                    continue  # same content already uploaded this cycle (e.g. a copy under another id)
+                picked = meta
+            db.execute('UPDATE bags SET size=?, last_seq=?, cycle=?, cycle_started=? WHERE folder_id=?',
+                       (bag['size'], bag['last_seq'], bag['cycle'], bag['cycle_started'], folder_id))
+            return picked
+
+    def pick(self, index, folder_id, accept=None, max_tries=PICK_MAX_CANDIDATES):
+        """Draw the next not-yet-uploaded video of folder_id from its shuffle bag (index must be current).
+
+        Files rejected by accept(meta) are dropped from the bag for the rest of the cycle; at most
+        max_tries are tried. accept may read from Drive, so it runs outside the lock and transaction.
+        """
+        for _ in range(max_tries if accept is not None else 1):
+            meta = self._draw_candidate(index, folder_id)
+            if meta is None or accept is None or accept(meta):
+                return meta
+        logger.warning('No acceptable video among %d candidates from folder %s', max_tries, folder_id)
+        return None
+
+    def return_to_bag(self, folder_id, file_id):
+        """Undo a draw whose upload failed, so the file stays in the current cycle."""
+        with self._lock, self._connect() as db:
+            bag = self._bag(db, folder_id)
+            self._add_items(db, folder_id, bag, [file_id])
+            db.execute('UPDATE bags SET size=? WHERE folder_id=?', (bag['size'], folder_id))
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UploadLedger()
+        return _ledger
@@ -0,0 +1,285 @@
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from config import METRICS_TRACE_MAX_SPANS
+
+logger = logging.getLogger('metrics_utils')
+
+# Default histogram buckets (seconds) for API calls and pipeline stages
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# Buckets (bytes/s) for per-transfer throughput: 64 KiB/s .. 256 MiB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(7))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' % (self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per-bucket (non-cumulative) counts + [+Inf], sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """In-process metric registry rendered in the Prometheus text exposition format.
+
+    Updates are a dict lookup under a per-metric lock, so instrumentation can stay on under load.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError('metric %s already registered with a different type or labels' % name)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('shorts_stage_seconds', 'Duration of upload pipeline stages', ['stage'])
+STAGE_ERRORS = registry.counter('shorts_stage_errors_total', 'Pipeline stages that raised', ['stage'])
+TRANSFER_BYTES = registry.counter('shorts_transfer_bytes_total', 'Bytes moved by transfers', ['direction'])
+TRANSFER_THROUGHPUT = registry.histogram('shorts_transfer_throughput_bytes_per_second', 'Throughput of completed transfers',
+                                         ['direction'], buckets=THROUGHPUT_BUCKETS)
+API_REQUESTS = registry.counter('shorts_api_requests_total', 'Google API requests by method and outcome', ['method', 'status'])
+API_SECONDS = registry.histogram('shorts_api_request_seconds', 'Google API request latency', ['method'])
+RETRIES = registry.counter('shorts_retries_total', 'Retried or fallen-back operations', ['operation'])
+RETRY_REASONS = registry.counter('shorts_retry_reasons_total', 'Transfer chunk retries by cause', ['operation', 'reason'])
+RETRY_BACKOFF = registry.histogram('shorts_retry_backoff_seconds', 'Backoff waited before a transfer chunk retry', ['operation'])
+TRANSFER_STALLS = registry.counter('shorts_transfer_stalls_total', 'Chunks torn down by the stall watchdog', ['operation'])
+TRANSFER_GIVEUPS = registry.counter('shorts_transfer_giveups_total', 'Transient chunk failures that exhausted their retries', ['operation'])
+SCHEDULER_LAG = registry.histogram('shorts_scheduler_lag_seconds',
+                                   'Delay before a scheduled run starts (trigger: APScheduler fire vs plan, queue: waiting for a worker)',
+                                   ['phase'])
+SCHEDULER_PENDING = registry.gauge('shorts_scheduler_pending_runs', 'Scheduled runs waiting for a worker')
+SCHEDULER_ACTIVE = registry.gauge('shorts_scheduler_active_runs', 'Scheduled runs currently executing')
+JOBS = registry.counter('shorts_jobs_total', 'Finished background jobs', ['kind', 'result'])
+TRENDING_CACHE = registry.counter('shorts_trending_cache_requests_total', 'Trending tag cache lookups', ['result'])
+PROBES = registry.counter('shorts_probe_total', 'Container header probes (cached, probed, failed)', ['result'])
+SHORTS_REJECTED = registry.counter('shorts_rejected_total', 'Picked files skipped for failing Shorts constraints', ['reason'])
+STAGING_REQUESTS = registry.counter('shorts_staging_requests_total', 'Staging cache lookups at upload time (hit, miss, stale)', ['result'])
+STAGING_BYTES = registry.gauge('shorts_staging_bytes', 'Bytes held in the prefetch staging cache')
+BUFFER_BYTES = registry.gauge('shorts_buffer_bytes', 'Transfer buffer memory by state (in_use, pooled)', ['state'])
+SPOOL_SPILLS = registry.counter('shorts_spool_spills_total', 'Spools moved to the scratch directory')
+PROCESSING_RESULTS = registry.counter('shorts_processing_results_total', 'Uploads settled by the processing-status poller', ['state'])
+THUMBNAILS = registry.counter('shorts_thumbnails_total', 'Thumbnails prepared (cached, rendered, passthrough, failed)', ['result'])
+
+
+# -- tracing -------------------------------------------------------------------
+
+class Trace:
+    """Ordered list of timed spans for one job; at most max_spans are kept."""
+
+    def __init__(self, max_spans=METRICS_TRACE_MAX_SPANS):
+        self.started = time.time()
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, start, seconds, error=None, **attrs):
+        span = {'name': name, 'offset': round(start - self.started, 4), 'seconds': round(seconds, 4)}
+        span.update(attrs)
+        if error:
+            span['error'] = error
+        with self._lock:
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+            else:
+                self.spans.append(span)
+
+    def to_list(self):
+        with self._lock:
+            return list(self.spans)
+
+
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextlib.contextmanager
+def bind_trace(trace):
+    """Make trace the current thread's trace (None leaves tracing off) for the duration of the block."""
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextlib.contextmanager
+def span(stage, **attrs):
+    """Time a pipeline stage into STAGE_SECONDS and, if a trace is bound, record it as a span."""
+    started_wall = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(stage, started_wall, elapsed, error=error, **attrs)
+
+
+@contextlib.contextmanager
+def api_call(method):
+    """Count and time one Google API request; status is 'ok', the HTTP status of an HttpError, or 'error'."""
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException as e:
+        status = getattr(getattr(e, 'resp', None), 'status', None) or 'error'
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - started, method=method)
+        API_REQUESTS.inc(method=method, status=status)
+
+
+def record_transfer(direction, nbytes, seconds):
+    """Record a completed transfer's throughput (bytes are counted incrementally by the callers)."""
+    if nbytes and seconds > 0:
+        TRANSFER_THROUGHPUT.observe(nbytes / seconds, direction=direction)
+
+
+def render_metrics():
+    return registry.render()
@@ -0,0 +1,305 @@
+import struct
+import logging
+from metrics_utils import span, api_call, PROBES, SHORTS_REJECTED
+from config import PROBE_READ_SIZE, PROBE_MAX_HEADER, SHORTS_MAX_DURATION, SHORTS_REQUIRE_VERTICAL, SHORTS_ALLOW_UNPROBED
+
+logger = logging.getLogger('probe_utils')
+
+# Top-level ISO BMFF box types that identify an MP4/MOV file
+MP4_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'}
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+
+# Matroska/WebM element ids (with their length marker bits, as they appear in the file)
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+MKV_MASTERS = {EBML_HEADER, MKV_SEGMENT, MKV_INFO, MKV_TRACKS, MKV_TRACK_ENTRY, MKV_VIDEO}
+
+
+class ProbeError(Exception):
+    """The container header could not be read or parsed."""
+
+
+class _HeaderEnd(Exception):
+    """Reached the first Cluster: every Matroska header element comes before it."""
+
+
+def _read_range(drive_service, file_id, start, length):
+    """Fetch bytes start..start+length-1 of a Drive file with one ranged GET."""
+    request = drive_service.files().get_media(fileId=file_id)
+    request.headers['range'] = 'bytes=%d-%d' % (start, start + length - 1)
+    with api_call('drive.files.get_media.probe'):
+        return request.execute()[:length]
+
+
+# -- MP4 / MOV -------------------------------------------------------------------
+
+def _iter_boxes(buf, start, end):
+    """Yield (type, body_start, body_end) for the boxes in buf[start:end]; a truncated last box is cut at end."""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield kind, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _find_box(buf, start, end, path):
+    for kind, s, e in _iter_boxes(buf, start, end):
+        if kind == path[0]:
+            return (s, e) if len(path) == 1 else _find_box(buf, s, e, path[1:])
+    return None
+
+
+def _parse_tkhd(buf, s, e):
+    version = buf[s]
+    matrix = s + (52 if version == 1 else 40)
+    if matrix + 44 > e:
+        return None
+    a, b, _, c, d = struct.unpack_from('>iiiii', buf, matrix)
+    width, height = struct.unpack_from('>II', buf, matrix + 36)
+    width, height = width >> 16, height >> 16
+    if a == 0 and d == 0 and b and c:
+        # rotated 90/270 degrees (phones often store portrait clips as rotated landscape)
+        width, height = height, width
+    return width, height
+
+
+def _parse_trak(buf, s, e):
+    track = {}
+    box = _find_box(buf, s, e, [b'tkhd'])
+    if box:
+        dims = _parse_tkhd(buf, *box)
+        if dims:
+            track['width'], track['height'] = dims
+    box = _find_box(buf, s, e, [b'mdia', b'hdlr'])
+    if box and box[0] + 12 <= box[1]:
+        track['handler'] = buf[box[0] + 8:box[0] + 12]
+    box = _find_box(buf, s, e, [b'mdia', b'minf', b'stbl', b'stsd'])
+    if box and box[0] + 16 <= box[1]:
+        track['codec'] = buf[box[0] + 12:box[0] + 16].decode('latin-1').strip()
+    return track
+
+
+def _parse_moov(buf):
+    info = {'container': 'mp4'}
+    for kind, s, e in _iter_boxes(buf, 0, len(buf)):
+        if kind == b'mvhd' and s + 32 <= e:
+            if buf[s] == 1:
+                timescale, duration = struct.unpack_from('>IQ', buf, s + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', buf, s + 12)
+            if timescale:
+                info['duration'] = duration / timescale
+        elif kind == b'trak' and 'width' not in info:
+            track = _parse_trak(buf, s, e)
+            if track.get('handler') == b'vide' or (track.get('handler') is None and track.get('width')):
+                info.update(width=track.get('width'), height=track.get('height'), codec=track.get('codec'))
+    return info
+
+
+def probe_mp4(read, size, head):
+    """Locate the moov box with header-sized ranged reads (it may sit after mdat) and parse it."""
+    pos = 0
+    hops = 0
+    while pos + 8 <= size:
+        if pos + 16 <= len(head) or len(head) >= size:
+            hdr = head[pos:pos + 16]
+        else:
+            hops += 1
+            if hops > 16:
+                break
+            hdr = read(pos, min(16, size - pos))
+        if len(hdr) < 8:
+            break
+        box_size, kind = struct.unpack_from('>I4s', hdr)
+        header = 8
+        if box_size == 1 and len(hdr) >= 16:
+            box_size = struct.unpack_from('>Q', hdr, 8)[0]
+            header = 16
+        elif box_size == 0:
+            box_size = size - pos
+        if box_size < header:
+            break
+        if kind == b'moov':
+            start = pos + header
+            length = min(box_size - header, PROBE_MAX_HEADER)
+            body = head[start:start + length] if start + length <= len(head) else read(start, length)
+            return _parse_moov(body)
+        pos += box_size
+    raise ProbeError('no moov box found')
+
+
+# -- Matroska / WebM -------------------------------------------------------------
+
+def _vint(buf, pos, marker):
+    """Read an EBML variable-length integer; returns (value, next_pos). value is None for 'unknown size'."""
+    if pos >= len(buf):
+        raise ProbeError('truncated EBML data')
+    first = buf[pos]
+    if not first:
+        raise ProbeError('invalid EBML vint')
+    length = 9 - first.bit_length()
+    if pos + length > len(buf):
+        raise ProbeError('truncated EBML data')
+    value = first if marker else first & (0xFF >> length)
+    for b in buf[pos + 1:pos + length]:
+        value = (value << 8) | b
+    if not marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, pos + length
+
+
+def _walk_ebml(buf, start, end, info, track):
+    pos = start
+    while pos < end:
+        try:
+            element, pos = _vint(buf, pos, marker=True)
+            size, pos = _vint(buf, pos, marker=False)
+        except ProbeError:
+            return
+        if element == MKV_CLUSTER:
+            raise _HeaderEnd()
+        stop = end if size is None else min(pos + size, end)
+        data = buf[pos:stop]
+        if element in MKV_MASTERS:
+            if element == MKV_TRACK_ENTRY:
+                entry = {}
+                _walk_ebml(buf, pos, stop, info, entry)
+                if entry.get('type') == 1 and 'width' not in info:
+                    info.update(width=entry.get('width'), height=entry.get('height'), codec=entry.get('codec'))
+            else:
+                _walk_ebml(buf, pos, stop, info, track)
+        elif element == EBML_DOCTYPE:
+            info['container'] = data.decode('ascii', 'replace')
+        elif element == MKV_TIMECODE_SCALE:
+            info['_scale'] = int.from_bytes(data, 'big')
+        elif element == MKV_DURATION and len(data) in (4, 8):
+            info['_duration'] = struct.unpack('>f' if len(data) == 4 else '>d', data)[0]
+        elif element == MKV_TRACK_TYPE:
+            track['type'] = int.from_bytes(data, 'big')
+        elif element == MKV_CODEC_ID:
+            track['codec'] = data.decode('ascii', 'replace').rstrip('\x00')
+        elif element == MKV_PIXEL_WIDTH:
+            track['width'] = int.from_bytes(data, 'big')
+        elif element == MKV_PIXEL_HEIGHT:
+            track['height'] = int.from_bytes(data, 'big')
+        if size is None or pos + size > end:
+            return
+        pos += size
+
+
+def parse_ebml(buf):
+    info = {'container': 'matroska'}
+    try:
+        _walk_ebml(buf, 0, len(buf), info, {})
+    except _HeaderEnd:
+        pass
+    if '_duration' in info:
+        info['duration'] = info['_duration'] * info.get('_scale', 1000000) / 1e9
+    info.pop('_duration', None)
+    info.pop('_scale', None)
+    return info
+
+
+def probe_ebml(read, size, head):
+    info = parse_ebml(head)
+    if 'width' not in info and len(head) < size:
+        # Tracks did not fit in the first read (large SeekHead/attachments): read further once
+        info = parse_ebml(read(0, min(size, PROBE_MAX_HEADER)))
+    if 'width' not in info and 'duration' not in info:
+        raise ProbeError('no Info/Tracks elements in EBML header')
+    return info
+
+
+# -- public API ------------------------------------------------------------------
+
+def probe_video(drive_service, meta):
+    """Read duration, resolution and codec of a Drive video from its container header.
+
+    meta is a Drive file dict with id and size. Only a few KB are read unless the moov box
+    sits behind mdat, in which case one extra header read per top-level box is needed.
+    """
+    file_id = meta['id']
+    size = int(meta.get('size') or 0)
+    if not size:
+        raise ProbeError('Drive reported no size for %s' % file_id)
+
+    def read(start, length):
+        return _read_range(drive_service, file_id, start, length)
+
+    with span('probe', file_id=file_id):
+        head = read(0, min(PROBE_READ_SIZE, size))
+        if head[:4] == EBML_MAGIC:
+            return probe_ebml(read, size, head)
+        if head[4:8] in MP4_BOXES:
+            return probe_mp4(read, size, head)
+    raise ProbeError('unsupported container for %s' % meta.get('name', file_id))
+
+
+def get_probe(drive_service, meta, index=None):
+    """Probe result for meta, from the index cache when md5/modifiedTime still match."""
+    if index is None:
+        from index_utils import get_folder_index
+        index = get_folder_index()
+    cached = index.get_probe(meta['id'], meta.get('md5Checksum'), meta.get('modifiedTime'))
+    if cached is not None:
+        PROBES.inc(result='cached')
+        return cached
+    try:
+        info = probe_video(drive_service, meta)
+        PROBES.inc(result='probed')
+    except Exception as e:
+        logger.warning('Could not probe %s (%s): %s', meta.get('name'), meta['id'], e)
+        PROBES.inc(result='failed')
+        info = {'error': str(e)[:200]}
+        from transfer_utils import retry_reason
+        if retry_reason(e) is not None:
+            return info  # network trouble or a 5xx: probe again next time instead of caching the failure
+    index.save_probe(meta['id'], meta.get('md5Checksum'), meta.get('modifiedTime'), info)
+    return info
+
+
+def shorts_rejection(info):
+    """Return why a probed video cannot be a Short (None if it can, or if unknown and allowed)."""
+    if info.get('error') or (info.get('duration') is None and not info.get('width')):
+        return None if SHORTS_ALLOW_UNPROBED else 'unprobed'
+    if info.get('duration') is not None and info['duration'] > SHORTS_MAX_DURATION:
+        return 'too_long'
+    if SHORTS_REQUIRE_VERTICAL and info.get('width') and info.get('height') and info['width'] > info['height']:
+        return 'landscape'
+    return None
+
+
+def shorts_filter(drive_service, index=None):
+    """Return accept(meta) for the pickers: True if the file passes the Shorts constraints."""
+    def accept(meta):
+        info = get_probe(drive_service, meta, index)
+        reason = shorts_rejection(info)
+        if reason:
+            SHORTS_REJECTED.inc(reason=reason)
+            logger.info('Skipping %s: not Shorts-eligible (%s, duration=%s, %sx%s)', meta.get('name'), reason,
+                        info.get('duration'), info.get('width'), info.get('height'))
+            return False
+        return True
+    return accept
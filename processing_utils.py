@@ -0,0 +1,116 @@
+import time
+import logging
+from config import STATUS_POLL_INITIAL, STATUS_POLL_MAX_DELAY, STATUS_POLL_MAX_AGE, STATUS_POLL_MAX_CALLS
+from auth_utils import load_credentials
+from client_utils import client_pool
+from ledger_utils import get_ledger
+from quota_utils import quota_ledger, API_COSTS
+from metrics_utils import span, api_call, PROCESSING_RESULTS
+
+logger = logging.getLogger('processing_utils')
+
+# videos.list accepts at most 50 ids per call
+BATCH_SIZE = 50
+FAILED_UPLOAD_STATUS = ('failed', 'rejected', 'deleted')
+FAILED_PROCESSING_STATUS = ('failed', 'terminated')
+# checks a video may be absent from videos.list (still propagating) before it counts as missing
+MISSING_AFTER = 3
+
+
+def classify(item):
+    """Map a videos.list item to (state, detail, seconds_left): state is None while YouTube is still processing."""
+    status = item.get('status') or {}
+    details = item.get('processingDetails') or {}
+    upload = status.get('uploadStatus')
+    processing = details.get('processingStatus')
+    if upload in FAILED_UPLOAD_STATUS:
+        return upload, status.get('failureReason') or status.get('rejectionReason'), None
+    if processing in FAILED_PROCESSING_STATUS:
+        return 'failed', details.get('processingFailureReason') or processing, None
+    if upload == 'processed' or processing == 'succeeded':
+        return 'processed', None, None
+    left = (details.get('processingProgress') or {}).get('timeLeftMs')
+    return None, processing or upload, int(left) / 1000.0 if left else None
+
+
+def next_delay(checks, seconds_left=None):
+    """Exponential backoff per video, cut short when YouTube says processing finishes sooner."""
+    delay = min(STATUS_POLL_MAX_DELAY, STATUS_POLL_INITIAL * 2 ** checks)
+    if seconds_left:
+        delay = max(STATUS_POLL_INITIAL, min(delay, seconds_left))
+    return delay
+
+
+class ProcessingPoller:
+    """Checks the YouTube processing state of every pending upload in the ledger.
+
+    Due video ids from all jobs are grouped into videos.list calls of up to 50 ids (1 quota
+    unit each); each video's next check backs off until it is processed, failed, or rejected.
+    """
+
+    def __init__(self, ledger=None):
+        self._ledger = ledger
+
+    @property
+    def ledger(self):
+        return self._ledger or get_ledger()
+
+    def poll(self, youtube_service=None):
+        """Check every due upload once. Returns the number of videos that settled."""
+        due = self.ledger.due_for_check(BATCH_SIZE * STATUS_POLL_MAX_CALLS)
+        if not due:
+            return 0
+        if youtube_service is not None:
+            return self._poll(youtube_service, due)
+        creds = load_credentials()
+        if not creds:
+            logger.info('No credentials available; skipping processing status check')
+            return 0
+        with client_pool.lease(creds) as (_, youtube_service):
+            return self._poll(youtube_service, due)
+
+    def _poll(self, youtube_service, due):
+        settled = 0
+        with span('processing_status', videos=len(due)):
+            for i in range(0, len(due), BATCH_SIZE):
+                if not quota_ledger.can_afford(API_COSTS['videos.list']):
+                    logger.info('No quota left for processing status checks')
+                    break
+                batch = due[i:i + BATCH_SIZE]
+                with api_call('youtube.videos.list.status'):
+                    res = youtube_service.videos().list(part='status,processingDetails', id=','.join(v[0] for v in batch),
+                                                        maxResults=BATCH_SIZE).execute()
+                quota_ledger.charge('videos.list')
+                items = {item['id']: item for item in res.get('items', [])}
+                for video_id, uploaded_at, checks in batch:
+                    settled += self._record(video_id, uploaded_at, checks, items.get(video_id))
+        if settled:
+            logger.info('Processing status: %d of %d checked uploads settled', settled, len(due))
+        return settled
+
+    def _record(self, video_id, uploaded_at, checks, item):
+        now = time.time()
+        if item is None:
+            state, detail, left = ('missing', 'not returned by videos.list', None) if checks + 1 >= MISSING_AFTER else (None, 'not found yet', None)
+        else:
+            state, detail, left = classify(item)
+        if state is None and now - uploaded_at > STATUS_POLL_MAX_AGE:
+            state = 'timeout'
+        if state is None:
+            self.ledger.record_state(video_id, 'pending', detail, now + next_delay(checks, left))
+            return 0
+        self.ledger.record_state(video_id, state, detail)
+        PROCESSING_RESULTS.inc(state=state)
+        log = logger.info if state == 'processed' else logger.warning
+        log('Video %s settled as %s%s', video_id, state, ' (%s)' % detail if detail else '')
+        return 1
+
+    def run(self):
+        """Scheduler entry point: never raises."""
+        try:
+            self.poll()
+        except Exception:
+            logger.exception('Processing status check failed')
+
+
+processing_poller = ProcessingPoller()
@@ -0,0 +1,219 @@
+import os
+import json
+import logging
+import threading
+import contextlib
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from config import QUOTA_DAILY_LIMIT, QUOTA_STATE_FILE
+from coordination_utils import process_id, process_alive, file_lock, write_json
+
+logger = logging.getLogger('quota_utils')
+
+# YouTube Data API quota resets at midnight Pacific time
+QUOTA_TZ = ZoneInfo('America/Los_Angeles')
+
+# Unit cost of every YouTube Data API call this project makes
+API_COSTS = {
+    'videos.insert': 1600,
+    'videos.list': 1,
+    'thumbnails.set': 50,
+}
+
+# Units one scheduled upload needs: the insert plus the trending tags lookup
+UPLOAD_COST = API_COSTS['videos.insert'] + API_COSTS['videos.list']
+
+
+class QuotaExceeded(Exception):
+    """Not enough YouTube quota left today for the requested operation."""
+
+
+def quota_day(now=None):
+    return (now or datetime.now(QUOTA_TZ)).astimezone(QUOTA_TZ).date().isoformat()
+
+
+def is_quota_error(exc):
+    """True for a googleapiclient HttpError caused by exhausted quota."""
+    resp = getattr(exc, 'resp', None)
+    if getattr(resp, 'status', None) != 403:
+        return False
+    return 'quotaExceeded' in str(getattr(exc, 'content', b'')) or 'dailyLimitExceeded' in str(getattr(exc, 'content', b''))
+
+
+class Reservation:
+    """Units held by QuotaLedger.reserve(); calls charged while it is open are drawn from it."""
+
+    def __init__(self, units):
+        self.units = units      # still held, not yet spent
+
+
+class QuotaLedger:
+    """Per-day YouTube quota accounting, persisted to QUOTA_STATE_FILE.
+
+    used counts units of calls already made; reserved counts units promised to uploads
+    that have been admitted but not finished, so concurrent jobs cannot overbook. A call
+    charged inside reserve() moves its units from reserved to used instead of counting twice.
+
+    The state file is the one budget of every worker process: each operation rereads it
+    under a file lock, and reservations are kept per process so those of a process that
+    died mid-upload are dropped.
+    """
+
+    def __init__(self, limit=QUOTA_DAILY_LIMIT, path=QUOTA_STATE_FILE):
+        self.limit = limit
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = self._load()
+        self._local = threading.local()     # the innermost open Reservation of each thread
+
+    def _fresh(self, day, reserved=None):
+        return {'day': day, 'used': 0, 'calls': {}, 'exhausted': False, 'reserved': reserved or {}}
+
+    def _load(self):
+        day = quota_day()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+                reserved = {p: u for p, u in state.get('reserved', {}).items() if process_alive(p)}
+                if state.get('day') == day:
+                    state['reserved'] = reserved
+                    return state
+                # uploads admitted before midnight still hold their units
+                return self._fresh(day, reserved)
+            except Exception:
+                logger.exception('Failed to read quota state %s; starting fresh', self.path)
+        return self._fresh(day)
+
+    def _save_locked(self):
+        if self.path:
+            write_json(self.path, self._state)
+
+    def _roll_locked(self):
+        day = quota_day()
+        if self._state['day'] != day:
+            logger.info('Quota day rolled over to %s (used %d units on %s)', day, self._state['used'], self._state['day'])
+            self._state = self._fresh(day, self._state['reserved'])
+
+    @contextlib.contextmanager
+    def _locked(self, save=True):
+        """Hold the ledger (threads and processes) with self._state reread from the state file."""
+        with self._lock, (file_lock(self.path) if self.path else contextlib.nullcontext()):
+            if self.path:
+                self._state = self._load()
+            self._roll_locked()
+            yield
+            if save:
+                self._save_locked()
+
+    def _hold_locked(self, units):
+        reserved, owner = self._state['reserved'], process_id()
+        reserved[owner] = reserved.get(owner, 0) + units
+        if reserved[owner] <= 0:
+            del reserved[owner]
+
+    def charge(self, method, units=None, reservation=None):
+        """Record one API call of method (a key of API_COSTS).
+
+        The units are debited from reservation, or else from the reservation this thread
+        holds open, as far as it still covers them.
+        """
+        units = API_COSTS.get(method, 0) if units is None else units
+        reservation = reservation or getattr(self._local, 'reservation', None)
+        with self._locked():
+            if reservation is not None:
+                held = min(units, reservation.units)
+                reservation.units -= held
+                self._hold_locked(-held)
+            self._state['used'] += units
+            calls = self._state['calls']
+            calls[method] = calls.get(method, 0) + 1
+
+    def current_reservation(self):
+        """The innermost Reservation this thread holds open, or None; for charges made from another thread."""
+        return getattr(self._local, 'reservation', None)
+
+    def mark_exhausted(self):
+        """The API answered quotaExceeded: treat today's budget as spent whatever our count says."""
+        with self._locked():
+            self._state['exhausted'] = True
+        logger.warning('YouTube reported quota exhausted; deferring uploads until Pacific midnight')
+
+    def remaining(self):
+        with self._locked(save=False):
+            return self._remaining_locked()
+
+    def _remaining_locked(self):
+        if self._state['exhausted']:
+            return 0
+        return max(0, self.limit - self._state['used'] - sum(self._state['reserved'].values()))
+
+    def can_afford(self, units):
+        return self.remaining() >= units
+
+    @contextlib.contextmanager
+    def reserve(self, units=UPLOAD_COST):
+        """Hold units for the duration of an operation; raises QuotaExceeded up front if they are not available.
+
+        Yields the Reservation; charge() calls made meanwhile draw it down.
+        """
+        with self._locked():
+            if self._remaining_locked() < units:
+                raise QuotaExceeded('need %d quota units, %d left today' % (units, self._remaining_locked()))
+            self._hold_locked(units)
+        reservation = Reservation(units)
+        outer = getattr(self._local, 'reservation', None)
+        self._local.reservation = reservation
+        try:
+            yield reservation
+        finally:
+            self._local.reservation = outer
+            with self._locked():
+                self._hold_locked(-reservation.units)
+
+    def snapshot(self):
+        with self._locked(save=False):
+            state = dict(self._state)
+            state.update(limit=self.limit, reserved=sum(self._state['reserved'].values()), remaining=self._remaining_locked())
+            return state
+
+
+quota_ledger = QuotaLedger()
+
+
+class UploadPlanner:
+    """Decides which queued scheduled upload may start given the remaining quota.
+
+    While the budget covers every pending run, runs are admitted in queue order. When it only
+    covers some, targets that have uploaded least today go first; runs that cannot fit are
+    deferred (left queued) until the quota resets.
+    """
+
+    def __init__(self, ledger=quota_ledger, cost=UPLOAD_COST):
+        self.ledger = ledger
+        self.cost = cost
+        self._uploads_today = {}
+        self._day = quota_day()
+
+    def _roll(self):
+        day = quota_day()
+        if day != self._day:
+            self._day = day
+            self._uploads_today = {}
+
+    def affordable_runs(self):
+        return self.ledger.remaining() // self.cost
+
+    def order(self, candidates, pending_total):
+        """Return candidates (objects with .id) in the order they should be admitted, or [] to defer all."""
+        self._roll()
+        budget = self.affordable_runs()
+        if budget <= 0:
+            return []
+        if budget >= pending_total:
+            return list(candidates)
+        return sorted(candidates, key=lambda t: self._uploads_today.get(t.id, 0))
+
+    def record_run(self, target_id):
+        self._roll()
+        self._uploads_today[target_id] = self._uploads_today.get(target_id, 0) + 1
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import logging
+import threading
+import google_auth_httplib2
+from googleapiclient.http import build_http
+from config import UPLOAD_STATE_FILE
+from coordination_utils import process_id, process_alive, file_lock, write_json
+from client_utils import client_pool
+from drive_utils import download_drive_tail_to_spooled
+from youtube_utils import upload_video_from_fileobj, query_upload_offset
+
+logger = logging.getLogger('resume_utils')
+
+
+class UploadStateStore:
+    """Small JSON store of in-flight resumable upload sessions, keyed by Drive file id.
+
+    Shared by the worker processes of one host: every change rereads the file under a file
+    lock, and each record names the process (owner) whose upload it is.
+    """
+
+    def __init__(self, path=UPLOAD_STATE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except Exception:
+            logger.exception('Failed to read upload state file %s; ignoring it', self.path)
+            return {}
+
+    def _write(self, data):
+        write_json(self.path, data, fsync=True)
+
+    def all(self):
+        with self._lock, file_lock(self.path):
+            return self._read()
+
+    def save(self, file_id, **fields):
+        with self._lock, file_lock(self.path):
+            data = self._read()
+            record = data.get(file_id, {})
+            record.update(fields)
+            record['file_id'] = file_id
+            record['owner'] = process_id()
+            record['updated'] = time.time()
+            data[file_id] = record
+            self._write(data)
+
+    def clear(self, file_id):
+        with self._lock, file_lock(self.path):
+            data = self._read()
+            if data.pop(file_id, None) is not None:
+                self._write(data)
+
+    def release(self, file_id):
+        """Drop this process's claim on a session so the next resume pass (in any worker) retries it."""
+        with self._lock, file_lock(self.path):
+            data = self._read()
+            if file_id in data:
+                data[file_id]['owner'] = None
+                self._write(data)
+
+    def claim_orphans(self):
+        """Take over the sessions whose owning process is gone; returns their records."""
+        with self._lock, file_lock(self.path):
+            data = self._read()
+            claimed = []
+            for record in data.values():
+                if not process_alive(record.get('owner')):
+                    record['owner'] = process_id()
+                    claimed.append(dict(record))
+            if claimed:
+                self._write(data)
+            return claimed
+
+
+class _Tail:
+    """A spool holding bytes base.. of a file, read and seeked by offsets in the whole file."""
+
+    def __init__(self, f, base):
+        self.f = f
+        self.base = base
+
+    def seek(self, pos, whence=0):
+        if whence == 0:
+            pos = max(pos - self.base, 0)
+        return self.f.seek(pos, whence) + self.base
+
+    def tell(self):
+        return self.f.tell() + self.base
+
+    def read(self, n=-1):
+        return self.f.read(n)
+
+
+_store = UploadStateStore()
+
+
+def get_state_store():
+    return _store
+
+
+def session_recorder(file_id, title, description, tags=None, privacy='public', store=None):
+    """Build a progress_callback for upload_video_from_media that persists the session after each chunk."""
+    store = store or _store
+    saved = {'uri': None}
+
+    def record(session_uri, offset, size):
+        if not session_uri:
+            return
+        if saved['uri'] != session_uri:
+            # first chunk of a session: store everything needed to recreate the request
+            store.save(file_id, session_uri=session_uri, offset=offset, size=size, title=title,
+                       description=description, tags=tags or [], privacy=privacy)
+            saved['uri'] = session_uri
+        else:
+            store.save(file_id, offset=offset)
+
+    return record
+
+
+def resume_upload(creds, record, store=None):
+    """Continue one persisted upload session. Returns the video id, or None if the session is gone."""
+    store = store or _store
+    file_id = record['file_id']
+    session_uri = record['session_uri']
+    size = record.get('size')
+    # build_http: a plain httplib2.Http follows the session's 308 as a redirect
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+    offset, response = query_upload_offset(http, session_uri, size)
+    if response is not None:
+        logger.info('Persisted upload of %s had already completed: video id=%s', file_id, response.get('id'))
+        store.clear(file_id)
+        return response.get('id')
+    if offset is None:
+        logger.warning('Upload session for %s expired; dropping persisted state', file_id)
+        store.clear(file_id)
+        return None
+
+    logger.info('Resuming upload of Drive file %s at byte %d of %s', file_id, offset, size)
+    recorder = session_recorder(file_id, record.get('title'), record.get('description'), record.get('tags'),
+                                record.get('privacy', 'public'), store=store)
+    with client_pool.lease(creds) as (drive_service, youtube_service):
+        # only the bytes the session has not committed are fetched again
+        with download_drive_tail_to_spooled(drive_service, file_id, offset, size) as sp:
+            video_id = upload_video_from_fileobj(youtube_service, _Tail(sp, offset), record.get('title'), record.get('description'),
+                                                 tags=record.get('tags'), privacy=record.get('privacy', 'public'),
+                                                 progress_callback=recorder, resume_uri=session_uri, resume_offset=offset)
+    store.clear(file_id)
+    logger.info('Resumed upload finished: video id=%s', video_id)
+    return video_id
+
+
+def resume_pending_uploads(creds, store=None):
+    """Resume the persisted sessions of processes that died mid-upload.
+
+    Sessions still owned by a live worker are left alone. Failures are logged and left in the
+    store for the next resume pass.
+    """
+    store = store or _store
+    results = {}
+    for record in store.claim_orphans():
+        file_id = record['file_id']
+        try:
+            results[file_id] = resume_upload(creds, record, store=store)
+        except Exception:
+            logger.exception('Failed to resume upload of %s', file_id)
+            store.release(file_id)
+    return results
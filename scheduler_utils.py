@@ -1,26 +1,127 @@
 # scheduler_utils.py  (patched)
 import os
+import uuid
+import time
+import atexit
+import sqlite3
 import logging
-from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-from config import SCHED_HOURS, SCHED_TEST_MODE  # add SCHED_TEST_MODE=True for testing if desired
-from drive_utils import build_drive_service, pick_random_video_from_folder, download_drive_file_to_spooled
-from youtube_utils import build_youtube_service, upload_video_from_fileobj
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from config import SCHED_HOURS, SCHED_TEST_MODE, SCHED_WORKERS, SCHED_TARGET_CONCURRENCY, SCHED_MAX_PENDING  # add SCHED_TEST_MODE=True for testing if desired
+from config import PREFETCH_ENABLED, PREFETCH_DEPTH, PREFETCH_IDLE_WAIT, STATUS_POLL_ENABLED, STATUS_POLL_INTERVAL, SCHED_COORDINATION, THUMB_AUTO_PICK
+from drive_utils import pick_random_video_from_folder, return_pick, get_file_metadata, find_sibling_image, FILE_FIELDS
+from client_utils import client_pool
+from stream_utils import transfer_drive_to_youtube
 from tags_utils import fetch_trending_hashtags
 from auth_utils import load_credentials
+from resume_utils import resume_pending_uploads
+from ledger_utils import get_ledger
+from processing_utils import processing_poller
+from staging_utils import get_staging_cache
+from quota_utils import quota_ledger, QuotaExceeded, UploadPlanner, QUOTA_TZ, API_COSTS
+from thumbnail_utils import thumbnail_pipeline, upload_thumbnail
+from metrics_utils import span, SCHEDULER_LAG, SCHEDULER_PENDING, SCHEDULER_ACTIVE
+from coordination_utils import get_shared_store, LeaderElector
 from flask import current_app
 
 logger = logging.getLogger('scheduler_utils')
 logging.getLogger('apscheduler').setLevel(logging.INFO)
 
+# Target id used by the single-folder start()/stop() API
+DEFAULT_TARGET_ID = 'auto_upload'
+# Lease held by the one process that runs the scheduler
+LEASE_NAME = 'scheduler'
+
+
+class UploadTarget:
+    """One scheduled (folder, region, interval) entry."""
+
+    def __init__(self, target_id, folder_id, region='US', interval=SCHED_HOURS, concurrency=SCHED_TARGET_CONCURRENCY):
+        self.id = target_id
+        self.folder_id = folder_id
+        self.region = region
+        self.interval = interval
+        self.concurrency = max(1, int(concurrency))
+        self.pending = deque()   # enqueue timestamps of runs waiting for a worker
+        self.running = 0
+        self.runs = 0
+        self.last_result = None
+        self.last_finished = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'folder_id': self.folder_id,
+            'region': self.region,
+            'interval': self.interval,
+            'concurrency': self.concurrency,
+            'pending': len(self.pending),
+            'running': self.running,
+            'runs': self.runs,
+            'last_result': self.last_result,
+            'last_finished': self.last_finished,
+        }
+
+
 class AutoUploader:
-    def __init__(self, app=None):
+    """Runs scheduled uploads for many targets on one bounded worker pool.
+
+    APScheduler only enqueues a run for its target; runs are dispatched round-robin across
+    targets (fair queueing) onto SCHED_WORKERS threads, with at most target.concurrency
+    runs of one target in flight and at most SCHED_MAX_PENDING runs waiting per target.
+
+    With PREFETCH_ENABLED each target's next pick is downloaded into the staging cache on a
+    single prefetch thread, only while no upload is running, so a run can start uploading at once.
+
+    With SCHED_COORDINATION targets live in the shared store and only the process holding the
+    scheduler lease runs APScheduler; any process can add, remove or list targets. A new leader
+    loads the targets with their next tick, so ticks missed during a handover run at once.
+    Runs already in flight on a leader that loses its lease finish; no new ones start there.
+    """
+
+    def __init__(self, app=None, workers=SCHED_WORKERS, store=None):
         self.app = app
-        self.scheduler = BackgroundScheduler()
-        self.job = None
-        self.folder_id = None
-        self.region = None
+        self._store = store
+        self.elector = None
+        self._synced_version = None
+        self._scheduler = None
+        self._scheduler_lock = threading.Lock()
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload-worker')
+        self.targets = OrderedDict()
+        self.planner = UploadPlanner()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._deferred = False
+        self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._prefetching = set()
+        self._unstaged = {}              # folder_id -> deque of prefetched picks too large to stage
+        self._idle = threading.Event()   # set while no upload is running
+        self._idle.set()
+
+    @property
+    def scheduler(self):
+        """The APScheduler instance, created (and APScheduler imported) on first use."""
+        if self._scheduler is None:
+            with self._scheduler_lock:
+                if self._scheduler is None:
+                    from apscheduler.schedulers.background import BackgroundScheduler
+                    self._scheduler = BackgroundScheduler()
+        return self._scheduler
+
+    @property
+    def store(self):
+        if self._store is None and SCHED_COORDINATION:
+            self._store = get_shared_store()
+        return self._store
+
+    def _leads(self):
+        """Whether this process runs the scheduled targets (always, without coordination)."""
+        if self.store is None:
+            return True
+        return self.elector is not None and self.elector.is_leader
 
     def init_app(self, app):
         """Register app and ensure scheduler starts only in the proper process."""
@@ -31,118 +132,487 @@ class AutoUploader:
             logger.info("App in debug mode and not in reloader child; scheduler will not start here.")
             return
 
-        if not self.scheduler.running:
-            self.scheduler.start()
-            logger.info("Scheduler started")
+        if self.store is not None:
+            # every worker process campaigns; the lease holder starts APScheduler, the rest only serve requests
+            self.elector = LeaderElector(self.store, LEASE_NAME, self._become_leader, self._step_down, on_tick=self._sync_targets)
+            self.elector.start()
+            # a clean worker exit hands the lease over at once instead of after SCHED_LEASE_TTL
+            atexit.register(self.elector.stop)
+        else:
+            # APScheduler is imported and started off the startup path; jobs added meanwhile wait for the start
+            threading.Thread(target=self._start_scheduler, name='scheduler-start', daemon=True).start()
 
         # Optionally attach shutdown hook
         @app.teardown_appcontext
         def shutdown_scheduler(exc):
-            if self.scheduler.running:
+            if self._scheduler is not None and self._scheduler.running:
                 # do not shutdown here on every request; only if app itself is stopping
                 # (this handler is safest-in-practice but only called on app context teardown)
                 pass
 
-    def start(self, folder_id, region='US', run_immediately=False):
-        """Start the recurring job.
-        - folder_id: Drive folder to pick from
-        - region: For trending hashtags
-        - run_immediately: if True schedule first run now (useful for testing)
-        """
-        self.folder_id = folder_id
-        self.region = region
+    def _start_scheduler(self):
+        from apscheduler.events import EVENT_JOB_SUBMITTED
+        from apscheduler.triggers.cron import CronTrigger
+        from apscheduler.triggers.interval import IntervalTrigger
+        if not self.scheduler.running:
+            self.scheduler.add_listener(self._on_job_submitted, EVENT_JOB_SUBMITTED)
+            self.scheduler.start()
+            logger.info("Scheduler started")
+
+        # Finish any upload session interrupted by a previous crash/restart (runs once, off the startup path)
+        self.scheduler.add_job(func=self._resume_wrapper, id='resume_uploads', replace_existing=True,
+                               next_run_time=datetime.now(), misfire_grace_time=None)
+
+        # Runs deferred for lack of quota are dispatched again right after the Pacific midnight reset
+        self.scheduler.add_job(func=self._dispatch, trigger=CronTrigger(hour=0, minute=1, timezone=QUOTA_TZ),
+                               id='quota_reset', replace_existing=True)
+
+        # YouTube processing state of finished uploads, checked in batches of up to 50 ids
+        if STATUS_POLL_ENABLED:
+            self.scheduler.add_job(func=processing_poller.run, trigger=IntervalTrigger(seconds=STATUS_POLL_INTERVAL),
+                                   id='processing_status', replace_existing=True, max_instances=1, coalesce=True)
+
+    # -- leadership -----------------------------------------------------------
 
-        if self.job:
-            self.stop()
+    def _become_leader(self):
+        from apscheduler.schedulers.base import STATE_PAUSED
+        self._start_scheduler()
+        if self.scheduler.state == STATE_PAUSED:
+            self.scheduler.resume()
+        self._synced_version = None
+        self._sync_targets()
 
+    def _step_down(self):
+        from apscheduler.schedulers.base import STATE_RUNNING
+        if self._scheduler is not None and self._scheduler.state == STATE_RUNNING:
+            self._scheduler.pause()
+        with self._lock:
+            for target_id in list(self.targets):
+                self._remove_locked(target_id)
+        self._synced_version = None
+        logger.info('Scheduler paused; another process leads now')
+
+    def _sync_targets(self):
+        """Leader: make the scheduled targets match the shared store (cheap while nothing changed)."""
+        version = self.store.targets_version()
+        if version == self._synced_version:
+            return
+        rows = self.store.load_targets()
+        wanted = {row['id']: row for row in rows}
+        with self._lock:
+            for target_id in [t for t in self.targets if t not in wanted]:
+                self._remove_locked(target_id)
+            current = dict(self.targets)
+        for row in rows:
+            target = current.get(row['id'])
+            if target is not None and (target.folder_id, target.region, target.interval, target.concurrency) == \
+                    (row['folder_id'], row['region'], row['interval'], row['concurrency']):
+                continue
+            target = UploadTarget(row['id'], row['folder_id'], region=row['region'], interval=row['interval'],
+                                  concurrency=row['concurrency'])
+            target.runs, target.last_result, target.last_finished = row['runs'], row['last_result'], row['last_finished']
+            self._schedule_target(target, row['next_run'])
+        self._synced_version = version
+
+    # -- target management ----------------------------------------------------
+
+    @staticmethod
+    def _interval_seconds(interval):
+        return interval * (60 if getattr(__import__('config'), 'SCHED_TEST_MODE', False) else 3600)
+
+    def _make_trigger(self, interval):
+        from apscheduler.triggers.interval import IntervalTrigger
         # Decide interval trigger unit: use hours normally; support test mode minutes
         if getattr(__import__('config'), 'SCHED_TEST_MODE', False):
-            trigger = IntervalTrigger(minutes=SCHED_HOURS)
-            logger.info("Using minutes trigger (test mode). Interval: %s minutes", SCHED_HOURS)
-        else:
-            trigger = IntervalTrigger(hours=SCHED_HOURS)
-            logger.info("Using hours trigger. Interval: %s hours", SCHED_HOURS)
+            logger.info("Using minutes trigger (test mode). Interval: %s minutes", interval)
+            return IntervalTrigger(minutes=interval)
+        logger.info("Using hours trigger. Interval: %s hours", interval)
+        return IntervalTrigger(hours=interval)
 
-        next_run = datetime.now() if run_immediately else None
+    def add_target(self, folder_id, region='US', interval=SCHED_HOURS, concurrency=SCHED_TARGET_CONCURRENCY,
+                   target_id=None, run_immediately=False):
+        """Schedule uploads from folder_id every interval hours. Returns the target id."""
+        target_id = target_id or uuid.uuid4().hex[:12]
+        target = UploadTarget(target_id, folder_id, region=region, interval=interval, concurrency=concurrency)
+        next_run = time.time() if run_immediately else None
+        if self.store is not None:
+            next_run = time.time() + (0 if run_immediately else self._interval_seconds(interval))
+            self.store.save_target(target_id, folder_id, region, interval, target.concurrency, next_run)
+            if not self._leads():
+                logger.info('Upload target %s saved; the scheduler leader picks it up', target_id)
+                return target_id
+        self._schedule_target(target, next_run)
+        return target_id
 
-        # Add job with safety parameters
-        self.job = self.scheduler.add_job(
-            func=self._job_wrapper,
-            trigger=trigger,
-            id='auto_upload',
+    def _schedule_target(self, target, next_run=None):
+        """Add target to APScheduler; next_run (epoch seconds) is the first tick, moved up to now if already past."""
+        target_id = target.id
+        with self._lock:
+            if target_id in self.targets:
+                self._remove_locked(target_id)
+            self.targets[target_id] = target
+
+        job_kwargs = {}
+        if next_run is not None:
+            job_kwargs['next_run_time'] = datetime.fromtimestamp(max(next_run, time.time()))
+        self.scheduler.add_job(
+            func=self._enqueue,
+            trigger=self._make_trigger(target.interval),
+            id=self._job_id(target_id),
             replace_existing=True,
-            next_run_time=next_run,
             max_instances=1,
             coalesce=True,
             misfire_grace_time=600,
-            args=[]
+            args=[target_id],
+            **job_kwargs
         )
-        logger.info('AutoUploader started for folder %s, next_run=%s', folder_id, str(next_run))
-        logger.debug("Scheduled jobs: %s", self.scheduler.get_jobs())
+        logger.info('Upload target %s added: folder=%s region=%s interval=%s', target_id, target.folder_id, target.region,
+                    target.interval)
+        self._schedule_prefetch(target)
+
+    def remove_target(self, target_id):
+        removed = self.store.delete_target(target_id) if self.store is not None else False
+        with self._lock:
+            return self._remove_locked(target_id) or removed
+
+    def _remove_locked(self, target_id):
+        target = self.targets.pop(target_id, None)
+        if target is None:
+            return False
+        target.pending.clear()
+        try:
+            self.scheduler.remove_job(self._job_id(target_id))
+            logger.info("Removed job %s", self._job_id(target_id))
+        except Exception:
+            logger.exception("Error removing job")
+        self._update_status_locked()
+        return True
+
+    def list_targets(self):
+        if not self._leads():
+            # pending/running are only known to the leader process
+            items = []
+            for row in self.store.load_targets():
+                item = {k: row[k] for k in ('id', 'folder_id', 'region', 'interval', 'concurrency', 'runs', 'last_result', 'last_finished')}
+                item.update(pending=None, running=None, next_run_time=datetime.fromtimestamp(row['next_run']).astimezone().isoformat()
+                            if row['next_run'] else None)
+                items.append(item)
+            return items
+        with self._lock:
+            items = [t.to_dict() for t in self.targets.values()]
+        for item in items:
+            # before the scheduler exists (startup) nothing has a next run yet
+            job = self._scheduler.get_job(self._job_id(item['id'])) if self._scheduler is not None else None
+            next_run = getattr(job, 'next_run_time', None) if job else None
+            item['next_run_time'] = next_run.isoformat() if next_run else None
+        return items
+
+    @staticmethod
+    def _job_id(target_id):
+        return target_id if target_id == DEFAULT_TARGET_ID else f'target:{target_id}'
+
+    def start(self, folder_id, region='US', run_immediately=False):
+        """Start the recurring job for a single folder (kept for the original single-target API).
+        - folder_id: Drive folder to pick from
+        - region: For trending hashtags
+        - run_immediately: if True schedule first run now (useful for testing)
+        """
+        self.add_target(folder_id, region=region, target_id=DEFAULT_TARGET_ID, run_immediately=run_immediately)
 
     def stop(self):
-        if self.job:
-            try:
-                self.scheduler.remove_job(self.job.id)
-                logger.info("Removed job %s", self.job.id)
-            except Exception:
-                logger.exception("Error removing job")
-            self.job = None
-            logger.info('AutoUploader stopped')
+        """Remove every scheduled target."""
+        if self.store is not None:
+            self.store.delete_target(None)
+        with self._lock:
+            for target_id in list(self.targets):
+                self._remove_locked(target_id)
+        logger.info('AutoUploader stopped')
+
+    # -- fair dispatch --------------------------------------------------------
+
+    def _on_job_submitted(self, event):
+        # trigger lag: how late APScheduler fired a target's tick relative to its planned time
+        if event.job_id.startswith('target:') or event.job_id == DEFAULT_TARGET_ID:
+            now = datetime.now(timezone.utc)
+            for planned in event.scheduled_run_times:
+                SCHEDULER_LAG.observe(max(0.0, (now - planned).total_seconds()), phase='trigger')
+
+    def _enqueue(self, target_id):
+        """APScheduler entry point: queue one run for target_id and dispatch if a worker is free."""
+        if self.elector is not None and not self.elector.holds():
+            # the lease ran out before this process noticed; the new leader has the tick
+            logger.warning('Scheduler lease not held; skipping tick of target %s', target_id)
+            return
+        target = self.targets.get(target_id)
+        if target is not None and self.store is not None:
+            self._store_call(self.store.record_tick, target_id, time.time() + self._interval_seconds(target.interval))
+        with self._lock:
+            target = self.targets.get(target_id)
+            if target is None:
+                return
+            if len(target.pending) >= SCHED_MAX_PENDING:
+                logger.warning('Target %s already has %d pending runs; skipping this tick', target_id, len(target.pending))
+                return
+            target.pending.append(time.time())
+            self._dispatch_locked()
+            self._update_status_locked()
+
+    def _dispatch(self):
+        with self._lock:
+            self._dispatch_locked()
+            self._update_status_locked()
+
+    def _update_status_locked(self):
+        SCHEDULER_PENDING.set(sum(len(t.pending) for t in self.targets.values()))
+        SCHEDULER_ACTIVE.set(self._active)
+        if self._active:
+            self._idle.clear()
+        else:
+            self._idle.set()
+
+    def _dispatch_locked(self):
+        while self._active < self.workers:
+            target = self._next_eligible_locked()
+            if target is None:
+                return
+            queued_at = target.pending.popleft()
+            SCHEDULER_LAG.observe(time.time() - queued_at, phase='queue')
+            target.running += 1
+            self._active += 1
+            self._idle.clear()
+            self.planner.record_run(target.id)
+            self.executor.submit(self._run_target, target)
+
+    def _next_eligible_locked(self):
+        # round-robin: candidates in queue order, then move the chosen target to the back
+        candidates = [t for t in self.targets.values() if t.pending and t.running < t.concurrency]
+        if not candidates:
+            return None
+        pending_total = sum(len(t.pending) for t in self.targets.values())
+        ordered = self.planner.order(candidates, pending_total)
+        if not ordered:
+            if not self._deferred:
+                logger.warning('Quota budget exhausted (%d units left); deferring %d queued uploads until reset',
+                               quota_ledger.remaining(), pending_total)
+                self._deferred = True
+            return None
+        self._deferred = False
+        target = ordered[0]
+        self.targets.move_to_end(target.id)
+        return target
+
+    def _run_target(self, target):
+        result = None
+        try:
+            result = self._job_wrapper(target.folder_id, target.region)
+        finally:
+            with self._lock:
+                target.running -= 1
+                target.runs += 1
+                target.last_result = result
+                target.last_finished = datetime.now().isoformat()
+                self._active -= 1
+                self._dispatch_locked()
+                self._update_status_locked()
+            if self.store is not None:
+                self._store_call(self.store.record_run, target.id, result, target.last_finished)
+            if target.id in self.targets:
+                self._schedule_prefetch(target)
+
+    @staticmethod
+    def _store_call(fn, *args):
+        # bookkeeping only: a busy or unreachable store must not fail a tick or a finished run
+        try:
+            fn(*args)
+        except sqlite3.Error:
+            logger.warning('Could not update the shared scheduler store', exc_info=True)
+
+    # -- prefetch -------------------------------------------------------------
+
+    def _schedule_prefetch(self, target):
+        if not PREFETCH_ENABLED:
+            return
+        with self._lock:
+            if target.folder_id in self._prefetching:
+                return
+            self._prefetching.add(target.folder_id)
+        self.prefetcher.submit(self._prefetch, target.folder_id, target.region)
+
+    def _prefetch(self, folder_id, region):
+        """Pick and stage videos for folder_id until PREFETCH_DEPTH are ready."""
+        try:
+            cache = get_staging_cache()
+            while cache.reserved(folder_id) + len(self._unstaged.get(folder_id, ())) < PREFETCH_DEPTH:
+                # keep download bandwidth off the upload window
+                if not self._idle.wait(PREFETCH_IDLE_WAIT):
+                    logger.info('Upload workers busy for %ss; skipping prefetch for folder %s', PREFETCH_IDLE_WAIT, folder_id)
+                    return
+                creds = load_credentials()
+                if not creds:
+                    return
+                with client_pool.lease(creds) as (drive_service, youtube_service), span('prefetch', folder_id=folder_id):
+                    video_meta = pick_random_video_from_folder(drive_service, folder_id)
+                    if not video_meta:
+                        return
+                    if not cache.stage(drive_service, video_meta, folder_id):
+                        # too large to stage: keep the pick so the shuffle bag draw is not lost
+                        with self._lock:
+                            self._unstaged.setdefault(folder_id, deque()).append(video_meta)
+                    # warm the trending tags so the run finds them cached
+                    fetch_trending_hashtags(youtube_service, regionCode=region)
+        except Exception:
+            logger.exception('Prefetch for folder %s failed', folder_id)
+        finally:
+            with self._lock:
+                self._prefetching.discard(folder_id)
+
+    def _checkout_prefetched(self, drive_service, folder_id):
+        """Return a prefetched pick for folder_id with current Drive metadata, or None to pick live."""
+        video_meta = get_staging_cache().checkout(folder_id)
+        if video_meta is None:
+            with self._lock:
+                unstaged = self._unstaged.get(folder_id)
+                video_meta = unstaged.popleft() if unstaged else None
+            if video_meta is None:
+                return None
+        try:
+            current = get_file_metadata(drive_service, video_meta['id'], fields=FILE_FIELDS + ', trashed')
+        except Exception:
+            logger.warning('Prefetched file %s is no longer available; picking again', video_meta['id'])
+            get_staging_cache().discard(video_meta['id'])
+            return None
+        if current.get('trashed'):
+            get_staging_cache().discard(video_meta['id'])
+            return None
+        return current
 
-    def _job_wrapper(self):
+    # -- job body -------------------------------------------------------------
+
+    def _auto_thumbnail(self, drive_service, video_meta):
+        """Start preparing the image named like the video, if the folder has one; returns a Future or None."""
+        try:
+            image = find_sibling_image(drive_service, video_meta)
+            if image is None:
+                return None
+            logger.info('Using %s as thumbnail for %s', image.get('name'), video_meta.get('name'))
+            return thumbnail_pipeline.submit_drive(drive_service, image['id'], meta=image)
+        except Exception:
+            logger.warning('No automatic thumbnail for %s', video_meta.get('name'), exc_info=True)
+            return None
+
+    def _set_auto_thumbnail(self, youtube_service, video_id, thumb):
+        # the video is already up: a thumbnail that cannot be set is logged, not a failed run
+        if not quota_ledger.can_afford(API_COSTS['thumbnails.set']):
+            logger.warning('No quota left to set the thumbnail of %s', video_id)
+            return
+        try:
+            upload_thumbnail(youtube_service, video_id, thumb)
+        except Exception:
+            logger.warning('Could not set the thumbnail of %s', video_id, exc_info=True)
+
+    def run_once(self, folder_id, region='US', job=None):
+        """Run one upload synchronously in the calling thread (debug helper / background job body)."""
+        return self._job_wrapper(folder_id, region, job=job)
+
+    def _job_wrapper(self, folder_id, region, job=None):
         """Wrapper to ensure Flask app context and exception visibility."""
         if not self.app:
             logger.error("AutoUploader has no app context bound; job aborting.")
-            return
+            return None
 
         # Use app context so utilities referencing current_app/config work correctly
         with self.app.app_context():
             try:
-                self._job_upload_random()
+                return self._job_upload_random(folder_id, region, job=job)
             except Exception:
                 logger.exception("Unhandled exception inside scheduled job")
+                if job is not None:
+                    raise
+                return None
 
-    def _job_upload_random(self):
-        logger.info('Auto job triggered — picking a random video from folder %s', self.folder_id)
+    def _resume_wrapper(self):
         creds = load_credentials()
         if not creds:
-            logger.warning('No credentials available for scheduled upload')
+            logger.info('No credentials available; skipping resume of persisted uploads')
             return
+        try:
+            results = resume_pending_uploads(creds)
+            if results:
+                logger.info('Resumed persisted uploads: %s', results)
+        except Exception:
+            logger.exception("Unhandled exception while resuming persisted uploads")
 
-        # Build API clients
-        drive_service = build_drive_service(creds)
-        youtube_service = build_youtube_service(creds)
+    def _job_upload_random(self, folder_id, region, job=None):
+        """Pick a random video from folder_id and upload it. Returns the YouTube video id or None.
 
-        # Pick a random video from folder
-        video_meta = pick_random_video_from_folder(drive_service, self.folder_id)
-        if not video_meta:
-            logger.warning('No video found in folder %s', self.folder_id)
-            return
+        job (a jobs_utils.Job) receives stage and transfer progress when given; a run for a job
+        raises instead of returning None, so the job reports failed.
+        """
+        logger.info('Auto job triggered — picking a random video from folder %s', folder_id)
+        creds = load_credentials()
+        if not creds:
+            logger.warning('No credentials available for scheduled upload')
+            return None
 
-        file_id = video_meta['id']
-        title = video_meta.get('name') or 'Short'
+        # Fail fast before any Drive I/O if today's quota cannot cover the upload
         try:
-            # Fetch trending tags (returns list)
-            tags = fetch_trending_hashtags(youtube_service, regionCode=self.region) or []
-        except Exception:
-            logger.exception("Failed to fetch trending hashtags; proceeding without them")
-            tags = []
+            with quota_ledger.reserve(), span('job', folder_id=folder_id, region=region):
+                return self._upload_random_with_quota(folder_id, region, creds, job)
+        except QuotaExceeded as e:
+            logger.warning('Skipping upload from folder %s: %s', folder_id, e)
+            if job is not None:
+                raise
+            return None
 
-        description = f'Auto-upload from folder {self.folder_id}'
+    def _upload_random_with_quota(self, folder_id, region, creds, job):
+        # Lease pooled API clients
+        with client_pool.lease(creds) as (drive_service, youtube_service):
+            # Pick a random video from folder
+            if job is not None:
+                job.set_stage('picking')
+            video_meta = self._checkout_prefetched(drive_service, folder_id) if PREFETCH_ENABLED else None
+            if video_meta is None:
+                video_meta = pick_random_video_from_folder(drive_service, folder_id)
+            if not video_meta:
+                logger.warning('No video found in folder %s', folder_id)
+                if job is not None:
+                    # as app.folder_upload_job does: the run-now job fails instead of finishing without a video
+                    raise ValueError('No video found in folder')
+                return None
 
-        try:
-            logger.info('Downloading file %s', file_id)
-            sp = download_drive_file_to_spooled(drive_service, file_id)
-            # ensure seek to start in case spooled file not at 0
+            file_id = video_meta['id']
+            title = video_meta.get('name') or 'Short'
+            if job is not None:
+                job.picked = title
+                job.set_stage('tags')
             try:
-                sp.seek(0)
+                # Fetch trending tags (returns list)
+                tags = fetch_trending_hashtags(youtube_service, regionCode=region) or []
             except Exception:
-                pass
+                logger.exception("Failed to fetch trending hashtags; proceeding without them")
+                tags = []
 
-            logger.info('Uploading file to YouTube: title="%s" tags=%s', title, tags[:10])
-            video_id = upload_video_from_fileobj(youtube_service, sp, title, description, tags=tags)
-            logger.info('Auto-upload succeeded: video id=%s', video_id)
+            description = f'Auto-upload from folder {folder_id}'
+            thumb = self._auto_thumbnail(drive_service, video_meta) if THUMB_AUTO_PICK else None
 
-        except Exception:
-            logger.exception('Auto-upload failed for file_id=%s', file_id)
+            try:
+                logger.info('Transferring file %s to YouTube: title="%s" tags=%s', file_id, title, tags[:10])
+                if job is not None:
+                    job.set_stage('transferring')
+                video_id = transfer_drive_to_youtube(drive_service, youtube_service, file_id, title, description, tags=tags, creds=creds,
+                                                     progress=job, meta=video_meta)
+                logger.info('Auto-upload succeeded: video id=%s', video_id)
+                get_ledger().record_upload(file_id, video_meta.get('md5Checksum'), folder_id, video_id)
+                if thumb is not None:
+                    self._set_auto_thumbnail(youtube_service, video_id, thumb)
+                return video_id
+
+            except Exception:
+                logger.exception('Auto-upload failed for file_id=%s', file_id)
+                return_pick(folder_id, video_meta)
+                if job is not None:
+                    raise
+                return None
+            finally:
+                # uploaded, or failed like a live pick would: either way the staged copy is done with
+                get_staging_cache().discard(file_id)
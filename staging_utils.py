@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+from config import STAGING_DIR, STAGING_MAX_BYTES
+from drive_utils import download_drive_file_to_path, DownloadChecksumError
+from metrics_utils import STAGING_REQUESTS, STAGING_BYTES
+from coordination_utils import process_id, process_alive, pid_alive, file_lock, write_json
+
+logger = logging.getLogger('staging_utils')
+
+
+class StagingCache:
+    """On-disk cache of Drive videos downloaded ahead of their upload.
+
+    Entries live in root as <file_id>.bin and are described in index.json (Drive md5Checksum,
+    modifiedTime and size at download time, last use, and the folder they were picked for).
+    Entries reserved for a folder are handed out by checkout(); open() only returns a file whose
+    recorded md5/modifiedTime still match Drive. The total size is capped at max_bytes by evicting
+    the least recently used entries that are not checked out.
+
+    Worker processes share root: every operation rereads index.json under a file lock, and a
+    checked-out entry records the process holding it (freed again if that process dies).
+    """
+
+    def __init__(self, root=STAGING_DIR, max_bytes=STAGING_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, 'index.json')
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._entries = {}
+        self._load()
+
+    # -- persistence ------------------------------------------------------------
+
+    def _path(self, file_id):
+        return os.path.join(self.root, file_id + '.bin')
+
+    def _part_path(self, file_id):
+        return '%s.%d.part' % (self._path(file_id), os.getpid())
+
+    def _read(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except Exception:
+            logger.exception('Failed to read staging index %s; starting empty', self.index_path)
+            return {}
+
+    @contextlib.contextmanager
+    def _shared(self):
+        """Hold the cache (threads and processes) with self._entries reread from index.json."""
+        with self._lock, file_lock(self.index_path):
+            self._entries = self._read()
+            yield
+
+    def _load(self):
+        with self._shared():
+            # drop entries whose file vanished and files no entry describes (e.g. interrupted downloads)
+            self._entries = {k: v for k, v in self._entries.items() if os.path.exists(self._path(k))}
+            for name in os.listdir(self.root):
+                if name.startswith('index.json'):
+                    continue
+                if name.endswith('.part'):
+                    # <file_id>.bin.<pid>.part: still downloading unless that process is gone
+                    pid = name[:-len('.part')].rsplit('.', 1)[-1]
+                    if pid.isdigit() and pid_alive(int(pid)):
+                        continue
+                elif name[:-len('.bin')] in self._entries:
+                    continue
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+            self._save_locked()
+
+    def _save_locked(self):
+        write_json(self.index_path, self._entries)
+        STAGING_BYTES.set(self._total_locked())
+
+    def _total_locked(self):
+        return sum(e['size'] for e in self._entries.values())
+
+    def _in_use_locked(self, entry):
+        return process_alive(entry.get('owner'))
+
+    def _evict_locked(self, incoming):
+        for file_id, entry in sorted(self._entries.items(), key=lambda kv: kv[1]['last_used']):
+            if self._total_locked() + incoming <= self.max_bytes:
+                break
+            if self._in_use_locked(entry):
+                continue
+            logger.info('Evicting staged file %s (%d bytes)', file_id, entry['size'])
+            self._remove_locked(file_id)
+        return self._total_locked() + incoming <= self.max_bytes
+
+    def _remove_locked(self, file_id):
+        self._entries.pop(file_id, None)
+        try:
+            os.remove(self._path(file_id))
+        except OSError:
+            pass
+
+    # -- public API -------------------------------------------------------------
+
+    def stage(self, drive_service, meta, folder_id=None):
+        """Download meta (a Drive file dict with id, size, md5Checksum, modifiedTime) and reserve it for folder_id.
+
+        Returns True if the file is staged, False if it cannot fit under max_bytes.
+        """
+        file_id = meta['id']
+        size = int(meta.get('size') or 0)
+        with self._shared():
+            if file_id in self._entries:
+                self._entries[file_id]['folder_id'] = folder_id
+                self._save_locked()
+                return True
+            if not size or not self._evict_locked(size):
+                logger.info('Not staging %s: %d bytes do not fit in the %d byte staging cache', file_id, size, self.max_bytes)
+                self._save_locked()
+                return False
+            self._save_locked()
+        part = self._part_path(file_id)
+        try:
+            md5 = download_drive_file_to_path(drive_service, file_id, part)
+            if meta.get('md5Checksum') and md5 != meta['md5Checksum']:
+                raise DownloadChecksumError('md5 mismatch for staged %s: got %s expected %s' % (file_id, md5, meta['md5Checksum']))
+        except Exception:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        with self._shared():
+            # moved into place under the lock so a starting process never sees an unindexed .bin
+            os.replace(part, self._path(file_id))
+            self._evict_locked(size)
+            self._entries[file_id] = {'md5': meta.get('md5Checksum'), 'modified': meta.get('modifiedTime'), 'size': size,
+                                      'name': meta.get('name'), 'folder_id': folder_id, 'staged_at': time.time(),
+                                      'last_used': time.time()}
+            self._save_locked()
+        logger.info('Staged Drive file %s (%d bytes) for folder %s', file_id, size, folder_id)
+        return True
+
+    def reserved(self, folder_id):
+        """Number of staged files reserved for folder_id and not checked out."""
+        with self._shared():
+            return sum(1 for e in self._entries.values() if e.get('folder_id') == folder_id and not self._in_use_locked(e))
+
+    def checkout(self, folder_id):
+        """Take the oldest staged file reserved for folder_id; returns its Drive metadata dict or None."""
+        with self._shared():
+            candidates = [(e['staged_at'], k) for k, e in self._entries.items()
+                          if e.get('folder_id') == folder_id and not self._in_use_locked(e)]
+            if not candidates:
+                return None
+            file_id = min(candidates)[1]
+            e = self._entries[file_id]
+            e['owner'] = process_id()
+            self._save_locked()
+            return {'id': file_id, 'name': e.get('name'), 'md5Checksum': e.get('md5'), 'modifiedTime': e.get('modified'),
+                    'size': str(e['size'])}
+
+    def open(self, file_id, meta):
+        """Open the staged copy of file_id if it still matches meta (current Drive md5Checksum/modifiedTime), else None."""
+        with self._shared():
+            entry = self._entries.get(file_id)
+            if entry is None:
+                STAGING_REQUESTS.inc(result='miss')
+                return None
+            if meta.get('md5Checksum') and entry.get('md5'):
+                valid = meta['md5Checksum'] == entry['md5']
+            else:
+                valid = bool(meta.get('modifiedTime')) and meta.get('modifiedTime') == entry.get('modified')
+            if not valid:
+                logger.info('Staged copy of %s is out of date; discarding it', file_id)
+                STAGING_REQUESTS.inc(result='stale')
+                self._remove_locked(file_id)
+                self._save_locked()
+                return None
+            entry['last_used'] = time.time()
+            self._save_locked()
+            STAGING_REQUESTS.inc(result='hit')
+            # an open handle keeps the bytes readable even if the entry is evicted meanwhile
+            return open(self._path(file_id), 'rb')
+
+    def discard(self, file_id):
+        with self._shared():
+            if file_id in self._entries:
+                self._remove_locked(file_id)
+                self._save_locked()
+
+    def stats(self):
+        with self._shared():
+            return {'entries': len(self._entries), 'bytes': self._total_locked(), 'max_bytes': self.max_bytes,
+                    'in_use': sum(1 for e in self._entries.values() if self._in_use_locked(e))}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_staging_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = StagingCache()
+        return _cache
@@ -0,0 +1,241 @@
+import time
+import logging
+import threading
+from googleapiclient.http import MediaIoBaseDownload, MediaUpload
+from config import (TRANSFER_MODE, STREAM_BUFFER_SIZE, STREAM_DOWNLOAD_CHUNK, STREAM_UPLOAD_CHUNK, UPLOAD_CHUNK_MODE, UPLOAD_CHUNK_MAX,
+                    PREFETCH_ENABLED)
+from drive_utils import download_drive_file_to_spooled, download_drive_file_parallel, get_file_metadata, next_download_chunk
+from youtube_utils import AdaptiveChunker, upload_video_from_fileobj, upload_video_from_media
+from resume_utils import get_state_store, session_recorder
+from staging_utils import get_staging_cache
+from buffer_utils import buffer_manager
+from metrics_utils import span, bind_trace, current_trace, RETRIES, TRANSFER_BYTES, record_transfer
+
+logger = logging.getLogger('stream_utils')
+
+
+class StreamNotResumable(Exception):
+    """Raised when a streamed transfer cannot continue (rewind past retained data, download failure)."""
+
+
+class RingBuffer:
+    """Bounded in-memory byte ring between one writer (download) and one reader (upload).
+
+    Offsets are absolute positions in the source file. Bytes before the last offset
+    requested by the reader are released, so the memory used never exceeds capacity.
+    """
+
+    def __init__(self, capacity, buf=None):
+        self._buf = bytearray(capacity) if buf is None else buf
+        self._cap = capacity
+        self._base = 0   # absolute offset of the first retained byte
+        self._end = 0    # absolute offset one past the last written byte
+        self._eof = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    @property
+    def capacity(self):
+        return self._cap
+
+    def write(self, data):
+        """Append data, blocking while the ring is full. Called by MediaIoBaseDownload."""
+        mv = memoryview(data)
+        while mv:
+            with self._cond:
+                while self._end - self._base >= self._cap and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    raise StreamNotResumable('stream reader closed')
+                n = min(len(mv), self._cap - (self._end - self._base))
+                self._copy_in(self._end, mv[:n])
+                self._end += n
+                self._cond.notify_all()
+            mv = mv[n:]
+        return len(data)
+
+    def finish(self, error=None):
+        """Mark the writer side as done (or failed with error)."""
+        with self._cond:
+            self._eof = True
+            self._error = error
+            self._cond.notify_all()
+
+    def close(self):
+        """Reader side gave up; unblock the writer."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def read_at(self, begin, length):
+        """Return up to length bytes starting at absolute offset begin.
+
+        Everything before begin is released; blocks until the range is available or EOF.
+        """
+        if length > self._cap:
+            raise ValueError('read length %d exceeds ring capacity %d' % (length, self._cap))
+        with self._cond:
+            if begin < self._base:
+                raise StreamNotResumable('offset %d already released (retained from %d)' % (begin, self._base))
+            if begin > self._base:
+                self._base = min(begin, self._end)
+                self._cond.notify_all()
+            while self._end < begin + length and not self._eof:
+                self._cond.wait()
+            if self._error is not None:
+                raise StreamNotResumable('download failed: %s' % self._error)
+            stop = min(self._end, begin + length)
+            return self._copy_out(begin, stop)
+
+    def _copy_in(self, offset, mv):
+        pos = offset % self._cap
+        first = min(len(mv), self._cap - pos)
+        self._buf[pos:pos + first] = mv[:first]
+        if first < len(mv):
+            self._buf[:len(mv) - first] = mv[first:]
+
+    def _copy_out(self, start, stop):
+        if stop <= start:
+            return b''
+        pos = start % self._cap
+        n = stop - start
+        first = min(n, self._cap - pos)
+        out = bytes(self._buf[pos:pos + first])
+        if first < n:
+            out += bytes(self._buf[:n - first])
+        return out
+
+
+class RingMediaUpload(MediaUpload):
+    """MediaUpload that feeds the resumable upload from a RingBuffer as bytes arrive."""
+
+    def __init__(self, ring, size, mimetype='video/*', chunksize=STREAM_UPLOAD_CHUNK):
+        super().__init__()
+        if chunksize % (256 * 1024) or chunksize > ring.capacity:
+            raise ValueError('chunksize must be a multiple of 256 KiB and fit in the ring buffer')
+        self._ring = ring
+        self._size = size
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+
+    def chunksize(self):
+        return self._chunksize
+
+    def set_chunksize(self, chunksize):
+        self._chunksize = min(chunksize, self._ring.capacity)
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        return self._ring.read_at(begin, length)
+
+
+def _download_into_ring(drive_service, file_id, ring, progress_callback=None, trace=None):
+    try:
+        request = drive_service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(ring, request, chunksize=STREAM_DOWNLOAD_CHUNK)
+        done = False
+        received = 0
+        started = time.monotonic()
+        with bind_trace(trace), span('download', file_id=file_id, mode='stream'):
+            while not done:
+                status, done = next_download_chunk(downloader, request, STREAM_DOWNLOAD_CHUNK)
+                if status:
+                    TRANSFER_BYTES.inc(status.resumable_progress - received, direction='download')
+                    received = status.resumable_progress
+                    logger.debug('Stream download progress: %d%%', int(status.progress() * 100))
+                    if progress_callback is not None:
+                        progress_callback(status.resumable_progress, status.total_size)
+        record_transfer('download', received, time.monotonic() - started)
+        ring.finish()
+    except Exception as e:
+        if not isinstance(e, StreamNotResumable):
+            logger.exception('Streaming download of %s failed', file_id)
+        ring.finish(error=e)
+
+
+def stream_drive_to_youtube(drive_service, youtube_service, file_id, title, description, tags=None, privacy='public', size=None, stats=None,
+                            progress_callback=None, download_callback=None):
+    """Pipe a Drive file into a YouTube resumable upload through a fixed-size ring buffer.
+
+    Raises StreamNotResumable if the transfer cannot be completed as a stream.
+    """
+    if size is None:
+        size = get_file_metadata(drive_service, file_id, fields='size').get('size')
+    if not size:
+        raise StreamNotResumable('Drive did not report a size for %s' % file_id)
+
+    buf = buffer_manager.acquire(STREAM_BUFFER_SIZE)
+    if buf is None:
+        raise StreamNotResumable('memory budget has no room for a %d byte stream buffer' % STREAM_BUFFER_SIZE)
+    ring = RingBuffer(STREAM_BUFFER_SIZE, buf)
+    worker = threading.Thread(target=_download_into_ring, args=(drive_service, file_id, ring, download_callback, current_trace()),
+                              name='stream-download-%s' % file_id, daemon=True)
+    worker.start()
+    logger.info('Streaming Drive file %s (%s bytes) to YouTube', file_id, size)
+    try:
+        chunker = None
+        if UPLOAD_CHUNK_MODE == 'adaptive':
+            # keep half the ring free so the download can run ahead of the chunk being sent
+            chunker = AdaptiveChunker(max_size=min(UPLOAD_CHUNK_MAX, ring.capacity // 2))
+        media = RingMediaUpload(ring, int(size), chunksize=chunker.current if chunker else STREAM_UPLOAD_CHUNK)
+        return upload_video_from_media(youtube_service, media, title, description, tags=tags, privacy=privacy,
+                                       chunker=chunker, stats=stats, progress_callback=progress_callback)
+    finally:
+        ring.close()
+        worker.join()
+        buffer_manager.release(buf)
+
+
+def transfer_drive_to_youtube(drive_service, youtube_service, file_id, title, description, tags=None, privacy='public', mode=None, creds=None,
+                              stats=None, progress=None, meta=None):
+    """Copy a Drive file to YouTube using TRANSFER_MODE, falling back to the spooled path.
+
+    The upload session is persisted after every chunk so a restart can resume it (see resume_utils).
+    progress, if given, gets on_download(done, total) and on_upload(done, total) calls.
+    meta (current Drive md5Checksum/modifiedTime of the file) lets a valid prefetched copy be uploaded without any download.
+    """
+    staged = get_staging_cache().open(file_id, meta) if PREFETCH_ENABLED and meta is not None else None
+    mode = 'staged' if staged is not None else mode or TRANSFER_MODE
+    recorder = session_recorder(file_id, title, description, tags=tags, privacy=privacy)
+    download_callback = progress.on_download if progress is not None else None
+
+    def upload_callback(session_uri, offset, size):
+        recorder(session_uri, offset, size)
+        if progress is not None:
+            progress.on_upload(offset, size)
+
+    video_id = None
+    with span('transfer', file_id=file_id, mode=mode):
+        if staged is not None:
+            with staged:
+                video_id = upload_video_from_fileobj(youtube_service, staged, title, description, tags=tags, privacy=privacy, stats=stats,
+                                                     progress_callback=upload_callback)
+        elif mode == 'stream':
+            try:
+                video_id = stream_drive_to_youtube(drive_service, youtube_service, file_id, title, description, tags=tags, privacy=privacy,
+                                                   stats=stats, progress_callback=upload_callback, download_callback=download_callback)
+            except StreamNotResumable as e:
+                logger.warning('Streaming transfer of %s not possible (%s); falling back to spooled download', file_id, e)
+                RETRIES.inc(operation='stream_fallback')
+        if video_id is None:
+            if mode == 'parallel' and creds is not None:
+                sp = download_drive_file_parallel(drive_service, creds, file_id, progress_callback=download_callback)
+            else:
+                sp = download_drive_file_to_spooled(drive_service, file_id, progress_callback=download_callback)
+            with sp:
+                video_id = upload_video_from_fileobj(youtube_service, sp, title, description, tags=tags, privacy=privacy, stats=stats,
+                                                     progress_callback=upload_callback)
+    get_state_store().clear(file_id)
+    return video_id
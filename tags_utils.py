@@ -1,50 +1,233 @@
-import logging
+import os
 import re
-from collections import Counter
-from googleapiclient.discovery import build
-from pytrends.request import TrendReq
-from config import TREND_VIDEO_LIMIT, DEFAULT_REGION, MAX_HASHTAGS
+import json
+import math
+import time
+import heapq
+import logging
+import threading
+from operator import itemgetter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from quota_utils import quota_ledger
+from metrics_utils import span, api_call, TRENDING_CACHE
+from config import (TREND_VIDEO_LIMIT, DEFAULT_REGION, MAX_HASHTAGS, TREND_CACHE_TTL, TREND_CACHE_MAX_STALE,
+                    TREND_CACHE_REFRESH_AHEAD, TREND_CACHE_MAX_REGIONS, TREND_CACHE_SNAPSHOT, TREND_CATEGORIES,
+                    TREND_FETCH_CONCURRENCY, TREND_HALF_LIFE, TREND_MAX_TAGS, TREND_SCORES_SNAPSHOT)
 
 logger = logging.getLogger('tags_utils')
 
 HASHTAG_RE = re.compile(r'#(\w+)')
 
+# Score weights per occurrence: plain tag, tag written as a hashtag, hashtag in title/description
+TAG_WEIGHT = 1
+HASHTAG_TAG_WEIGHT = 2
+TEXT_HASHTAG_WEIGHT = 3
+# Best tags kept ranked per region for top-k queries and blends
+TOP_CANDIDATES = 200
+# Rebase scores once their growth factor passes this (float headroom is far larger)
+MAX_GROWTH = 1e12
+
 
 def extract_hashtags_from_text(text):
     return HASHTAG_RE.findall(text or '')
 
 
+def snippet_tags(snippet):
+    """Yield (tag, weight) for every tag and hashtag of one video snippet."""
+    for t in snippet.get('tags', []) or []:
+        if t.startswith('#'):
+            yield t.lower(), HASHTAG_TAG_WEIGHT
+        else:
+            yield '#' + t.lower(), TAG_WEIGHT
+    text = snippet.get('title', '') + '\n' + snippet.get('description', '')
+    for h in extract_hashtags_from_text(text):
+        yield '#' + h.lower(), TEXT_HASHTAG_WEIGHT
+
+
+def fetch_chart(youtube_service, region, category=None, max_videos=TREND_VIDEO_LIMIT):
+    """Return up to max_videos mostPopular items for region (and video category), 50 per page."""
+    items = []
+    page_token = None
+    while len(items) < max_videos:
+        params = {'part': 'snippet', 'chart': 'mostPopular', 'regionCode': region,
+                  'maxResults': min(max_videos - len(items), 50), 'pageToken': page_token}
+        if category:
+            params['videoCategoryId'] = category
+        quota_ledger.charge('videos.list')
+        with api_call('youtube.videos.list'):
+            res = youtube_service.videos().list(**params).execute()
+        items.extend(res.get('items', []))
+        page_token = res.get('nextPageToken')
+        if not page_token:
+            break
+    return items
+
+
+class TrendEngine:
+    """Rolling, exponentially decayed tag scores per region.
+
+    A score is stored multiplied by exp(rate * (t - t0)) at the time t it was earned, so
+    decay never touches the table: every score shrinks by the same factor, which leaves the
+    ranking unchanged. Ingesting a chart only adds to the affected tags and re-ranks that
+    region's TOP_CANDIDATES; top() reads the ranked lists without recomputing anything.
+    """
+
+    def __init__(self, half_life=TREND_HALF_LIFE, max_tags=TREND_MAX_TAGS, snapshot_path=TREND_SCORES_SNAPSHOT):
+        self.rate = math.log(2) / half_life
+        self.max_tags = max_tags
+        self.snapshot_path = snapshot_path
+        self._t0 = time.time()
+        self._scores = {}   # region -> {tag: scaled score}
+        self._top = {}      # region -> [(tag, scaled score)], best first
+        self._blends = {}   # (regions, weights, k) -> tags; cleared on every ingest
+        self._lock = threading.Lock()
+        self._load_snapshot()
+
+    def _rebase_locked(self, now):
+        factor = math.exp(-self.rate * (now - self._t0))
+        for table in self._scores.values():
+            for tag in table:
+                table[tag] *= factor
+        # the ranked lists hold scores on the old scale too
+        for region in self._scores:
+            self._rank_locked(region)
+        self._t0 = now
+
+    def _rank_locked(self, region):
+        table = self._scores[region]
+        if len(table) > self.max_tags:
+            table = self._scores[region] = dict(heapq.nlargest(self.max_tags, table.items(), key=itemgetter(1)))
+        self._top[region] = heapq.nlargest(TOP_CANDIDATES, table.items(), key=itemgetter(1))
+        self._blends.clear()
+
+    def ingest(self, region, items, now=None):
+        """Add the tags of videos.list items observed at now to region's scores."""
+        now = time.time() if now is None else now
+        with self._lock:
+            growth = math.exp(self.rate * (now - self._t0))
+            if growth > MAX_GROWTH:
+                self._rebase_locked(now)
+                growth = 1.0
+            table = self._scores.setdefault(region, {})
+            for item in items:
+                for tag, weight in snippet_tags(item.get('snippet', {})):
+                    table[tag] = table.get(tag, 0.0) + weight * growth
+            self._rank_locked(region)
+
+    def top(self, regions, k=MAX_HASHTAGS, weights=None):
+        """Best k tags for one region or a weighted blend of regions (equal weights by default)."""
+        if isinstance(regions, str):
+            regions = [regions]
+        with self._lock:
+            if len(regions) == 1:
+                return [t for t, _ in self._top.get(regions[0], [])[:k]]
+            key = (tuple(regions), tuple(weights) if weights else None, k)
+            tags = self._blends.get(key)
+            if tags is None:
+                combined = {}
+                for region, weight in zip(regions, weights or [1.0] * len(regions)):
+                    for tag, score in self._top.get(region, []):
+                        combined[tag] = combined.get(tag, 0.0) + weight * score
+                tags = self._blends[key] = [t for t, _ in heapq.nlargest(k, combined.items(), key=itemgetter(1))]
+            return list(tags)
+
+    def scores(self, region, k=MAX_HASHTAGS, now=None):
+        """Top k (tag, current decayed score) pairs of region."""
+        now = time.time() if now is None else now
+        with self._lock:
+            decay = math.exp(-self.rate * (now - self._t0))
+            return [(t, s * decay) for t, s in self._top.get(region, [])[:k]]
+
+    def refresh(self, regions, youtube_service=None, categories=TREND_CATEGORIES, max_videos=TREND_VIDEO_LIMIT):
+        """Fetch every region x category chart concurrently and ingest them. Returns the number of videos seen.
+
+        Each fetch runs on its own pooled client; youtube_service is only used when no pooled
+        client is available, and then the charts are fetched one after another.
+        """
+        # imported here: client_utils builds its services from modules that import this one
+        from client_utils import client_pool
+        charts = [(r, c) for r in regions for c in categories]
+
+        def fetch(chart, service=None):
+            try:
+                if service is not None:
+                    return fetch_chart(service, chart[0], chart[1], max_videos)
+                with client_pool.lease() as (_, leased):
+                    if leased is None:
+                        return None
+                    return fetch_chart(leased, chart[0], chart[1], max_videos)
+            except Exception:
+                logger.exception('Trending chart fetch failed for region %s category %s', *chart)
+                return []
+
+        with ThreadPoolExecutor(max_workers=min(TREND_FETCH_CONCURRENCY, len(charts)), thread_name_prefix='trend-fetch') as pool:
+            results = list(pool.map(fetch, charts))
+        if youtube_service is not None:
+            results = [fetch(chart, youtube_service) if res is None else res for chart, res in zip(charts, results)]
+        by_region = {}
+        for (region, _), items in zip(charts, results):
+            # a video charting in several categories counts once per region
+            seen = by_region.setdefault(region, {})
+            for item in items or []:
+                seen.setdefault(item.get('id'), item)
+        now = time.time()
+        for region, videos in by_region.items():
+            self.ingest(region, videos.values(), now)
+        self._save_snapshot()
+        return sum(len(v) for v in by_region.values())
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path) as f:
+                data = json.load(f)
+            with self._lock:
+                self._t0 = data['t0']
+                self._scores = data['scores']
+                for region in self._scores:
+                    self._rank_locked(region)
+            logger.info('Loaded trending tag scores for %d regions', len(self._scores))
+        except Exception:
+            logger.exception('Failed to read trending tag scores %s', self.snapshot_path)
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            data = json.dumps({'t0': self._t0, 'scores': self._scores})
+        try:
+            tmp = self.snapshot_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.snapshot_path)
+        except Exception:
+            logger.exception('Failed to write trending tag scores %s', self.snapshot_path)
+
+
+trend_engine = TrendEngine()
+
+
 def fetch_trending_hashtags_via_youtube(youtube_service, regionCode=DEFAULT_REGION, max_videos=TREND_VIDEO_LIMIT):
-    """Use YouTube mostPopular videos to derive popular hashtags/tags."""
-    tags_counter = Counter()
+    """Refresh regionCode (a region or comma separated blend) from YouTube mostPopular charts and return its top tags."""
+    regions = [r.strip() for r in regionCode.split(',') if r.strip()]
     try:
-        # youtube_service.videos().list supports maxResults up to 50. We request up to max_videos (≤50).
-        res = youtube_service.videos().list(part='snippet', chart='mostPopular', regionCode=regionCode, maxResults=min(max_videos, 50)).execute()
-        for item in res.get('items', []):
-            snippet = item.get('snippet', {})
-            # explicit tags
-            for t in snippet.get('tags', []) or []:
-                if t.startswith('#'):
-                    tags_counter[t.lower()] += 2
-                else:
-                    tags_counter[('#' + t.lower())] += 1
-            # hashtags in title/description
-            text = (snippet.get('title', '') + '\n' + snippet.get('description', ''))
-            for h in extract_hashtags_from_text(text):
-                tags_counter[('#' + h.lower())] += 3
+        trend_engine.refresh(regions, youtube_service, max_videos=max_videos)
     except Exception as e:
         logger.exception('YouTube trending fetch failed: %s', e)
-
-    tags = [t for t, _ in tags_counter.most_common(MAX_HASHTAGS)]
-    return tags
+    return trend_engine.top(regions)
 
 
 def fetch_trending_hashtags_via_pytrends(geo='US', top_k=MAX_HASHTAGS):
     """Fallback using Google Trends (pytrends) trending searches."""
     try:
-        pt = TrendReq()
-        # Use trending_searches - returns a pandas Series-like structure
-        df = pt.trending_searches(pn='united_states') if geo.upper() in ('US', 'UNITED_STATES') else pt.trending_searches()
+        # imported on first use: pytrends pulls in pandas, a large share of startup time
+        from pytrends.request import TrendReq
+        with api_call('pytrends.trending_searches'):
+            pt = TrendReq()
+            # Use trending_searches - returns a pandas Series-like structure
+            df = pt.trending_searches(pn='united_states') if geo.upper() in ('US', 'UNITED_STATES') else pt.trending_searches()
         items = []
         # robust slicing depending on return type
         try:
@@ -70,9 +253,136 @@ def fetch_trending_hashtags_via_pytrends(geo='US', top_k=MAX_HASHTAGS):
         return []
 
 
-def fetch_trending_hashtags(youtube_service, regionCode=DEFAULT_REGION):
+def _load_trending_hashtags(regionCode, youtube_service=None):
+    if youtube_service is None:
+        # background refresh: never share the caller's (non thread-safe) service object
+        from client_utils import client_pool
+        with client_pool.lease() as (_, youtube_service):
+            if youtube_service is None:
+                return []
+            return _load_trending_hashtags(regionCode, youtube_service)
     # prefer YouTube-based extraction
     tags = fetch_trending_hashtags_via_youtube(youtube_service, regionCode=regionCode)
     if tags:
         return tags
-    return fetch_trending_hashtags_via_pytrends(geo=regionCode)
+    return fetch_trending_hashtags_via_pytrends(geo=regionCode.split(',')[0])
+
+
+class TrendingCache:
+    """Per-region trending tag cache with TTL, LRU eviction and refresh-ahead.
+
+    Fresh entries are served directly; entries within refresh_ahead of expiry (or expired
+    but younger than max_stale) are served as-is while one background thread refreshes them.
+    An optional JSON snapshot keeps the cache warm across restarts.
+    """
+
+    def __init__(self, loader=_load_trending_hashtags, ttl=TREND_CACHE_TTL, max_stale=TREND_CACHE_MAX_STALE,
+                 refresh_ahead=TREND_CACHE_REFRESH_AHEAD, max_entries=TREND_CACHE_MAX_REGIONS, snapshot_path=TREND_CACHE_SNAPSHOT):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.refresh_ahead = refresh_ahead
+        self.max_entries = max_entries
+        self.snapshot_path = snapshot_path
+        self._entries = OrderedDict()   # region -> (fetched_at, tags)
+        self._refreshing = {}           # region -> threading.Event
+        self._lock = threading.Lock()
+        self._load_snapshot()
+
+    def get(self, region, youtube_service=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(region)
+            if entry is not None:
+                self._entries.move_to_end(region)
+                age = now - entry[0]
+                if age < self.ttl - self.refresh_ahead:
+                    TRENDING_CACHE.inc(result='hit')
+                    return list(entry[1])
+                if age < self.max_stale:
+                    TRENDING_CACHE.inc(result='stale')
+                    self._start_refresh_locked(region)
+                    return list(entry[1])
+            event = self._refreshing.get(region)
+            if event is None:
+                event = self._refreshing[region] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        TRENDING_CACHE.inc(result='miss' if owner else 'wait')
+        if not owner:
+            # single-flight: another caller is already fetching this region
+            event.wait()
+            with self._lock:
+                entry = self._entries.get(region)
+                return list(entry[1]) if entry else []
+        return self._refresh(region, youtube_service)
+
+    def _start_refresh_locked(self, region):
+        if region in self._refreshing:
+            return
+        self._refreshing[region] = threading.Event()
+        threading.Thread(target=self._refresh, args=(region, None), name=f'trending-refresh-{region}', daemon=True).start()
+
+    def _refresh(self, region, youtube_service):
+        tags = []
+        try:
+            tags = self.loader(region, youtube_service)
+        except Exception:
+            logger.exception('Trending hashtag refresh failed for region %s', region)
+        with self._lock:
+            if tags:
+                self._entries[region] = (time.time(), list(tags))
+                self._entries.move_to_end(region)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                entry = self._entries.get(region)
+                tags = entry[1] if entry else []
+            self._refreshing.pop(region).set()
+        if tags:
+            self._save_snapshot()
+        return list(tags)
+
+    def invalidate(self, region=None):
+        with self._lock:
+            if region is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(region, None)
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path) as f:
+                data = json.load(f)
+            for region, (fetched, tags) in sorted(data.items(), key=lambda kv: kv[1][0]):
+                self._entries[region] = (fetched, tags)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logger.info('Loaded trending hashtag snapshot for %d regions', len(self._entries))
+        except Exception:
+            logger.exception('Failed to read trending hashtag snapshot %s', self.snapshot_path)
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            data = dict(self._entries)
+        try:
+            tmp = self.snapshot_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.snapshot_path)
+        except Exception:
+            logger.exception('Failed to write trending hashtag snapshot %s', self.snapshot_path)
+
+
+trending_cache = TrendingCache()
+
+
+def fetch_trending_hashtags(youtube_service, regionCode=DEFAULT_REGION):
+    """Trending tags for a region code, or a comma separated blend of regions such as 'US,GB'."""
+    with span('tags', region=regionCode or DEFAULT_REGION):
+        return trending_cache.get(regionCode or DEFAULT_REGION, youtube_service)
@@ -0,0 +1,73 @@
+"""Shared fixtures for the tests, also imported by the benchmarks: a local fake Drive/YouTube server
+(benchmarks/fake_google.py), clients pointed at it, and persistent stores moved into a temp dir."""
+import os
+import sys
+import json
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+
+def isolate_state(tmp):
+    """Point every persistent store at tmp so tests and benchmarks never touch the real ones."""
+    import index_utils
+    import ledger_utils
+    import resume_utils
+    import quota_utils
+    import tags_utils
+    index_utils._index = index_utils.DriveFolderIndex(os.path.join(tmp, 'index.sqlite3'))
+    ledger_utils._ledger = ledger_utils.UploadLedger(os.path.join(tmp, 'ledger.sqlite3'))
+    resume_utils._store.path = os.path.join(tmp, 'upload_state.json')
+    quota_utils.quota_ledger.path = None
+    quota_utils.quota_ledger.limit = 10 ** 12
+    tags_utils.trending_cache.snapshot_path = None
+    tags_utils.trending_cache.invalidate()
+
+
+def fake_services(endpoint):
+    """Drive and YouTube clients whose every URL, resumable uploads included, points at the fake server."""
+    from googleapiclient.http import build_http
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+
+    def build(api, version):
+        # rewrite rootUrl rather than pass client_options api_endpoint: the client derives the
+        # media upload URL from rootUrl and would keep https for it
+        doc = json.loads(get_static_doc(api, version))
+        doc['rootUrl'] = endpoint + '/'
+        return build_from_document(doc, http=build_http())
+    return build('drive', 'v3'), build('youtube', 'v3')
+
+
+class FixedPool:
+    """Stands in for client_utils.client_pool: always leases the fake-endpoint services."""
+
+    def __init__(self, drive, youtube):
+        self.pair = (drive, youtube)
+
+    def lease(self, creds=None):
+        import contextlib
+        return contextlib.nullcontext(self.pair)
+
+
+@pytest.fixture
+def server():
+    from fake_google import FakeGoogle
+    server = FakeGoogle().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def services(server, tmp_path, monkeypatch):
+    """Fake-endpoint (drive, youtube) clients, leased by resume_utils in place of the real pool."""
+    import resume_utils
+    isolate_state(str(tmp_path))
+    drive, youtube = fake_services(server.url)
+    monkeypatch.setattr(resume_utils, 'client_pool', FixedPool(drive, youtube))
+    # the fake server takes no auth: resume_upload's offset query goes out on the bare http
+    monkeypatch.setattr(resume_utils.google_auth_httplib2, 'AuthorizedHttp', lambda creds, http: http)
+    return drive, youtube
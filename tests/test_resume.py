@@ -0,0 +1,84 @@
+"""resume_utils.resume_upload against the local fake Drive/YouTube server (fixtures in conftest.py)."""
+import pytest
+
+pytest.importorskip('googleapiclient')
+pytest.importorskip('google_auth_httplib2')
+
+import resume_utils  # noqa: E402
+from youtube_utils import upload_video_from_fileobj  # noqa: E402
+from drive_utils import download_drive_file_to_spooled  # noqa: E402
+
+CHUNK = 256 * 1024
+SIZE = 10 * CHUNK + 1234     # the last chunk is a short one
+
+
+class Crash(Exception):
+    """Stands in for the process dying between two chunks."""
+
+
+def _session(server, video_id):
+    return next(s for s in server.sessions.values() if s.video_id == video_id)
+
+
+def _interrupted_upload(drive, youtube, file_id, crash_after):
+    """Upload file_id with its session persisted after every chunk, and crash after crash_after chunks."""
+    recorder = resume_utils.session_recorder(file_id, 'title', 'description', tags=['a'])
+    chunks = []
+
+    def progress(session_uri, offset, size):
+        recorder(session_uri, offset, size)
+        chunks.append(offset)
+        if len(chunks) == crash_after:
+            raise Crash(offset)
+
+    with download_drive_file_to_spooled(drive, file_id) as sp:
+        with pytest.raises(Crash):
+            upload_video_from_fileobj(youtube, sp, 'title', 'description', tags=['a'], chunk_size=CHUNK, adaptive=False,
+                                      progress_callback=progress)
+    return chunks[-1]
+
+
+def test_resume_after_mid_upload_failure(server, services):
+    drive, youtube = services
+    source = server.add_file('vid1', SIZE)
+    store = resume_utils.get_state_store()
+
+    committed = _interrupted_upload(drive, youtube, 'vid1', crash_after=4)
+    record = store.all()['vid1']
+    assert record['offset'] == committed == 4 * CHUNK
+    assert record['size'] == SIZE
+
+    server.reset_counters()
+    video_id = resume_utils.resume_upload(None, record)
+
+    session = _session(server, video_id)
+    assert session.received == SIZE
+    assert server.stats()['bytes_out'] == SIZE - committed   # only the tail was read from Drive again
+    assert server.completed[video_id] == source.md5
+    assert 'vid1' not in store.all()
+
+
+def test_resume_after_server_committed_more_than_recorded(server, services):
+    # the process died after the chunk was sent but before its offset was saved
+    drive, youtube = services
+    source = server.add_file('vid2', SIZE)
+    store = resume_utils.get_state_store()
+
+    _interrupted_upload(drive, youtube, 'vid2', crash_after=3)
+    store.save('vid2', offset=CHUNK)
+    video_id = resume_utils.resume_upload(None, store.all()['vid2'])
+
+    assert _session(server, video_id).received == SIZE
+    assert server.completed[video_id] == source.md5
+
+
+def test_resume_of_finished_upload_returns_video(server, services):
+    drive, youtube = services
+    source = server.add_file('vid3', CHUNK)
+    store = resume_utils.get_state_store()
+
+    _interrupted_upload(drive, youtube, 'vid3', crash_after=1)   # the only chunk completes the upload
+    video_id = resume_utils.resume_upload(None, store.all()['vid3'])
+
+    assert server.completed[video_id] == source.md5
+    assert 'vid3' not in store.all()
@@ -0,0 +1,241 @@
+import io
+import os
+import hashlib
+import logging
+import threading
+import importlib.util
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from config import (THUMB_SIZE, THUMB_MAX_BYTES, THUMB_MAX_SOURCE_BYTES, THUMB_WORKERS, THUMB_CACHE_DIR, THUMB_CACHE_MAX_FILES,
+                    THUMB_RENDER_TIMEOUT)
+from metrics_utils import THUMBNAILS
+
+# Pool processes import this module: Drive/YouTube helpers are imported inside the functions that use them.
+
+logger = logging.getLogger('thumbnail_utils')
+
+Thumbnail = namedtuple('Thumbnail', 'data mimetype')
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+# JPEG qualities tried in turn; if none fits under the limit the image is scaled down by SHRINK and tried again
+QUALITIES = (90, 80, 70, 60, 50)
+SHRINK = 0.8
+MIN_SIDE = 64
+
+
+class ThumbnailError(Exception):
+    """The image cannot be made into a valid YouTube thumbnail."""
+
+
+def sniff_mimetype(data):
+    if data.startswith(JPEG_MAGIC):
+        return 'image/jpeg'
+    if data.startswith(PNG_MAGIC):
+        return 'image/png'
+    return None
+
+
+def render(data, size=THUMB_SIZE, max_bytes=THUMB_MAX_BYTES):
+    """Decode image bytes, fit them into size (aspect kept) and encode as JPEG under max_bytes. Runs in a pool process."""
+    from PIL import Image, ImageOps
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEG: let the decoder downscale by a power of two instead of decoding full size
+        img.draft('RGB', size)
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ThumbnailError('cannot decode image: %s' % e)
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, (0, 0, 0))
+        img.paste(rgba, mask=rgba.getchannel('A'))
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail(size, Image.LANCZOS)
+    while True:
+        for quality in QUALITIES:
+            out = io.BytesIO()
+            img.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+            if out.tell() <= max_bytes:
+                return out.getvalue()
+        if min(img.size) * SHRINK < MIN_SIDE:
+            raise ThumbnailError('cannot encode under %d bytes' % max_bytes)
+        img = img.resize((int(img.width * SHRINK), int(img.height * SHRINK)), Image.LANCZOS)
+
+
+def _done(result=None, error=None):
+    fut = Future()
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+    return fut
+
+
+class ThumbnailPipeline:
+    """Prepares thumbnails on a process pool so image decoding never runs on web or scheduler threads.
+
+    Renders are cached on disk by source md5 (and target size/limit), so an image used again,
+    e.g. one shared by many scheduled videos, is decoded only once. Concurrent requests for
+    the same image share one render. Without Pillow, JPEG/PNG sources already under the
+    limit are passed through unchanged and anything else is rejected.
+    """
+
+    def __init__(self, cache_dir=THUMB_CACHE_DIR, workers=THUMB_WORKERS, size=THUMB_SIZE, max_bytes=THUMB_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.size = tuple(size)
+        self.max_bytes = max_bytes
+        self._pool = None
+        self._inflight = {}     # cache key -> Future of the render in progress
+        self._lock = threading.Lock()
+        self._pillow = None
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: forking a process full of web and scheduler threads can copy held locks
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _discard_pool(self, pool, error):
+        """Drop pool if a worker died in it (BrokenProcessPool), so the next render starts a fresh one."""
+        if not isinstance(error, BrokenProcessPool):
+            return
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        logger.warning('Thumbnail pool is broken (%s); starting a new one for the next render', error)
+        pool.shutdown(wait=False)
+
+    @property
+    def pillow(self):
+        if self._pillow is None:
+            self._pillow = importlib.util.find_spec('PIL') is not None
+            if not self._pillow:
+                logger.warning('Pillow is not installed; thumbnails are uploaded as-is (JPEG/PNG under %d bytes only)', self.max_bytes)
+        return self._pillow
+
+    # -- cache ----------------------------------------------------------------
+
+    def _path(self, md5):
+        return os.path.join(self.cache_dir, '%s-%dx%d-%d.jpg' % (md5, self.size[0], self.size[1], self.max_bytes))
+
+    def cached(self, md5):
+        """Cached render for a source md5, or None."""
+        if not self.cache_dir or not md5:
+            return None
+        path = self._path(md5)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)   # eviction drops the least recently used renders
+        except OSError:
+            return None
+        return Thumbnail(data, 'image/jpeg')
+
+    def _store(self, md5, data):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(md5)
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            entries = [os.path.join(self.cache_dir, n) for n in os.listdir(self.cache_dir) if n.endswith('.jpg')]
+            if len(entries) > THUMB_CACHE_MAX_FILES:
+                entries.sort(key=os.path.getmtime)
+                for old in entries[:len(entries) - THUMB_CACHE_MAX_FILES]:
+                    os.remove(old)
+        except OSError:
+            logger.warning('Could not write thumbnail cache in %s', self.cache_dir, exc_info=True)
+
+    # -- pipeline -------------------------------------------------------------
+
+    def submit(self, data, md5=None):
+        """Queue image bytes for processing; returns a Future of Thumbnail (ThumbnailError if unusable)."""
+        md5 = md5 or hashlib.md5(data).hexdigest()
+        hit = self.cached(md5)
+        if hit is not None:
+            THUMBNAILS.inc(result='cached')
+            return _done(hit)
+        if not self.pillow:
+            mimetype = sniff_mimetype(data)
+            if mimetype is None or len(data) > self.max_bytes:
+                THUMBNAILS.inc(result='failed')
+                return _done(error=ThumbnailError('without Pillow only JPEG/PNG images up to %d bytes can be used' % self.max_bytes))
+            THUMBNAILS.inc(result='passthrough')
+            return _done(Thumbnail(data, mimetype))
+        with self._lock:
+            fut = self._inflight.get(md5)
+            if fut is not None:
+                return fut
+            fut = self._inflight[md5] = Future()
+        pool = self.pool
+        try:
+            rendered = pool.submit(render, data, self.size, self.max_bytes)
+        except Exception as e:
+            # fail the shared future now: anyone waiting on it would otherwise wait forever
+            self._fail(md5, fut, pool, e)
+            return fut
+        rendered.add_done_callback(lambda r: self._finish(md5, fut, pool, r))
+        return fut
+
+    def _fail(self, md5, fut, pool, error):
+        with self._lock:
+            self._inflight.pop(md5, None)
+        self._discard_pool(pool, error)
+        THUMBNAILS.inc(result='failed')
+        fut.set_exception(error)
+
+    def _finish(self, md5, fut, pool, rendered):
+        error = rendered.exception()
+        if error is not None:
+            self._fail(md5, fut, pool, error)
+            return
+        with self._lock:
+            self._inflight.pop(md5, None)
+        data = rendered.result()
+        self._store(md5, data)
+        THUMBNAILS.inc(result='rendered')
+        fut.set_result(Thumbnail(data, 'image/jpeg'))
+
+    def submit_drive(self, drive_service, file_id, meta=None):
+        """Fetch a Drive image and queue it; a cached render for its md5 skips the download.
+
+        Raises ThumbnailError at once for files that are not images or exceed THUMB_MAX_SOURCE_BYTES.
+        """
+        from drive_utils import get_file_metadata, download_drive_file_to_spooled
+        meta = meta or get_file_metadata(drive_service, file_id, fields='id, name, mimeType, size, md5Checksum')
+        if not (meta.get('mimeType') or '').startswith('image/'):
+            raise ThumbnailError('%s is not an image (%s)' % (meta.get('name') or file_id, meta.get('mimeType')))
+        if int(meta.get('size') or 0) > THUMB_MAX_SOURCE_BYTES:
+            raise ThumbnailError('%s is larger than %d bytes' % (meta.get('name') or file_id, THUMB_MAX_SOURCE_BYTES))
+        hit = self.cached(meta.get('md5Checksum'))
+        if hit is not None:
+            THUMBNAILS.inc(result='cached')
+            return _done(hit)
+        with download_drive_file_to_spooled(drive_service, file_id, max_mem=THUMB_MAX_SOURCE_BYTES) as sp:
+            data = sp.read()
+        return self.submit(data)
+
+
+def upload_thumbnail(youtube_service, video_id, future, timeout=THUMB_RENDER_TIMEOUT):
+    """Wait (up to timeout seconds) for a prepared thumbnail and set it on video_id."""
+    from youtube_utils import set_thumbnail
+    try:
+        thumb = future.result(timeout=timeout)
+    except FutureTimeout:
+        raise ThumbnailError('thumbnail for %s not ready after %ds' % (video_id, timeout))
+    return set_thumbnail(youtube_service, video_id, thumb_fileobj=io.BytesIO(thumb.data), mimetype=thumb.mimetype)
+
+
+thumbnail_pipeline = ThumbnailPipeline()
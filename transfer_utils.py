@@ -0,0 +1,148 @@
+import time
+import random
+import socket
+import logging
+import threading
+import contextlib
+import http.client
+import httplib2
+from googleapiclient.errors import HttpError
+from metrics_utils import RETRIES, RETRY_REASONS, RETRY_BACKOFF, TRANSFER_STALLS, TRANSFER_GIVEUPS
+from config import TRANSFER_RETRIES, TRANSFER_BACKOFF_BASE, TRANSFER_BACKOFF_MAX, TRANSFER_MIN_THROUGHPUT, TRANSFER_STALL_GRACE
+
+logger = logging.getLogger('transfer_utils')
+
+RETRYABLE_STATUS = (500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'backendError')
+
+
+class StallError(IOError):
+    """A chunk made no progress within its watchdog deadline; its connection was torn down."""
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter: attempt n sleeps uniform(0, min(cap, base * 2**n))."""
+
+    def __init__(self, retries=TRANSFER_RETRIES, base=TRANSFER_BACKOFF_BASE, cap=TRANSFER_BACKOFF_MAX):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+def retry_reason(exc):
+    """Short reason string if exc is a transient transfer failure worth retrying, else None."""
+    if isinstance(exc, StallError):
+        return 'stall'
+    if isinstance(exc, HttpError):
+        status = getattr(exc.resp, 'status', None)
+        if status in RETRYABLE_STATUS:
+            return 'http_%d' % status
+        if status == 429:
+            return 'rate_limit'
+        if status == 403 and any(r in str(exc.content) for r in RATE_LIMIT_REASONS):
+            return 'rate_limit'
+        return None
+    if isinstance(exc, socket.timeout):
+        return 'timeout'
+    if isinstance(exc, (OSError, http.client.HTTPException, httplib2.HttpLib2Error)):
+        return 'network'
+    return None
+
+
+def _close_connections(http):
+    """Shut down every socket held by an (Authorized)Http so a blocked read returns and the next request reconnects."""
+    inner = getattr(http, 'http', http)
+    connections = getattr(inner, 'connections', None) or {}
+    for conn in list(connections.values()):
+        sock = getattr(conn, 'sock', None)
+        try:
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        except Exception:
+            pass
+    connections.clear()
+
+
+class Watchdog:
+    """One background thread enforcing per-chunk deadlines for every in-flight transfer.
+
+    A chunk of n bytes must finish within grace + n / min_throughput seconds; otherwise its
+    connections are shut down, which makes the blocked request fail so it can be retried.
+    """
+
+    def __init__(self, min_throughput=TRANSFER_MIN_THROUGHPUT, grace=TRANSFER_STALL_GRACE):
+        self.min_throughput = min_throughput
+        self.grace = grace
+        self._watches = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def watch(self, http, expected_bytes, label):
+        watch = {'deadline': time.monotonic() + self.grace + expected_bytes / self.min_throughput,
+                 'http': http, 'label': label, 'stalled': False}
+        key = object()
+        with self._cond:
+            self._watches[key] = watch
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='transfer-watchdog', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        try:
+            yield watch
+        finally:
+            with self._cond:
+                self._watches.pop(key, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._watches:
+                    self._cond.wait()
+                now = time.monotonic()
+                expired = [w for w in self._watches.values() if not w['stalled'] and w['deadline'] <= now]
+                for w in expired:
+                    w['stalled'] = True
+            for w in expired:
+                logger.warning('Transfer %s stalled (below %d B/s); reopening its connection', w['label'], self.min_throughput)
+                TRANSFER_STALLS.inc(operation=w['label'])
+                _close_connections(w['http'])
+            time.sleep(1)
+
+
+watchdog = Watchdog()
+
+
+def run_chunk(call, http, operation, expected_bytes, policy=None, on_retry=None):
+    """Run call() (one chunk of a transfer) under the stall watchdog, retrying transient failures.
+
+    on_retry(exc), if given, runs before each retry so the caller can rewind to the last committed offset.
+    """
+    policy = policy or RetryPolicy()
+    attempt = 0
+    while True:
+        with watchdog.watch(http, expected_bytes, operation) as watch:
+            try:
+                return call()
+            except Exception as e:
+                exc = StallError('%s stalled: %s' % (operation, e)) if watch['stalled'] else e
+                reason = retry_reason(exc)
+                if reason is None or attempt >= policy.retries:
+                    if reason is not None:
+                        TRANSFER_GIVEUPS.inc(operation=operation)
+                    if exc is e:
+                        raise
+                    raise exc from e
+        attempt += 1
+        delay = policy.delay(attempt)
+        RETRIES.inc(operation=operation)
+        RETRY_REASONS.inc(operation=operation, reason=reason)
+        RETRY_BACKOFF.observe(delay, operation=operation)
+        logger.warning('%s failed (%s: %s); retry %d/%d in %.1fs', operation, reason, exc, attempt, policy.retries, delay)
+        if on_retry is not None:
+            on_retry(exc)
+        time.sleep(delay)
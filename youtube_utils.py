@@ -1,24 +1,26 @@
+import json
+import time
 import logging
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
+from quota_utils import quota_ledger, is_quota_error
+from metrics_utils import span, api_call, TRANSFER_BYTES, record_transfer
+from transfer_utils import run_chunk
+from discovery_utils import build_service
+from config import UPLOAD_CHUNK_MODE, UPLOAD_CHUNK_MIN, UPLOAD_CHUNK_MAX, UPLOAD_CHUNK_TARGET_SECONDS
 
 logger = logging.getLogger('youtube_utils')
 
+# YouTube resumable uploads require chunk sizes in multiples of 256 KiB
+CHUNK_GRANULARITY = 256 * 1024
 
-def build_youtube_service(creds):
-    return build('youtube', 'v3', credentials=creds, cache_discovery=False)
 
+def build_youtube_service(creds):
+    return build_service('youtube', 'v3', creds)
 
-def upload_video_from_fileobj(youtube_service, fileobj, title, description, tags=None, privacy='public', chunk_size=256 * 1024):
-    """Upload a video using a file-like object. Returns YouTube video id."""
-    if hasattr(fileobj, 'seek'):
-        try:
-            fileobj.seek(0)
-        except Exception:
-            # ignore if not seekable
-            pass
 
-    body = {
+def build_video_body(title, description, tags=None, privacy='public'):
+    return {
         'snippet': {
             'title': title,
             'description': description,
@@ -28,20 +30,217 @@ def upload_video_from_fileobj(youtube_service, fileobj, title, description, tags
             'privacyStatus': privacy
         }
     }
-    media = MediaIoBaseUpload(fileobj, mimetype='video/*', chunksize=chunk_size, resumable=True)
+
+
+class UploadStats:
+    """Per-upload measurements, filled in by upload_video_from_media when passed as stats=."""
+
+    def __init__(self):
+        self.mode = None
+        self.chunk_sizes = []
+        self.chunk_seconds = []
+        self.bytes_sent = 0
+        self.elapsed = 0.0
+        self.retries = 0
+
+    @property
+    def mb_per_s(self):
+        return (self.bytes_sent / (1024 * 1024)) / self.elapsed if self.elapsed else 0.0
+
+    def record(self, nbytes, seconds, chunk_size):
+        self.chunk_sizes.append(chunk_size)
+        self.chunk_seconds.append(seconds)
+        self.bytes_sent += nbytes
+        self.elapsed += seconds
+
+    def to_dict(self):
+        return {
+            'mode': self.mode,
+            'chunks': len(self.chunk_sizes),
+            'chunk_sizes': list(self.chunk_sizes),
+            'bytes_sent': self.bytes_sent,
+            'elapsed': round(self.elapsed, 3),
+            'mb_per_s': round(self.mb_per_s, 3),
+            'retries': self.retries,
+        }
+
+
+class AdaptiveChunker:
+    """Pick the next chunk size from measured throughput so each chunk takes ~target_seconds.
+
+    Sizes stay multiples of CHUNK_GRANULARITY within [min_size, max_size] and change by
+    at most 2x per step so one slow or fast chunk cannot swing the size wildly.
+    """
+
+    def __init__(self, min_size=UPLOAD_CHUNK_MIN, max_size=UPLOAD_CHUNK_MAX, target_seconds=UPLOAD_CHUNK_TARGET_SECONDS, initial=None):
+        self.min_size = max(CHUNK_GRANULARITY, _round_chunk(min_size))
+        self.max_size = max(self.min_size, _round_chunk(max_size))
+        self.target_seconds = target_seconds
+        self.current = self._clamp(initial or self.min_size)
+
+    def _clamp(self, size):
+        return min(self.max_size, max(self.min_size, _round_chunk(size)))
+
+    def observe(self, nbytes, seconds):
+        """Feed one chunk's size and duration; returns the next chunk size."""
+        if nbytes <= 0 or seconds <= 0:
+            return self.current
+        desired = (nbytes / seconds) * self.target_seconds
+        desired = min(desired, self.current * 2)
+        desired = max(desired, self.current / 2)
+        self.current = self._clamp(desired)
+        return self.current
+
+
+def _round_chunk(size):
+    return max(CHUNK_GRANULARITY, int(size) // CHUNK_GRANULARITY * CHUNK_GRANULARITY)
+
+
+class AdaptiveMediaIoBaseUpload(MediaIoBaseUpload):
+    """MediaIoBaseUpload whose chunk size can change between next_chunk calls."""
+
+    def set_chunksize(self, chunksize):
+        self._chunksize = chunksize
+
+
+def upload_video_from_media(youtube_service, media, title, description, tags=None, privacy='public', chunker=None, stats=None,
+                            progress_callback=None, resume_uri=None, resume_offset=0):
+    """Run a resumable videos.insert for an already built MediaUpload. Returns YouTube video id.
+
+    With a chunker, media must provide set_chunksize(); the size is retuned after every chunk.
+    progress_callback(session_uri, committed_offset, size) is called after every chunk.
+    resume_uri/resume_offset continue an existing upload session instead of starting a new one.
+    """
+    body = build_video_body(title, description, tags=tags, privacy=privacy)
     request = youtube_service.videos().insert(part=','.join(['snippet', 'status']), body=body, media_body=media)
+    if resume_uri:
+        request.resumable_uri = resume_uri
+        request.resumable_progress = resume_offset
+        logger.info('Resuming upload session at byte %d', resume_offset)
+    if stats is not None:
+        stats.mode = 'adaptive' if chunker else 'fixed'
     logger.info('Starting resumable upload to YouTube (title=%s)', title)
+    state = {'response': None}
+
+    def next_chunk():
+        if state['response'] is not None:
+            # the chunk that dropped its connection completed the upload
+            response, state['response'] = state['response'], None
+            return None, response
+        with api_call('youtube.videos.insert'):
+            return request.next_chunk()
+
+    def rewind(exc):
+        # a dropped connection may have committed part of the chunk: ask the session for its
+        # committed offset and resend from there. The client asks again before its next send;
+        # for HttpErrors that query is all it takes
+        if stats is not None:
+            stats.retries += 1
+        if request.resumable_uri is None or isinstance(exc, HttpError):
+            return
+        try:
+            with api_call('youtube.videos.insert'):
+                committed, response = query_upload_offset(request.http, request.resumable_uri, media.size())
+        except Exception:
+            logger.warning('Could not query the committed offset; resending from byte %d', request.resumable_progress,
+                           exc_info=True)
+            return
+        if committed is not None:
+            request.resumable_progress = committed
+            state['response'] = response
+
     response = None
-    while response is None:
-        status, response = request.next_chunk()
-        if status:
-            logger.info('Upload progress: %d%%', int(status.progress() * 100))
+    last_logged = -10
+    sent_total = 0
+    upload_started = time.monotonic()
+    with span('upload', title=title, resumed=bool(resume_uri)):
+        while response is None:
+            chunk_size = media.chunksize()
+            offset = request.resumable_progress
+            started = time.monotonic()
+            if request.resumable_uri is None:
+                # the session-creating call is the one that spends the videos.insert quota
+                quota_ledger.charge('videos.insert')
+            try:
+                status, response = run_chunk(next_chunk, request.http, 'youtube.upload', chunk_size, on_retry=rewind)
+            except HttpError as e:
+                if is_quota_error(e):
+                    quota_ledger.mark_exhausted()
+                raise
+            elapsed = time.monotonic() - started
+            sent = (media.size() if response is not None and media.size() else request.resumable_progress) - offset
+            sent_total += sent
+            TRANSFER_BYTES.inc(sent, direction='upload')
+            if stats is not None:
+                stats.record(sent, elapsed, chunk_size)
+            if chunker is not None:
+                media.set_chunksize(chunker.observe(sent, elapsed))
+            if progress_callback is not None:
+                # the final chunk answers with the video instead of a 308: report it as fully committed
+                progress_callback(request.resumable_uri, offset + sent, media.size())
+            if status:
+                pct = int(status.progress() * 100)
+                logger.debug('Upload chunk: %d bytes in %.2fs (chunk size %d)', sent, elapsed, chunk_size)
+                if pct - last_logged >= 10:
+                    logger.info('Upload progress: %d%%', pct)
+                    last_logged = pct
+    record_transfer('upload', sent_total, time.monotonic() - upload_started)
     video_id = response.get('id')
-    logger.info('Upload finished: video id=%s', video_id)
+    if stats is not None:
+        logger.info('Upload finished: video id=%s (%d chunks, %.2f MB/s)', video_id, len(stats.chunk_sizes), stats.mb_per_s)
+    else:
+        logger.info('Upload finished: video id=%s', video_id)
     return video_id
 
 
-def set_thumbnail(youtube_service, video_id, thumb_fileobj=None):
+def upload_video_from_fileobj(youtube_service, fileobj, title, description, tags=None, privacy='public', chunk_size=256 * 1024,
+                              adaptive=None, stats=None, progress_callback=None, resume_uri=None, resume_offset=0):
+    """Upload a video using a file-like object. Returns YouTube video id.
+
+    adaptive (default: UPLOAD_CHUNK_MODE == 'adaptive') starts at chunk_size and grows/shrinks it
+    from measured throughput; pass an UploadStats as stats to get chunk sizes and MB/s back.
+    """
+    if hasattr(fileobj, 'seek'):
+        try:
+            fileobj.seek(0)
+        except Exception:
+            # ignore if not seekable
+            pass
+
+    if adaptive is None:
+        adaptive = UPLOAD_CHUNK_MODE == 'adaptive'
+    chunker = None
+    if adaptive:
+        chunker = AdaptiveChunker(initial=chunk_size)
+        media = AdaptiveMediaIoBaseUpload(fileobj, mimetype='video/*', chunksize=chunker.current, resumable=True)
+    else:
+        media = MediaIoBaseUpload(fileobj, mimetype='video/*', chunksize=chunk_size, resumable=True)
+    return upload_video_from_media(youtube_service, media, title, description, tags=tags, privacy=privacy,
+                                   chunker=chunker, stats=stats, progress_callback=progress_callback,
+                                   resume_uri=resume_uri, resume_offset=resume_offset)
+
+
+def query_upload_offset(http, session_uri, size):
+    """Ask a resumable session how many bytes it has committed.
+
+    Returns (offset, response): response is the video resource if the upload already
+    completed, offset is None if the session no longer exists.
+    """
+    headers = {'Content-Length': '0', 'Content-Range': 'bytes */%s' % (size if size is not None else '*')}
+    resp, content = http.request(session_uri, 'PUT', headers=headers)
+    if resp.status in (200, 201):
+        return size, json.loads(content.decode('utf-8') if isinstance(content, bytes) else content)
+    if resp.status == 308:
+        rng = resp.get('range')
+        if not rng:
+            return 0, None
+        return int(rng.rsplit('-', 1)[1]) + 1, None
+    if resp.status in (404, 410):
+        return None, None
+    raise HttpError(resp, content, uri=session_uri)
+
+
+def set_thumbnail(youtube_service, video_id, thumb_fileobj=None, mimetype='image/jpeg'):
     if thumb_fileobj is None:
         return None
     try:
@@ -49,7 +248,9 @@ def set_thumbnail(youtube_service, video_id, thumb_fileobj=None):
             thumb_fileobj.seek(0)
     except Exception:
         pass
-    media = MediaIoBaseUpload(thumb_fileobj, mimetype='image/jpeg', resumable=False)
-    res = youtube_service.thumbnails().set(videoId=video_id, media_body=media).execute()
+    media = MediaIoBaseUpload(thumb_fileobj, mimetype=mimetype, resumable=False)
+    quota_ledger.charge('thumbnails.set')
+    with span('thumbnail', video_id=video_id), api_call('youtube.thumbnails.set'):
+        res = youtube_service.thumbnails().set(videoId=video_id, media_body=media).execute()
     logger.info('Thumbnail set response: %s', res)
     return res